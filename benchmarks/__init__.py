@@ -0,0 +1,6 @@
+"""
+Benchmarks for the Product service
+
+Each module in this package is a standalone script that seeds a database
+through the service models and prints or stores its measurements.
+"""
@@ -0,0 +1,56 @@
+"""
+Shared helpers for the benchmarks
+"""
+import statistics
+import subprocess
+import time
+from service.models import Product
+from tests.factories import ProductFactory
+
+
+def seed(rows: int, chunk_size: int = 10000):
+    """Replaces the catalog with freshly generated Products"""
+    Product.delete_many(filters={})
+    for start in range(0, rows, chunk_size):
+        count = min(chunk_size, rows - start)
+        Product.create_many([product.serialize() for product in ProductFactory.build_batch(count)])
+
+
+def summarize(timings: list, elapsed: float) -> dict:
+    """Returns throughput and latency percentiles in milliseconds"""
+    ordered = sorted(timings)
+
+    def percentile(fraction: float) -> float:
+        index = min(len(ordered) - 1, round(fraction * (len(ordered) - 1)))
+        return round(ordered[index] * 1000, 3)
+
+    return {
+        "count": len(ordered),
+        "ops_per_sec": round(len(ordered) / elapsed, 1) if elapsed else 0.0,
+        "mean_ms": round(statistics.fmean(ordered) * 1000, 3),
+        "p50_ms": percentile(0.50),
+        "p90_ms": percentile(0.90),
+        "p99_ms": percentile(0.99),
+        "max_ms": round(ordered[-1] * 1000, 3),
+    }
+
+
+def timed(operation, count: int) -> dict:
+    """Calls operation(i) count times and summarizes the latencies"""
+    timings = []
+    started = time.perf_counter()
+    for i in range(count):
+        start = time.perf_counter()
+        operation(i)
+        timings.append(time.perf_counter() - start)
+    return summarize(timings, time.perf_counter() - started)
+
+
+def git_revision() -> str:
+    """Returns the short hash of the checked out commit"""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
@@ -0,0 +1,61 @@
+"""
+Compare two benchmark result files
+
+Prints the change in throughput and p99 latency of every scenario and
+exits with status 1 when any scenario regressed by more than the
+threshold or answered with an unexpected status.
+
+Usage:
+    python -m benchmarks.compare benchmarks/results/abc1234.json benchmarks/results/def5678.json
+"""
+import argparse
+import json
+import sys
+
+
+def load(path: str) -> dict:
+    """Reads a benchmark result file"""
+    with open(path, encoding="utf-8") as file:
+        return json.load(file)
+
+
+def compare(baseline: dict, candidate: dict, threshold: float) -> list:
+    """Returns the scenarios whose p99 latency grew by more than threshold or that had errors"""
+    regressions = []
+    print(f"{'scenario':32} {'ops/s':>21} {'p99 ms':>21}")
+    for label, before in baseline["results"].items():
+        after = candidate["results"].get(label)
+        if after is None:
+            continue
+        change = (after["p99_ms"] - before["p99_ms"]) / before["p99_ms"] if before["p99_ms"] else 0.0
+        flag = "  REGRESSION" if change > threshold else ""
+        if after.get("errors"):
+            # a route answering with errors can look fast, never count it as a pass
+            flag += f"  {after['errors']} ERRORS"
+        print(
+            f"{label:32} {before['ops_per_sec']:>10} -> {after['ops_per_sec']:<8}"
+            f" {before['p99_ms']:>10} -> {after['p99_ms']:<8} ({change:+.0%}){flag}"
+        )
+        if flag:
+            regressions.append(label)
+    return regressions
+
+
+def main():
+    """Compares a candidate run against a baseline run"""
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("baseline", help="results of the reference commit")
+    parser.add_argument("candidate", help="results of the commit under test")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed p99 growth, 0.2 is 20%%")
+    args = parser.parse_args()
+
+    baseline, candidate = load(args.baseline), load(args.candidate)
+    print(f"{baseline['revision']} -> {candidate['revision']}")
+    regressions = compare(baseline, candidate, args.threshold)
+    if regressions:
+        print("Regressed: " + ", ".join(regressions))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""
+Request throughput with logging off, synchronous and queued
+
+Serves GET /products/<id> from concurrent threads through the Flask test
+client while the service logs at INFO to a file, the way gunicorn's
+error log would receive it. Compares logging off, the handlers called
+on the request thread, and the queued pipeline with and without
+sampling.
+
+Usage:
+    DATABASE_URI=sqlite:////tmp/bench.db python -m benchmarks.log_pipeline --requests 20000 --threads 8
+"""
+import argparse
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+from service import create_app
+from service.common import log_handlers
+from service.models import Product, db, init_db
+from benchmarks.common import seed, summarize
+
+SCENARIOS = {
+    "logging off": {"level": logging.WARNING, "LOG_ASYNC": False, "LOG_FORMAT": "text"},
+    "sync text": {"level": logging.INFO, "LOG_ASYNC": False, "LOG_FORMAT": "text"},
+    "sync json": {"level": logging.INFO, "LOG_ASYNC": False, "LOG_FORMAT": "json"},
+    "async json": {"level": logging.INFO, "LOG_ASYNC": True, "LOG_FORMAT": "json"},
+    "async json, INFO=0.1": {
+        "level": logging.INFO, "LOG_ASYNC": True, "LOG_FORMAT": "json", "LOG_SAMPLE_RATES": {"INFO": 0.1},
+    },
+}
+
+
+def run(app, ids: list, requests: int, threads: int) -> dict:
+    """Splits the requests over threads and summarizes their latencies"""
+    timings = []
+    lock = threading.Lock()
+
+    def worker(count: int, rng: random.Random):
+        client = app.test_client()
+        local = []
+        for _ in range(count):
+            start = time.perf_counter()
+            client.get(f"/products/{rng.choice(ids)}")
+            local.append(time.perf_counter() - start)
+        with lock:
+            timings.extend(local)
+
+    workers = [
+        threading.Thread(target=worker, args=(requests // threads, random.Random(number)))
+        for number in range(threads)
+    ]
+    started = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return summarize(timings, time.perf_counter() - started)
+
+
+def main():
+    """Serves the same requests under each logging setup and prints the throughput"""
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1000, help="number of products to seed")
+    parser.add_argument("--requests", type=int, default=20000, help="requests per scenario")
+    parser.add_argument("--threads", type=int, default=8, help="concurrent request threads")
+    args = parser.parse_args()
+
+    server_logger = logging.getLogger("gunicorn.error")
+    with tempfile.TemporaryDirectory() as directory:
+        for label, settings in SCENARIOS.items():
+            settings = dict(settings)
+            server_logger.setLevel(settings.pop("level"))
+            path = os.path.join(directory, f"{len(os.listdir(directory))}.log")
+            server_logger.handlers = [logging.FileHandler(path)]
+            # the cache would skip the lookups that log
+            app = create_app(dict(settings, PRODUCT_CACHE_SIZE=0))
+            init_db(app)
+            with app.app_context():
+                if db.session.query(Product.id).count() != args.rows:
+                    seed(args.rows)
+                ids = [product_id for (product_id,) in db.session.query(Product.id)]
+
+            result = run(app, ids, args.requests, args.threads)
+            log_handlers.stop_pipeline()
+            server_logger.handlers[0].close()
+            print(
+                f"{label:22} {result['ops_per_sec']:>10} req/s  p50 {result['p50_ms']:>8} ms  "
+                f"p99 {result['p99_ms']:>8} ms  log {os.path.getsize(path) // 1024:>8} KiB"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+Query plans before and after the Product indexes
+
+Seeds a catalog, drops the Product indexes, then captures the query plan
+and median latency of every filter query, recreates the indexes with
+``upgrade_db()`` and measures again.
+
+Usage:
+    DATABASE_URI=sqlite:////tmp/bench.db python -m benchmarks.query_plans --rows 100000
+"""
+import argparse
+import json
+import statistics
+import time
+from decimal import Decimal
+from service import app
+from service.models import Product, ProductQuery, Category, db, upgrade_db, init_db
+from benchmarks.common import seed
+
+
+def queries() -> dict:
+    """Returns the filter queries to examine keyed by a short label"""
+    return {
+        "find_by_name": Product.find_by_name("hammer"),
+        "name_prefix": ProductQuery().name_prefix("ham").query(),
+        "find_by_category": Product.find_by_category(Category.TOOLS),
+        "category_available": ProductQuery().categories([Category.TOOLS]).available(True).query(),
+        "find_by_price": Product.find_by_price(Decimal("19.99")),
+        "price_range": ProductQuery().price_range(Decimal("10"), Decimal("11")).query(),
+    }
+
+
+def explain(query) -> str:
+    """Returns the database query plan for a SQLAlchemy query"""
+    dialect = db.engine.dialect
+    sql = str(query.statement.compile(dialect=dialect, compile_kwargs={"literal_binds": True}))
+    prefix = "EXPLAIN QUERY PLAN " if dialect.name == "sqlite" else "EXPLAIN "
+    rows = db.session.execute(db.text(prefix + sql)).all()
+    return "\n".join(" ".join(str(column) for column in row) for row in rows)
+
+
+def measure(query, repeat: int) -> float:
+    """Returns the median milliseconds taken to fetch all rows of a query"""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        query.all()
+        timings.append((time.perf_counter() - start) * 1000)
+    return round(statistics.median(timings), 3)
+
+
+def run(repeat: int) -> dict:
+    """Captures the plan and latency of every query"""
+    return {
+        label: {"plan": explain(query), "median_ms": measure(query, repeat)}
+        for label, query in queries().items()
+    }
+
+
+def main():
+    """Seeds the catalog and compares the plans before and after indexing"""
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=50000, help="number of products to seed")
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs per query")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    args = parser.parse_args()
+    init_db(app)
+
+    seed(args.rows)
+    db.session.close()
+    for index in Product.__table__.indexes:
+        index.drop(db.engine)
+    before = run(args.repeat)
+    db.session.close()
+    upgrade_db()
+    db.session.execute(db.text("ANALYZE"))
+    db.session.commit()
+    after = run(args.repeat)
+
+    for label in before:
+        print(f"== {label}: {before[label]['median_ms']} ms -> {after[label]['median_ms']} ms")
+        print(f"   before: {before[label]['plan']}")
+        print(f"   after:  {after[label]['plan']}")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump({"rows": args.rows, "before": before, "after": after}, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
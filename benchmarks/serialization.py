@@ -0,0 +1,65 @@
+"""
+Serialization benchmark for Product lists
+
+Compares the ORM path (load Products, call serialize() and jsonify) with
+the column projection path (select tuples and encode them with orjson)
+over the same query, then compares the size and client decode time of
+the JSON list with the columnar MessagePack one.
+
+Usage:
+    DATABASE_URI=sqlite:////tmp/bench.db python -m benchmarks.serialization --rows 50000
+"""
+import argparse
+from decimal import Decimal
+import orjson
+from flask import jsonify
+from service import app
+from service.models import Product, db, init_db
+from service.common import encoders
+from benchmarks.common import seed, timed
+
+
+def orm_path(query) -> bytes:
+    """Serializes through ORM instances and the stdlib encoder"""
+    with app.test_request_context():
+        return jsonify([product.serialize() for product in query]).get_data()
+
+
+def projection_path(query) -> bytes:
+    """Serializes through projected tuples and orjson"""
+    return encoders.dumps(list(Product.project(query)))
+
+
+def decode_json(body: bytes) -> list:
+    """Decodes a JSON list the way a sync job would, prices as Decimals"""
+    products = orjson.loads(body)
+    for product in products:
+        product["price"] = Decimal(product["price"])
+    return products
+
+
+def main():
+    """Seeds the catalog and times both serialization paths"""
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=50000, help="number of products to seed")
+    parser.add_argument("--repeat", type=int, default=10, help="timed runs per path")
+    args = parser.parse_args()
+    init_db(app)
+
+    seed(args.rows)
+    query = Product.query.order_by(Product.id)
+    for label, path in (("orm + jsonify", orm_path), ("projection + orjson", projection_path)):
+        result = timed(lambda _, path=path: (path(query), db.session.expunge_all()), args.repeat)
+        print(f"{label:24} p50 {result['p50_ms']:>10} ms  p99 {result['p99_ms']:>10} ms")
+
+    bodies = {
+        "json": (projection_path(query), decode_json),
+        "msgpack columns": (encoders.pack_columns(Product.columns(query), args.rows), encoders.unpack_columns),
+    }
+    for label, (body, decode) in bodies.items():
+        result = timed(lambda _, body=body, decode=decode: decode(body), args.repeat)
+        print(f"decode {label:17} p50 {result['p50_ms']:>10} ms  {len(body):>12,} bytes")
+
+
+if __name__ == "__main__":
+    main()
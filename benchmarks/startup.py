@@ -0,0 +1,59 @@
+"""
+Startup time of the Product service
+
+Measures what a new worker pays before it serves traffic: importing the
+service package in a fresh interpreter, building an app with
+create_app(), and the lazy schema check run by the first request.
+
+Usage:
+    DATABASE_URI=sqlite:////tmp/bench.db python -m benchmarks.startup --repeat 10
+"""
+import argparse
+import subprocess
+import sys
+import time
+from service import create_app
+from benchmarks.common import summarize
+
+IMPORT_SCRIPT = "import time; t = time.perf_counter(); import service; print(time.perf_counter() - t)"
+
+
+def import_time() -> float:
+    """Returns the seconds a fresh interpreter spends importing the service"""
+    result = subprocess.run([sys.executable, "-c", IMPORT_SCRIPT], capture_output=True, text=True, check=True)
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def first_request_time(schema_check: bool) -> float:
+    """Returns the seconds a new app takes to answer its first request"""
+    app = create_app({"DB_SCHEMA_CHECK": schema_check})
+    client = app.test_client()
+    start = time.perf_counter()
+    client.get("/health")
+    return time.perf_counter() - start
+
+
+def main():
+    """Times each startup phase and prints the latency percentiles"""
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=10, help="timed runs per phase")
+    args = parser.parse_args()
+
+    phases = {
+        "import service": import_time,
+        "create_app()": lambda: create_app(),  # pylint: disable=unnecessary-lambda
+        "first request": lambda: first_request_time(True),
+        "first request (no check)": lambda: first_request_time(False),
+    }
+    for label, phase in phases.items():
+        timings = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            value = phase()
+            timings.append(value if isinstance(value, float) else time.perf_counter() - start)
+        result = summarize(timings, sum(timings))
+        print(f"{label:26} p50 {result['p50_ms']:>10} ms  p99 {result['p99_ms']:>10} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+"""
+Benchmark suite for the Product service
+
+Seeds a catalog with ProductFactory and measures the throughput and
+latency percentiles of every route through the Flask test client and of
+every Product finder, counting the responses with an unexpected status
+as errors, then stores the results as JSON named after the
+current commit so that runs can be compared with benchmarks.compare.
+
+Usage:
+    DATABASE_URI=sqlite:////tmp/bench.db python -m benchmarks.suite --rows 10000
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import secrets
+from datetime import datetime, timezone
+from typing import Callable, NamedTuple
+from service import app
+from service.common import status
+from service.models import Product, Category, db, product_cache, init_db
+from benchmarks.common import git_revision, seed, timed
+from tests.factories import ProductFactory
+
+
+class Scenario(NamedTuple):
+    """An HTTP request to time with the status it must answer with
+
+    ``setup(count)`` runs before the timed loop and seeds whatever rows
+    the scenario consumes, ``scale`` is the share of --requests it runs.
+    """
+
+    request: Callable
+    expected: int = status.HTTP_200_OK
+    setup: Callable = None
+    scale: float = 1.0
+
+
+def fresh_ids(count: int) -> list:
+    """Adds count Products for a scenario to consume and returns their ids"""
+    return Product.create_many([product.serialize() for product in ProductFactory.build_batch(count)])
+
+
+def route_scenarios(client, ids: list, rng: random.Random, page_size: int) -> dict:
+    """Returns the HTTP scenarios keyed by route name"""
+    names = [name for (name,) in db.session.query(Product.name).limit(100)]
+    admin = {"Authorization": f"Bearer {app.config['ADMIN_TOKEN']}"}
+    doomed = []
+
+    def seed_doomed(size: int):
+        def setup(count):
+            fresh = fresh_ids(count * size)
+            doomed[:] = [fresh[start:start + size] for start in range(0, len(fresh), size)]
+        return setup
+
+    return {
+        "index": Scenario(lambda _: client.get("/")),
+        "healthcheck": Scenario(lambda _: client.get("/health")),
+        "metrics": Scenario(lambda _: client.get("/metrics")),
+        "admin_cache": Scenario(lambda _: client.get("/admin/cache")),
+        "admin_pool": Scenario(lambda _: client.get("/admin/pool")),
+        "admin_profile": Scenario(
+            # the profiler only runs in threaded workers such as gunicorn gthread
+            lambda _: client.get("/admin/profile?seconds=0.05", headers=admin, environ_overrides={"wsgi.multithread": True}),
+            scale=0.1,
+        ),
+        "get_product": Scenario(lambda _: client.get(f"/products/{rng.choice(ids)}")),
+        "product_stats": Scenario(lambda _: client.get("/products/stats")),
+        "list_products_all": Scenario(lambda _: client.get("/products"), scale=0.1),
+        "list_products_page": Scenario(lambda _: client.get(f"/products?limit={page_size}")),
+        "list_products_by_name": Scenario(lambda _: client.get(f"/products?name={rng.choice(names)}&limit={page_size}")),
+        "list_products_by_category": Scenario(lambda _: client.get(f"/products?category=FOOD&limit={page_size}")),
+        "list_products_filtered": Scenario(lambda _: client.get(
+            f"/products?category=TOOLS&available=true&price_min=100&price_max=500&limit={page_size}"
+        )),
+        "create_products": Scenario(
+            lambda _: client.post("/products", json=ProductFactory.build().serialize()), status.HTTP_201_CREATED
+        ),
+        "update_product": Scenario(
+            lambda _: client.put(f"/products/{rng.choice(ids)}", json=ProductFactory.build().serialize())
+        ),
+        "delete_product": Scenario(
+            lambda i: client.delete(f"/products/{doomed[i][0]}"), status.HTTP_204_NO_CONTENT, seed_doomed(1)
+        ),
+        "create_products_batch": Scenario(
+            lambda _: client.post("/products:batch", json=[p.serialize() for p in ProductFactory.build_batch(100)]),
+            status.HTTP_201_CREATED,
+            scale=0.1,
+        ),
+        "update_products_batch": Scenario(
+            lambda _: client.patch(
+                "/products:batch", json={"filter": {"category": "CLOTHS"}, "set": {"price_delta": "0.01"}}
+            ),
+            scale=0.1,
+        ),
+        "delete_products_batch": Scenario(
+            lambda i: client.delete("/products:batch", json={"ids": doomed[i]}), setup=seed_doomed(100), scale=0.1
+        ),
+    }
+
+
+def checked(scenario: Scenario, errors: list):
+    """Wraps the request of a scenario to record the responses with an unexpected status"""
+    def operation(i):
+        response = scenario.request(i)
+        if response.status_code != scenario.expected:
+            errors.append(response.status_code)
+    return operation
+
+
+def model_scenarios(ids: list, rng: random.Random, page_size: int) -> dict:
+    """Returns the model scenarios keyed by Product method name"""
+    prices = [price for (price,) in db.session.query(Product.price).limit(100)]
+    return {
+        "Product.all_paged": lambda _: Product.all_paged(page_size, after=rng.choice(ids)),
+        "Product.find": lambda _: Product.find(rng.choice(ids)),
+        "Product.find_serialized": lambda _: Product.find_serialized(rng.choice(ids)),
+        "Product.find_by_name": lambda _: Product.find_by_name(
+            Product.find(rng.choice(ids)).name
+        ).limit(page_size).all(),
+        "Product.find_by_price": lambda _: Product.find_by_price(rng.choice(prices)).limit(page_size).all(),
+        "Product.find_by_availability": lambda _: Product.find_by_availability(
+            rng.random() < 0.5
+        ).limit(page_size).all(),
+        "Product.find_by_category": lambda _: Product.find_by_category(
+            rng.choice([Category.CLOTHS, Category.FOOD, Category.TOOLS])
+        ).limit(page_size).all(),
+    }
+
+
+def run(args) -> dict:
+    """Seeds the catalog and runs every scenario"""
+    seed(args.rows)
+    app.config["ADMIN_TOKEN"] = app.config["ADMIN_TOKEN"] or secrets.token_hex(16)
+    ids = [product_id for (product_id,) in db.session.query(Product.id)]
+    rng = random.Random(args.seed)
+    client = app.test_client()
+
+    results = {}
+    scenarios = dict(model_scenarios(ids, rng, args.page_size))
+    scenarios.update(route_scenarios(client, ids, rng, args.page_size))
+    for label, scenario in scenarios.items():
+        if args.only and label not in args.only:
+            continue
+        product_cache.clear()
+        if isinstance(scenario, Scenario):
+            count = max(int(args.requests * scenario.scale), 1)
+            if scenario.setup is not None:
+                scenario.setup(count)
+            errors = []
+            results[label] = timed(checked(scenario, errors), count)
+            results[label]["errors"] = len(errors)
+        else:
+            results[label] = timed(scenario, args.requests)
+        db.session.remove()
+        print(f"{label:32} {results[label]['ops_per_sec']:>10} ops/s  p50 {results[label]['p50_ms']} ms"
+              f"  p99 {results[label]['p99_ms']} ms")
+        if results[label].get("errors"):
+            print(f"{'':32} {results[label]['errors']} responses were not {scenario.expected}: {sorted(set(errors))}")
+    return results
+
+
+def main():
+    """Runs the suite and writes the results to a JSON file"""
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=10000, help="number of products to seed")
+    parser.add_argument("--requests", type=int, default=500, help="operations per scenario")
+    parser.add_argument("--page-size", type=int, default=100, help="rows fetched by list scenarios")
+    parser.add_argument("--seed", type=int, default=42, help="random seed for the chosen ids")
+    parser.add_argument("--only", nargs="*", help="run only these scenarios")
+    parser.add_argument("--output", help="results file, defaults to benchmarks/results/<commit>.json")
+    args = parser.parse_args()
+    init_db(app)
+
+    revision = git_revision()
+    results = run(args)
+    report = {
+        "revision": revision,
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "database": db.engine.dialect.name,
+        "python": platform.python_version(),
+        "rows": args.rows,
+        "requests": args.requests,
+        "page_size": args.page_size,
+        "results": results,
+    }
+    output = args.output or os.path.join("benchmarks", "results", f"{revision}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w", encoding="utf-8") as file:
+        json.dump(report, file, indent=2)
+    print(f"Results written to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+"""
+Gunicorn configuration
+
+Used by the Procfile and the Dockerfile. Workers and threads are sized
+from the CPUs available to the container unless overridden:
+
+    GUNICORN_WORKER_CLASS   gthread (default), sync or gevent
+    GUNICORN_WORKERS        worker processes (WEB_CONCURRENCY is honored too)
+    GUNICORN_THREADS        threads per gthread worker
+    GUNICORN_MAX_REQUESTS   requests before a worker is recycled, 0 disables
+    GUNICORN_KEEPALIVE      seconds to hold idle keep-alive connections
+    GUNICORN_PRELOAD        load the app once in the master (default true)
+
+Each worker gets its own connection pool, so DB_POOL_SIZE defaults to
+the number of threads in a worker.
+
+/admin/profile is refused by sync workers and only sees request work in
+gthread workers with more than one thread.
+"""
+import math
+import os
+import sys
+import time
+
+
+def cpu_count() -> int:
+    """Returns the CPUs this process may use, honoring cgroup quotas"""
+    try:
+        count = len(os.sched_getaffinity(0))
+    except AttributeError:
+        count = os.cpu_count() or 1
+    try:
+        with open("/sys/fs/cgroup/cpu.max", encoding="ascii") as cpu_max:
+            quota, period = cpu_max.read().split()
+        if quota != "max":
+            count = min(count, math.ceil(int(quota) / int(period)))
+    except (OSError, ValueError):
+        pass
+    return max(count, 1)
+
+
+def _env_int(name: str, default: int) -> int:
+    value = os.getenv(name)
+    return int(value) if value not in (None, "") else default
+
+
+CPUS = cpu_count()
+
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+if worker_class == "gthread":
+    # threads overlap database round trips, processes use the CPUs
+    workers = _env_int("GUNICORN_WORKERS", _env_int("WEB_CONCURRENCY", CPUS))
+    threads = _env_int("GUNICORN_THREADS", 4)
+elif worker_class == "gevent":
+    workers = _env_int("GUNICORN_WORKERS", _env_int("WEB_CONCURRENCY", CPUS))
+    threads = 1
+    worker_connections = _env_int("GUNICORN_WORKER_CONNECTIONS", 1000)
+else:
+    workers = _env_int("GUNICORN_WORKERS", _env_int("WEB_CONCURRENCY", CPUS * 2 + 1))
+    threads = 1
+os.environ.setdefault("DB_POOL_SIZE", str(threads if worker_class != "gevent" else 10))
+
+bind = os.getenv("GUNICORN_BIND", f"0.0.0.0:{os.getenv('PORT', '8080')}")
+preload_app = os.getenv("GUNICORN_PRELOAD", "true").lower() == "true"
+
+# recycle workers to bound slow leaks, jittered so they do not restart together
+max_requests = _env_int("GUNICORN_MAX_REQUESTS", 1000)
+max_requests_jitter = _env_int("GUNICORN_MAX_REQUESTS_JITTER", max(max_requests // 10, 1) if max_requests else 0)
+
+# keep-alive must outlive the load balancer idle timeout or it will reuse closed sockets
+keepalive = _env_int("GUNICORN_KEEPALIVE", 75)
+timeout = _env_int("GUNICORN_TIMEOUT", 30)
+graceful_timeout = _env_int("GUNICORN_GRACEFUL_TIMEOUT", 30)
+
+# heartbeat files on tmpfs so a slow container disk cannot stall the workers
+worker_tmp_dir = "/dev/shm" if os.path.isdir("/dev/shm") else None
+loglevel = os.getenv("GUNICORN_LOG_LEVEL", "info")
+accesslog = os.getenv("GUNICORN_ACCESS_LOG") or None
+
+
+def when_ready(server):
+    """Checks the database schema once in the master before any worker forks"""
+    if not preload_app:
+        return
+    from service import app  # pylint: disable=import-outside-toplevel
+    from service.models import db, ensure_schema  # pylint: disable=import-outside-toplevel
+
+    try:
+        with app.app_context():
+            ensure_schema()
+            # the master serves no requests, so it keeps no connections
+            db.engine.dispose()
+    except Exception as error:  # pylint: disable=broad-except
+        server.log.critical("%s: Cannot continue", error)
+        # gunicorn requires exit code 4 to stop spawning workers when they die
+        sys.exit(4)
+
+
+def pre_fork(server, worker):  # pylint: disable=unused-argument
+    """Stamps the worker with its spawn time to measure how long it takes to boot"""
+    worker.spawned_at = time.monotonic()
+
+
+def post_fork(server, worker):  # pylint: disable=unused-argument
+    """Drops the connections a preloaded master handed down to the worker
+
+    A forked worker shares the master's pooled sockets. ``close=False``
+    forgets them without closing them, so the master's connections stay
+    usable and the worker opens fresh ones on first use.
+    """
+    from service import app  # pylint: disable=import-outside-toplevel
+    from service.models import db  # pylint: disable=import-outside-toplevel
+    from service.common.pool import pool_stats  # pylint: disable=import-outside-toplevel
+
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
+    pool_stats.reset()
+
+
+def post_worker_init(worker):
+    """Records the worker boot time and makes psycopg2 cooperative under gevent"""
+    from service.common import metrics  # pylint: disable=import-outside-toplevel
+
+    metrics.WORKER_BOOT.observe(time.monotonic() - worker.spawned_at)
+    if worker_class != "gevent":
+        return
+    try:
+        from psycogreen.gevent import patch_psycopg  # pylint: disable=import-outside-toplevel
+    except ImportError:
+        worker.log.warning("psycogreen is not installed, database calls will block the gevent loop")
+        return
+    patch_psycopg()
+
+
+def child_exit(server, worker):  # pylint: disable=unused-argument
+    """Removes the live gauges of a dead worker from the shared metrics"""
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess  # pylint: disable=import-outside-toplevel
+
+        multiprocess.mark_process_dead(worker.pid)
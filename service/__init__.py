@@ -18,41 +18,71 @@
 Package: service
 
 Package for the application models and service routes
-This module creates and configures the Flask app and sets up the logging
-and SQL database
+This module provides the create_app() factory that configures the Flask
+app, its logging, metrics and routes. Creating the app does not touch the
+database: the schema is checked lazily by models.ensure_schema().
 """
-import sys
-from flask import Flask
-from service import config
-from service.common import log_handlers
+import time
 
-# NOTE: Do not change the order of this code
-# The Flask app must be created
-# BEFORE you import modules that depend on it !!!
+_import_started = time.perf_counter()
 
-# Create the Flask aoo
-app = Flask(__name__)  # pylint: disable=invalid-name
+# pylint: disable=wrong-import-position
+from flask import Flask  # noqa: E402
+from service import config  # noqa: E402
+from service.common import compression, log_handlers, metrics, profiling  # noqa: E402
 
-# Load Configurations
-app.config.from_object(config)
 
-# Dependencies require we import the routes AFTER the Flask app is created
-# pylint: disable=wrong-import-position, wrong-import-order, cyclic-import
-from service import routes, models        # noqa: F401, E402
-from service.common import error_handlers, cli_commands  # noqa: F401, E402
+def create_app(test_config: dict = None) -> Flask:
+    """Creates and configures a Flask app for the Product service
 
-# Set up logging for production
-log_handlers.init_logging(app, "gunicorn.error")
+    :param test_config: settings that override the environment configuration
+    :type test_config: dict
 
-app.logger.info(70 * "*")
-app.logger.info("  P E T   S E R V I C E   R U N N I N G  ".center(70, "*"))
-app.logger.info(70 * "*")
+    """
+    started = time.perf_counter()
+    app = Flask(__name__)
 
-try:
-    models.init_db(app)  # make our sqlalchemy tables
-except Exception as error:  # pylint: disable=broad-except
-    app.logger.critical("%s: Cannot continue", error)
-    # gunicorn requires exit code 4 to stop spawning workers when they die
-    sys.exit(4)
+    # Load Configurations
+    app.config.from_object(config)
+    if test_config:
+        app.config.update(test_config)
 
-app.logger.info("Service initialized!")
+    # pylint: disable=import-outside-toplevel, cyclic-import
+    from service import models
+    from service.routes import api
+    from service.common.error_handlers import errors
+    from service.common.cli_commands import commands
+
+    app.register_blueprint(api)
+    app.register_blueprint(errors)
+    app.register_blueprint(commands)
+
+    # Set up logging for production
+    log_handlers.init_logging(app, "gunicorn.error")
+
+    # Collect request and database metrics
+    metrics.init_metrics(app)
+
+    # Profile SQL per request, before compression so its timing is reported
+    profiling.init_profiling(app)
+
+    # Compress large responses, after metrics so they record the bytes sent
+    compression.init_compression(app)
+
+    # Configure the engine now, connect on first use
+    models.init_app(app)
+    app.before_request(models.ensure_schema)
+
+    elapsed = time.perf_counter() - started
+    metrics.record_startup("create_app", elapsed)
+    app.logger.info(70 * "*")
+    app.logger.info("  P E T   S E R V I C E   R U N N I N G  ".center(70, "*"))
+    app.logger.info(70 * "*")
+    app.logger.info("Service initialized in %.3fs", elapsed)
+    return app
+
+
+# The app served by gunicorn (service:app) and the flask CLI
+app = create_app()  # pylint: disable=invalid-name
+
+metrics.record_startup("import", time.perf_counter() - _import_started)
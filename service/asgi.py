@@ -0,0 +1,295 @@
+"""
+Async ASGI entry point
+
+Serves the product routes from a Starlette app on an async SQLAlchemy
+engine (asyncpg for PostgreSQL, aiosqlite for SQLite) so that a single
+process keeps many requests in flight while they wait on the database.
+The Product model, ProductQuery, validation, serialization, cache and
+cursors are shared with the Flask app.
+
+Usage:
+    uvicorn service.asgi:app --host 0.0.0.0 --port 8080
+"""
+import contextlib
+import hashlib
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm.exc import StaleDataError
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+from werkzeug.exceptions import HTTPException
+from service import app as flask_app
+from service.common import encoders, status
+from service.models import (
+    DataValidationError, IdempotencyKey, Product, ProductQuery, db, ensure_schema, invalidate_caches, product_cache
+)
+from service.routes import decode_cursor, encode_cursor, product_etag
+
+ASYNC_DRIVERS = {"postgresql": "postgresql+asyncpg", "sqlite": "sqlite+aiosqlite"}
+
+
+def async_engine_url():
+    """Returns the URL of the Flask app database with its async driver"""
+    with flask_app.app_context():
+        url = db.engine.url
+    backend = url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise RuntimeError(f"No async driver configured for {backend}")
+    return url.set(drivername=ASYNC_DRIVERS[backend])
+
+
+def async_engine_options(url) -> dict:
+    """Returns the pool options for the async engine from the DB_POOL_* settings"""
+    config = flask_app.config
+    options = {"pool_pre_ping": config["DB_POOL_PRE_PING"]}
+    if url.get_backend_name() != "sqlite":
+        options.update(
+            pool_size=config["DB_POOL_SIZE"],
+            max_overflow=config["DB_MAX_OVERFLOW"],
+            pool_recycle=config["DB_POOL_RECYCLE"],
+            pool_timeout=config["DB_POOL_TIMEOUT"],
+        )
+    return options
+
+
+engine_url = async_engine_url()
+engine = create_async_engine(engine_url, **async_engine_options(engine_url))
+Session = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+
+
+######################################################################
+# UTILITY
+######################################################################
+def error_response(status_code: int, error: str, message: str) -> JSONResponse:
+    """Returns an error body shaped like the Flask error handlers"""
+    return JSONResponse({"status": status_code, "error": error, "message": message}, status_code)
+
+
+def json_response(data, status_code: int = status.HTTP_200_OK, headers: dict = None) -> Response:
+    """Returns a JSON response encoded with the fast encoder"""
+    return Response(encoders.dumps(data), status_code, headers, media_type="application/json")
+
+
+async def get_json(request: Request):
+    """Returns the JSON body of a request after checking its Content-Type"""
+    if request.headers.get("Content-Type") != "application/json":
+        return None
+    try:
+        return await request.json()
+    except ValueError as error:
+        raise DataValidationError("Invalid JSON: " + str(error)) from error
+
+
+def page_args(request: Request):
+    """Returns the (limit, after) pagination arguments or None if not paging"""
+    limit = request.query_params.get("limit")
+    after = request.query_params.get("after")
+    if limit is None and after is None:
+        return None
+    max_limit = flask_app.config["PAGE_SIZE_MAX"]
+    try:
+        limit = int(limit) if limit is not None else max_limit
+    except ValueError as error:
+        raise DataValidationError(f"Invalid limit: {limit}") from error
+    if not 0 < limit <= max_limit:
+        raise DataValidationError(f"limit must be between 1 and {max_limit}")
+    return limit, decode_cursor(after) if after else None
+
+
+######################################################################
+# ROUTES
+######################################################################
+async def healthcheck(request: Request):  # pylint: disable=unused-argument
+    """Health check endpoint"""
+    return JSONResponse({"status": 200, "message": "OK"})
+
+
+async def list_products(request: Request):
+    """List Products with optional filters and keyset pagination"""
+    builder = ProductQuery(dialect=engine.dialect.name).apply(request.query_params)
+    page = page_args(request)
+    statement = builder.select(*page) if page else builder.select()
+    if builder.rank is not None:
+        statement = statement.add_columns(builder.rank)
+
+    async with Session() as session:
+        rows = (await session.execute(statement)).all()
+    results = [row[0].serialize() for row in rows]
+
+    headers = {}
+    if page is not None and len(rows) == page[0]:
+        rank = rows[-1][1] if builder.rank is not None else None
+        cursor = encode_cursor(builder.cursor(results[-1], rank))
+        headers["Link"] = f'<{request.url.include_query_params(after=cursor)}>; rel="next"'
+    return json_response(results, headers=headers)
+
+
+async def get_product(request: Request):
+    """Read a Product"""
+    product_id = request.path_params["product_id"]
+    payload = product_cache.get(product_id)
+    if payload is None:
+        async with Session() as session:
+            product = await session.get(Product, product_id)
+        if product is None:
+            return error_response(status.HTTP_404_NOT_FOUND, "Not Found", f"Product {product_id} not found")
+        payload = product.serialize()
+        product_cache.set(product_id, payload)
+
+    etag = product_etag(payload["id"], payload["version"])
+    if f'"{etag}"' in request.headers.get("If-None-Match", ""):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": f'"{etag}"'})
+    return json_response(payload, headers={"ETag": f'"{etag}"'})
+
+
+async def create_products(request: Request):
+    """Create a Product"""
+    data = await get_json(request)
+    if data is None:
+        return error_response(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, "Unsupported media type", "")
+    key = request.headers.get("Idempotency-Key")
+    if key is not None:
+        if not 0 < len(key) <= 255:
+            raise DataValidationError("Idempotency-Key must be 1 to 255 characters")
+        fingerprint = hashlib.sha256(await request.body()).hexdigest()
+        record = await find_idempotency_key(key)
+        if record is not None:
+            return replay_created(request, record, fingerprint)
+    product = Product()
+    product.deserialize(data)
+    async with Session() as session:
+        session.add(product)
+        if key is not None:
+            # the same steps as Product.create, on the async session
+            await session.flush()
+            await session.refresh(product)
+            await session.execute(IdempotencyKey.expire_statement(key))
+            session.add(IdempotencyKey.store(key, fingerprint, product.serialize()))
+        try:
+            await session.commit()
+        except IntegrityError:
+            # a concurrent request with the same key got there first
+            await session.rollback()
+            return replay_created(request, await find_idempotency_key(key), fingerprint)
+    invalidate_caches(product.id)
+
+    location_url = str(request.url_for("get_product", product_id=product.id))
+    return json_response(product.serialize(), status.HTTP_201_CREATED, {"Location": location_url})
+
+
+async def find_idempotency_key(key: str):
+    """Returns the live record stored under an Idempotency-Key, or None"""
+    async with Session() as session:
+        record = await session.get(IdempotencyKey, key)
+    if record is None or record.expired():
+        return None
+    return record
+
+
+def replay_created(request: Request, record: IdempotencyKey, fingerprint: str) -> Response:
+    """Returns the stored response of a create request again"""
+    if record is None:
+        return error_response(status.HTTP_409_CONFLICT, "Conflict", "Idempotency-Key is already in use")
+    if record.fingerprint != fingerprint:
+        return error_response(
+            status.HTTP_422_UNPROCESSABLE_ENTITY,
+            "Unprocessable Entity",
+            "Idempotency-Key was used with a different request body",
+        )
+    location_url = str(request.url_for("get_product", product_id=record.response["id"]))
+    headers = {"Location": location_url, "Idempotent-Replayed": "true"}
+    return json_response(record.response, status.HTTP_201_CREATED, headers)
+
+
+async def update_product(request: Request):
+    """Update a Product"""
+    product_id = request.path_params["product_id"]
+    data = await get_json(request)
+    if data is None:
+        return error_response(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, "Unsupported media type", "")
+    async with Session() as session:
+        product = await session.get(Product, product_id)
+        if product is None:
+            return error_response(status.HTTP_404_NOT_FOUND, "Not Found", f"Product {product_id} not found")
+        if not if_match(request, product):
+            return error_response(
+                status.HTTP_412_PRECONDITION_FAILED, "Precondition Failed", "Product was modified by another request"
+            )
+        product.deserialize(data)
+        await session.commit()
+    invalidate_caches(product_id)
+
+    etag = product_etag(product.id, product.version)
+    return json_response(product.serialize(), headers={"ETag": f'"{etag}"'})
+
+
+async def delete_product(request: Request):
+    """Delete a Product"""
+    product_id = request.path_params["product_id"]
+    async with Session() as session:
+        product = await session.get(Product, product_id)
+        if product is None:
+            return error_response(status.HTTP_404_NOT_FOUND, "Not Found", f"Product {product_id} not found")
+        if not if_match(request, product):
+            return error_response(
+                status.HTTP_412_PRECONDITION_FAILED, "Precondition Failed", "Product was modified by another request"
+            )
+        await session.delete(product)
+        await session.commit()
+    invalidate_caches(product_id)
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
+
+
+def if_match(request: Request, product: Product) -> bool:
+    """Returns False when an If-Match header does not match the Product"""
+    header = request.headers.get("If-Match")
+    if header is None or header.strip() == "*":
+        return True
+    return f'"{product_etag(product.id, product.version)}"' in header
+
+
+######################################################################
+# ERROR HANDLERS
+######################################################################
+async def request_validation_error(request: Request, error: DataValidationError):  # pylint: disable=unused-argument
+    """Handles Value Errors from bad data"""
+    return error_response(status.HTTP_400_BAD_REQUEST, "Bad Request", str(error))
+
+
+async def stale_data_error(request: Request, error: StaleDataError):  # pylint: disable=unused-argument
+    """Handles concurrent modifications detected by the row version"""
+    return error_response(status.HTTP_409_CONFLICT, "Conflict", str(error))
+
+
+async def http_error(request: Request, error: HTTPException):  # pylint: disable=unused-argument
+    """Handles the HTTP errors raised by helpers shared with the Flask routes"""
+    return error_response(error.code, error.name, error.description)
+
+
+@contextlib.asynccontextmanager
+async def lifespan(_app):
+    """Checks the schema on startup and closes the pooled connections on shutdown"""
+    with flask_app.app_context():
+        ensure_schema()
+    yield
+    await engine.dispose()
+
+
+app = Starlette(
+    routes=[
+        Route("/health", healthcheck),
+        Route("/products", list_products, methods=["GET"]),
+        Route("/products", create_products, methods=["POST"]),
+        Route("/products/{product_id:int}", get_product, methods=["GET"], name="get_product"),
+        Route("/products/{product_id:int}", update_product, methods=["PUT"]),
+        Route("/products/{product_id:int}", delete_product, methods=["DELETE"]),
+    ],
+    exception_handlers={
+        DataValidationError: request_validation_error,
+        StaleDataError: stale_data_error,
+        HTTPException: http_error,
+    },
+    lifespan=lifespan,
+)
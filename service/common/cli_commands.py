@@ -1,15 +1,23 @@
 """
 Flask CLI Command Extensions
 """
-from service import app
-from service.models import db
+import os
+import urllib.error
+import urllib.request
+import click
+from flask import Blueprint, current_app
+from service.common import exporter, importer
+from service.models import IdempotencyKey, db, ensure_schema, upgrade_db
+
+# Commands are added to the top level of the flask CLI by create_app()
+commands = Blueprint("commands", __name__, cli_group=None)
 
 
 ######################################################################
 # Command to force tables to be rebuilt
 # Usage: flask db-create
 ######################################################################
-@app.cli.command("db-create")
+@commands.cli.command("db-create")
 def db_create():
     """
     Recreates a local database. You probably should not use this on
@@ -18,3 +26,124 @@ def db_create():
     db.drop_all()
     db.create_all()
     db.session.commit()
+
+
+######################################################################
+# Command to bring an existing database up to the current schema
+# Usage: flask db-upgrade
+######################################################################
+@commands.cli.command("db-upgrade")
+def db_upgrade():
+    """
+    Creates any tables and indexes missing from an existing database
+    without touching the data already in it.
+    """
+    created = upgrade_db()
+    for name in created:
+        print(f"Created {name}")
+    print(f"Schema is up to date ({len(created)} objects created)")
+
+
+######################################################################
+# Command to delete expired idempotency keys
+# Usage: flask idempotency-purge
+######################################################################
+@commands.cli.command("idempotency-purge")
+def idempotency_purge():
+    """
+    Deletes the stored responses of idempotent requests that are older
+    than IDEMPOTENCY_TTL. Run it periodically to keep the table small.
+    """
+    count = IdempotencyKey.purge()
+    print(f"Purged {count} idempotency keys")
+
+
+######################################################################
+# Command to capture a CPU profile of a running worker
+# Usage: flask cpu-profile --seconds 30 --output worker.folded
+######################################################################
+@commands.cli.command("cpu-profile")
+@click.option("--url", default=lambda: f"http://localhost:{os.getenv('PORT', '8080')}", show_default="localhost:$PORT",
+              help="Base URL of the running service.")
+@click.option("--seconds", default=10.0, show_default=True, help="How long to sample for.")
+@click.option("--output", type=click.File("wb"), default="-", help="File to write the collapsed stacks to.")
+def cpu_profile(url, seconds, output):
+    """
+    Samples the stacks of the worker that serves the request for SECONDS
+    and writes them as collapsed stacks for flamegraph.pl or speedscope.
+    Uses the ADMIN_TOKEN the service is configured with.
+    """
+    token = current_app.config["ADMIN_TOKEN"]
+    if not token:
+        raise click.UsageError("ADMIN_TOKEN must be set to capture a profile")
+    request = urllib.request.Request(
+        f"{url.rstrip('/')}/admin/profile?seconds={seconds:g}", headers={"Authorization": f"Bearer {token}"}
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=seconds + 30) as response:
+            output.write(response.read())
+            samples = response.headers.get("X-Profile-Samples")
+    except urllib.error.HTTPError as error:
+        message = error.read().decode(errors="replace")
+        raise click.ClickException(f"Profile failed with HTTP {error.code}: {message}") from error
+    except urllib.error.URLError as error:
+        raise click.ClickException(f"Cannot reach {url}: {error.reason}") from error
+    click.echo(f"Captured {samples} samples in {seconds:g}s", err=True)
+
+
+######################################################################
+# Command to load a supplier catalog
+# Usage: flask products-import catalog.csv
+######################################################################
+@commands.cli.command("products-import")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--format", "fmt", type=click.Choice(importer.FORMATS), help="File format, from the extension by default.")
+@click.option("--batch-size", default=10000, show_default=True, help="Rows loaded per transaction.")
+@click.option("--rejects", type=click.Path(dir_okay=False), help="Where rejected rows go, PATH.rejects.ndjson by default.")
+def products_import(path, fmt, batch_size, rejects):
+    """
+    Loads Products from a CSV or NDJSON file with COPY on PostgreSQL and
+    batched INSERTs elsewhere. Rows that fail validation are written to
+    the rejects file and the rest of the file is still loaded.
+    """
+    try:
+        fmt = fmt or importer.detect_format(path)
+    except ValueError as error:
+        raise click.UsageError(str(error)) from error
+    rejects = rejects or f"{path}.rejects.ndjson"
+    ensure_schema()
+    with open(path, encoding="utf-8", newline="") as stream, open(rejects, "w", encoding="utf-8") as rejects_file:
+        result = importer.import_products(stream, fmt, rejects_file, batch_size)
+    if not result["rejected"]:
+        os.remove(rejects)
+    rate = result["imported"] / result["seconds"] if result["seconds"] else 0
+    print(f"Imported {result['imported']} products in {result['seconds']:.2f}s ({rate:,.0f} rows/s)")
+    if result["rejected"]:
+        print(f"Rejected {result['rejected']} rows, see {rejects}")
+
+
+######################################################################
+# Command to dump the catalog into partition files
+# Usage: flask products-export export/ --format msgpack --workers 8
+######################################################################
+@commands.cli.command("products-export")
+@click.argument("directory", type=click.Path(file_okay=False))
+@click.option("--format", "fmt", type=click.Choice(exporter.FORMATS), default="csv", show_default=True)
+@click.option("--workers", default=os.cpu_count() or 1, show_default="CPU count", help="Partitions exported at once.")
+@click.option("--partitions", "partition_count", type=int, help="Id ranges to split the table into, 4 per worker by default.")
+@click.option("--batch-size", default=10000, show_default=True, help="Rows fetched per round-trip.")
+@click.option("--pool", type=click.Choice(["thread", "process"]), default="thread", show_default=True,
+              help="Export with threads, or with processes when serializing is the bottleneck.")
+def products_export(directory, fmt, workers, partition_count, batch_size, pool):
+    """
+    Exports the Products to part-NNNNN files in DIRECTORY as CSV, NDJSON
+    or columnar MessagePack. The id space is split into ranges that are
+    exported concurrently, each through its own server-side cursor.
+    """
+    ensure_schema()
+    result = exporter.export_products(directory, fmt, workers, partition_count, batch_size, pool)
+    rate = result["rows"] / result["seconds"] if result["seconds"] else 0
+    print(
+        f"Exported {result['rows']} products to {len(result['files'])} files in {directory} "
+        f"in {result['seconds']:.2f}s ({rate:,.0f} rows/s)"
+    )
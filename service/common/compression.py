@@ -0,0 +1,195 @@
+"""
+Response Compression
+
+This module compresses responses with the best encoding the client
+accepts. gzip is always available; brotli and zstd are offered when the
+``brotli`` and ``zstandard`` packages are installed. Bodies smaller than
+``COMPRESS_MIN_SIZE`` are sent as is because compressing them costs more
+than it saves. Streamed responses are compressed incrementally and
+flushed every ``COMPRESS_STREAM_FLUSH_MS`` so clients read rows as they
+are written.
+"""
+import time
+import zlib
+from flask import current_app, request
+from service.common import profiling
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+COMPRESSIBLE_MIMETYPES = (
+    "application/json", "application/x-ndjson", "application/x-msgpack", "text/html", "text/plain", "text/csv"
+)
+
+
+class _GzipCompressor:
+    """Streaming gzip compressor"""
+
+    def __init__(self, level: int):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data: bytes) -> bytes:
+        """Compresses a chunk of data"""
+        return self._compressor.compress(data)
+
+    def flush_block(self) -> bytes:
+        """Returns everything compressed so far and keeps the stream open"""
+        return self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def flush(self) -> bytes:
+        """Returns the end of the compressed stream"""
+        return self._compressor.flush()
+
+
+class _BrotliCompressor:
+    """Streaming brotli compressor"""
+
+    def __init__(self, quality: int):
+        self._compressor = brotli.Compressor(quality=quality)
+
+    def compress(self, data: bytes) -> bytes:
+        """Compresses a chunk of data"""
+        return self._compressor.process(data)
+
+    def flush_block(self) -> bytes:
+        """Returns everything compressed so far and keeps the stream open"""
+        return self._compressor.flush()
+
+    def flush(self) -> bytes:
+        """Returns the end of the compressed stream"""
+        return self._compressor.finish()
+
+
+class _ZstdCompressor:
+    """Streaming zstd compressor"""
+
+    def __init__(self, level: int):
+        self._compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data: bytes) -> bytes:
+        """Compresses a chunk of data"""
+        return self._compressor.compress(data)
+
+    def flush_block(self) -> bytes:
+        """Returns everything compressed so far and keeps the stream open"""
+        return self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def flush(self) -> bytes:
+        """Returns the end of the compressed stream"""
+        return self._compressor.flush()
+
+
+def compressors(config) -> dict:
+    """Returns factories of streaming compressors keyed by content coding
+
+    Codings that are not installed or not listed in ``COMPRESS_ALGORITHMS``
+    are left out, and the order of that setting is the server preference.
+    """
+    available = {"gzip": lambda: _GzipCompressor(config["COMPRESS_GZIP_LEVEL"])}
+    if brotli is not None:
+        available["br"] = lambda: _BrotliCompressor(config["COMPRESS_BROTLI_QUALITY"])
+    if zstandard is not None:
+        available["zstd"] = lambda: _ZstdCompressor(config["COMPRESS_ZSTD_LEVEL"])
+    return {coding: available[coding] for coding in config["COMPRESS_ALGORITHMS"] if coding in available}
+
+
+def negotiate(accept_encodings, codings) -> str:
+    """Returns the accepted coding with the highest quality, or None
+
+    Ties go to the coding listed first in ``codings``.
+    """
+    best, best_quality = None, 0
+    for coding in codings:
+        quality = accept_encodings[coding]
+        if quality > best_quality:
+            best, best_quality = coding, quality
+    return best
+
+
+def _compress_stream(chunks, compressor, flush_seconds: float):
+    """Compresses an iterable of chunks as they are produced
+
+    The first chunk is flushed right away and later ones at most every
+    ``flush_seconds``, so the client is never left waiting for the end of
+    the stream while the compressor keeps enough data to work with.
+    """
+    flushed = None
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        now = time.monotonic()
+        if flushed is None or now - flushed >= flush_seconds:
+            data += compressor.flush_block()
+            flushed = now
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def _not_modified(response):
+    """Gives a 304 the Vary header and entity tag of the response it stands for
+
+    A client holding a compressed body revalidates the weak form of its
+    entity tag, so the 304 repeats the tag in that form.
+    """
+    if response.mimetype in COMPRESSIBLE_MIMETYPES:
+        response.vary.add("Accept-Encoding")
+        etag, weak = response.get_etag()
+        if etag and not weak and request.if_none_match.is_weak(etag) and not request.if_none_match.is_strong(etag):
+            response.set_etag(etag, weak=True)
+    return response
+
+
+def compress_response(response):
+    """Compresses a response body with the coding negotiated for the request"""
+    if response.status_code == 304:
+        return _not_modified(response)
+    if (
+        response.status_code < 200
+        or response.status_code in (204, 206)
+        or "Content-Encoding" in response.headers
+        or "Content-Range" in response.headers
+        or response.mimetype not in COMPRESSIBLE_MIMETYPES
+    ):
+        return response
+    response.vary.add("Accept-Encoding")
+
+    codings = current_app.extensions["compression"]
+    coding = negotiate(request.accept_encodings, codings)
+    if coding is None:
+        return response
+
+    if response.is_streamed:
+        response.response = _compress_stream(
+            response.response, codings[coding](), current_app.config["COMPRESS_STREAM_FLUSH_MS"] / 1000
+        )
+        response.direct_passthrough = False
+        # the length of the compressed stream is not known up front
+        response.headers.pop("Content-Length", None)
+    else:
+        body = response.get_data()
+        if len(body) < current_app.config["COMPRESS_MIN_SIZE"]:
+            return response
+        with profiling.timer("compress"):
+            compressor = codings[coding]()
+            response.set_data(compressor.compress(body) + compressor.flush())
+
+    response.headers["Content-Encoding"] = coding
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        # the compressed bytes are a different representation of the resource
+        response.set_etag(etag, weak=True)
+    return response
+
+
+def init_compression(app):
+    """Set up response compression for the Flask app"""
+    app.extensions["compression"] = compressors(app.config)
+    if app.config["COMPRESS_ENABLED"]:
+        app.after_request(compress_response)
@@ -0,0 +1,97 @@
+"""
+Encoders
+
+This module contains the fast JSON encoder used for large responses and
+the columnar MessagePack encoder offered to machine consumers
+"""
+from decimal import Decimal
+from enum import Enum
+import orjson
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+
+def _default(obj):
+    """Encodes the types orjson does not support natively"""
+    if isinstance(obj, Decimal):
+        return str(obj)
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+
+def dumps(obj) -> bytes:
+    """Encodes an object as compact UTF-8 JSON with orjson
+
+    Decimals are written as strings to keep their precision. orjson writes
+    an Enum as its value, so serializers convert Enums to their names first
+    as ``Product.serialize`` does.
+    """
+    return orjson.dumps(obj, default=_default)
+
+
+def pack_columns(columns: dict, count: int) -> bytes:
+    """Encodes columns of values as a compact MessagePack map
+
+    The document is ``{"count", "columns", "scales", "dictionaries"}``:
+
+    * Decimal columns are sent as integers scaled by ``10 ** scales[name]``,
+      the smallest power of ten that keeps every value exact
+    * Enum columns are sent as indexes into ``dictionaries[name]``, the
+      names of the members of the Enum
+    * other columns are sent as they are
+
+    :param columns: lists of equal length keyed by field name
+    :type columns: dict
+    :param count: the number of rows in every column
+    :type count: int
+
+    """
+    encoded, scales, dictionaries = {}, {}, {}
+    for name, values in columns.items():
+        sample = values[0] if values else None
+        if isinstance(sample, Decimal):
+            scale = max(0, max(-value.as_tuple().exponent for value in values))
+            factor = 10 ** scale
+            encoded[name] = [int(value * factor) for value in values]
+            scales[name] = scale
+        elif isinstance(sample, Enum):
+            members = list(type(sample))
+            index = {member: position for position, member in enumerate(members)}
+            encoded[name] = [index[value] for value in values]
+            dictionaries[name] = [member.name for member in members]
+        else:
+            encoded[name] = values
+    return msgpack.packb(
+        {"count": count, "columns": encoded, "scales": scales, "dictionaries": dictionaries}, use_bin_type=True
+    )
+
+
+def unpack_columns(data: bytes) -> dict:
+    """Decodes ``pack_columns`` output back into columns of plain values
+
+    Scaled integers come back as Decimals and dictionary indexes as the
+    Enum member names, which is what a client of the format would do.
+    """
+    return _decode_columns(msgpack.unpackb(data, raw=False))
+
+
+def iter_columns(stream):
+    """Decodes a file of concatenated ``pack_columns`` documents one at a time
+
+    Exports write one document per batch of rows, the way Parquet writes
+    row groups, so a reader never holds more than a batch in memory.
+    """
+    for document in msgpack.Unpacker(stream, raw=False):
+        yield _decode_columns(document)
+
+
+def _decode_columns(document: dict) -> dict:
+    """Turns the columns of a decoded document back into plain values"""
+    columns = document["columns"]
+    for name, scale in document["scales"].items():
+        columns[name] = [Decimal(value).scaleb(-scale) for value in columns[name]]
+    for name, names in document["dictionaries"].items():
+        columns[name] = [names[value] for value in columns[name]]
+    return columns
@@ -14,26 +14,37 @@
 """
 Module: error_handlers
 """
-from flask import jsonify
+from flask import Blueprint, current_app, jsonify
+from sqlalchemy.orm.exc import StaleDataError
 from service.models import DataValidationError
-from service import app
 from . import status
+from .metrics import count_errors
+
+# The handlers apply to the whole app once create_app() registers this
+errors = Blueprint("errors", __name__)
 
 
 ######################################################################
 # Error Handlers
 ######################################################################
-@app.errorhandler(DataValidationError)
+@errors.app_errorhandler(DataValidationError)
 def request_validation_error(error):
     """Handles Value Errors from bad data"""
     return bad_request(error)
 
 
-@app.errorhandler(status.HTTP_400_BAD_REQUEST)
+@errors.app_errorhandler(StaleDataError)
+def stale_data_error(error):
+    """Handles concurrent modifications detected by the row version"""
+    return conflict(error)
+
+
+@errors.app_errorhandler(status.HTTP_400_BAD_REQUEST)
+@count_errors
 def bad_request(error):
     """Handles bad requests with 400_BAD_REQUEST"""
     message = str(error)
-    app.logger.warning(message)
+    current_app.logger.warning(message)
     return (
         jsonify(
             status=status.HTTP_400_BAD_REQUEST, error="Bad Request", message=message
@@ -42,22 +53,39 @@ def bad_request(error):
     )
 
 
-@app.errorhandler(status.HTTP_404_NOT_FOUND)
+@errors.app_errorhandler(status.HTTP_401_UNAUTHORIZED)
+@count_errors
+def unauthorized(error):
+    """Handles requests without valid credentials with 401_UNAUTHORIZED"""
+    message = str(error)
+    current_app.logger.warning(message)
+    return (
+        jsonify(
+            status=status.HTTP_401_UNAUTHORIZED, error="Unauthorized", message=message
+        ),
+        status.HTTP_401_UNAUTHORIZED,
+        {"WWW-Authenticate": "Bearer"},
+    )
+
+
+@errors.app_errorhandler(status.HTTP_404_NOT_FOUND)
+@count_errors
 def not_found(error):
     """Handles resources not found with 404_NOT_FOUND"""
     message = str(error)
-    app.logger.warning(message)
+    current_app.logger.warning(message)
     return (
         jsonify(status=status.HTTP_404_NOT_FOUND, error="Not Found", message=message),
         status.HTTP_404_NOT_FOUND,
     )
 
 
-@app.errorhandler(status.HTTP_405_METHOD_NOT_ALLOWED)
+@errors.app_errorhandler(status.HTTP_405_METHOD_NOT_ALLOWED)
+@count_errors
 def method_not_supported(error):
     """Handles unsupported HTTP methods with 405_METHOD_NOT_SUPPORTED"""
     message = str(error)
-    app.logger.warning(message)
+    current_app.logger.warning(message)
     return (
         jsonify(
             status=status.HTTP_405_METHOD_NOT_ALLOWED,
@@ -68,11 +96,40 @@ def method_not_supported(error):
     )
 
 
-@app.errorhandler(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+@errors.app_errorhandler(status.HTTP_409_CONFLICT)
+@count_errors
+def conflict(error):
+    """Handles conflicting modifications with 409_CONFLICT"""
+    message = str(error)
+    current_app.logger.warning(message)
+    return (
+        jsonify(status=status.HTTP_409_CONFLICT, error="Conflict", message=message),
+        status.HTTP_409_CONFLICT,
+    )
+
+
+@errors.app_errorhandler(status.HTTP_412_PRECONDITION_FAILED)
+@count_errors
+def precondition_failed(error):
+    """Handles failed If-Match preconditions with 412_PRECONDITION_FAILED"""
+    message = str(error)
+    current_app.logger.warning(message)
+    return (
+        jsonify(
+            status=status.HTTP_412_PRECONDITION_FAILED,
+            error="Precondition Failed",
+            message=message,
+        ),
+        status.HTTP_412_PRECONDITION_FAILED,
+    )
+
+
+@errors.app_errorhandler(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+@count_errors
 def mediatype_not_supported(error):
     """Handles unsupported media requests with 415_UNSUPPORTED_MEDIA_TYPE"""
     message = str(error)
-    app.logger.warning(message)
+    current_app.logger.warning(message)
     return (
         jsonify(
             status=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
@@ -83,11 +140,28 @@ def mediatype_not_supported(error):
     )
 
 
-@app.errorhandler(status.HTTP_500_INTERNAL_SERVER_ERROR)
+@errors.app_errorhandler(status.HTTP_422_UNPROCESSABLE_ENTITY)
+@count_errors
+def unprocessable_entity(error):
+    """Handles requests that cannot be processed with 422_UNPROCESSABLE_ENTITY"""
+    message = str(error)
+    current_app.logger.warning(message)
+    return (
+        jsonify(
+            status=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            error="Unprocessable Entity",
+            message=message,
+        ),
+        status.HTTP_422_UNPROCESSABLE_ENTITY,
+    )
+
+
+@errors.app_errorhandler(status.HTTP_500_INTERNAL_SERVER_ERROR)
+@count_errors
 def internal_server_error(error):
     """Handles unexpected server error with 500_SERVER_ERROR"""
     message = str(error)
-    app.logger.error(message)
+    current_app.logger.error(message)
     return (
         jsonify(
             status=status.HTTP_500_INTERNAL_SERVER_ERROR,
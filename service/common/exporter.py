@@ -0,0 +1,138 @@
+"""
+Catalog Export
+
+This module dumps the Product table into a directory of partition files.
+The id space is split into ranges of equal width and each range is
+exported by a thread or process of a pool, reading its rows through a
+server-side cursor ``batch_size`` at a time, so memory stays bounded and
+the wall-clock time shrinks with the number of workers. Partitions are
+written as ``part-00000.csv``, ``.ndjson`` or ``.msgpack`` files; the
+msgpack files hold one columnar ``pack_columns`` document per batch, to
+be read back with ``encoders.iter_columns``.
+
+Threads share one interpreter, so they mostly overlap the database
+round trips. Processes also serialize in parallel and are the choice
+when the export is CPU bound.
+"""
+import csv
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from flask import current_app
+from service.common import encoders
+from service.models import Product, db
+
+EXTENSIONS = {"csv": "csv", "ndjson": "ndjson", "msgpack": "msgpack"}
+FORMATS = tuple(EXTENSIONS)
+
+# the app of a process pool worker, see _init_process()
+_process_app = None
+
+
+def partitions(low: int, high: int, count: int) -> list:
+    """Splits the ids from low to high into at most count half-open ranges"""
+    if low is None or high is None:
+        return []
+    width = max(1, -(-(high - low + 1) // count))
+    return [(start, min(start + width, high + 1)) for start in range(low, high + 1, width)]
+
+
+def _write_csv(query, output, batch_size: int) -> int:
+    writer = csv.DictWriter(output, Product.FIELDS)
+    writer.writeheader()
+    count = 0
+    for count, row in enumerate(Product.project(query, batch_size), start=1):
+        writer.writerow(row)
+    return count
+
+
+def _write_ndjson(query, output, batch_size: int) -> int:
+    count = 0
+    for count, row in enumerate(Product.project(query, batch_size), start=1):
+        output.write(encoders.dumps(row) + b"\n")
+    return count
+
+
+def _write_msgpack(query, output, batch_size: int) -> int:
+    count = 0
+    for columns in Product.column_batches(query, batch_size):
+        rows = len(columns["id"])
+        output.write(encoders.pack_columns(columns, rows))
+        count += rows
+    return count
+
+
+WRITERS = {"csv": (_write_csv, "w"), "ndjson": (_write_ndjson, "wb"), "msgpack": (_write_msgpack, "wb")}
+
+
+def export_range(app, fmt: str, directory: str, batch_size: int, number: int, start: int, end: int) -> dict:
+    """Exports the Products with start <= id < end to a partition file
+
+    Runs in its own app context, and so its own session and connection.
+
+    :return: the path of the partition file and the number of rows in it
+    :rtype: dict
+
+    """
+    writer, mode = WRITERS[fmt]
+    path = os.path.join(directory, f"part-{number:05d}.{EXTENSIONS[fmt]}")
+    with app.app_context():
+        query = Product.query.filter(Product.id >= start, Product.id < end).order_by(Product.id)
+        options = {"encoding": "utf-8", "newline": ""} if mode == "w" else {}
+        with open(path, mode, **options) as output:  # pylint: disable=unspecified-encoding
+            rows = writer(query, output, batch_size)
+    return {"path": path, "rows": rows}
+
+
+def _init_process(app):
+    """Gives a forked pool worker the app and fresh database connections"""
+    global _process_app  # pylint: disable=global-statement
+    _process_app = app
+    with app.app_context():
+        # the pooled connections belong to the parent
+        db.engine.dispose(close=False)
+
+
+def _export_range_in_process(*args) -> dict:
+    return export_range(_process_app, *args)
+
+
+def export_products(directory: str, fmt: str, workers: int, partition_count: int = None,
+                    batch_size: int = 10000, pool: str = "thread") -> dict:
+    """Exports the Product table to partition files in a directory
+
+    :param directory: the directory the partition files are written to
+    :param fmt: "csv", "ndjson" or "msgpack"
+    :param workers: the number of threads or processes exporting at once
+    :param partition_count: the number of id ranges, four per worker if None
+    :param batch_size: the number of rows fetched per round-trip
+    :param pool: "thread" or "process"
+
+    :return: the partition files, the total rows and the seconds taken
+    :rtype: dict
+
+    """
+    started = time.perf_counter()
+    os.makedirs(directory, exist_ok=True)
+    low, high = db.session.query(db.func.min(Product.id), db.func.max(Product.id)).one()
+    db.session.remove()
+    ranges = partitions(low, high, partition_count or workers * 4)
+
+    app = current_app._get_current_object()  # pylint: disable=protected-access
+    if pool == "process":
+        executor = ProcessPoolExecutor(
+            workers, mp_context=multiprocessing.get_context("fork"), initializer=_init_process, initargs=(app,)
+        )
+        task, args = _export_range_in_process, (fmt, directory, batch_size)
+    else:
+        executor = ThreadPoolExecutor(workers, thread_name_prefix="export")
+        task, args = export_range, (app, fmt, directory, batch_size)
+    with executor:
+        futures = [executor.submit(task, *args, number, start, end) for number, (start, end) in enumerate(ranges)]
+        files = [future.result() for future in futures]
+    return {
+        "files": files,
+        "rows": sum(part["rows"] for part in files),
+        "seconds": time.perf_counter() - started,
+    }
@@ -0,0 +1,90 @@
+"""
+Catalog Import
+
+This module loads supplier catalogs of CSV or newline delimited JSON
+into the Product table. The file is read one row at a time and loaded
+``batch_size`` rows per transaction with ``Product.load_rows``, so memory
+stays constant whatever the size of the file. Rows that fail the
+validation of ``Product.row_from`` are written to a rejects file as
+NDJSON with their line number and the error instead of stopping the load.
+"""
+import csv
+import json
+import time
+from service.models import DataValidationError, Product
+
+FORMATS = ("csv", "ndjson")
+
+# CSV has no booleans, these are the spellings accepted for [available]
+BOOLEANS = {"true": True, "t": True, "yes": True, "1": True, "false": False, "f": False, "no": False, "0": False}
+
+
+def detect_format(path: str) -> str:
+    """Returns the format of a catalog file from its extension"""
+    if path.lower().endswith(".csv"):
+        return "csv"
+    if path.lower().endswith((".ndjson", ".jsonl")):
+        return "ndjson"
+    raise ValueError(f"Cannot tell the format of {path}, use --format")
+
+
+def read_csv(stream):
+    """Yields (line number, Product dictionary) for each row of a CSV file
+
+    The first line names the columns.
+    """
+    reader = csv.DictReader(stream)
+    for data in reader:
+        available = data.get("available")
+        if isinstance(available, str):
+            data["available"] = BOOLEANS.get(available.strip().lower(), available)
+        yield reader.line_num, data
+
+
+def read_ndjson(stream):
+    """Yields (line number, Product dictionary) for each line of an NDJSON file
+
+    A line that is not valid JSON is yielded as the error to reject.
+    """
+    for number, line in enumerate(stream, start=1):
+        if not line.strip():
+            continue
+        try:
+            yield number, json.loads(line)
+        except ValueError as error:
+            yield number, DataValidationError(f"Invalid JSON: {error}")
+
+
+def import_products(stream, fmt: str, rejects, batch_size: int = 10000) -> dict:
+    """Loads a catalog into the Product table
+
+    :param stream: the text file to read
+    :param fmt: "csv" or "ndjson"
+    :param rejects: a text file the rejected rows are written to
+    :param batch_size: the number of rows loaded per transaction
+
+    :return: the counts of imported and rejected rows and the seconds taken
+    :rtype: dict
+
+    """
+    reader = read_csv if fmt == "csv" else read_ndjson
+    started = time.perf_counter()
+    imported = rejected = 0
+    batch = []
+    for number, data in reader(stream):
+        try:
+            if isinstance(data, DataValidationError):
+                raise data
+            if not isinstance(data, dict):
+                raise DataValidationError("Invalid product: not an object")
+            batch.append(Product.row_from(data))
+        except DataValidationError as error:
+            rejected += 1
+            row = None if isinstance(data, DataValidationError) else data
+            rejects.write(json.dumps({"line": number, "error": str(error), "row": row}, default=str) + "\n")
+            continue
+        if len(batch) >= batch_size:
+            imported += Product.load_rows(batch)
+            batch = []
+    imported += Product.load_rows(batch)
+    return {"imported": imported, "rejected": rejected, "seconds": time.perf_counter() - started}
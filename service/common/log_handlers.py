@@ -19,19 +19,272 @@ Log Handlers
 
 This module contains utility functions to set up logging
 consistently
+
+With LOG_ASYNC the loggers only put records on a bounded queue. A
+listener thread formats them and writes them to the log stream in
+batches, so request threads never wait on formatting or I/O. A full
+queue drops records instead of blocking. Per-level sampling and rate
+limits run before a record is queued.
 """
+import atexit
+import copy
 import logging
+import os
+import queue
+import sys
+import time
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+import orjson
+
+TEXT_FORMAT = "[%(asctime)s] [%(levelname)s] [%(module)s] %(message)s"
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S %z"
+
+# attributes every LogRecord has, anything else was passed with extra=
+_RECORD_ATTRIBUTES = frozenset(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+# the queue handler and listener of this process, see start_pipeline()
+_pipeline = {}
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats a record as one JSON object per line
+
+    Fields passed with ``extra=`` are added to the object.
+    """
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "module": record.module,
+            "pid": record.process,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc_info"] = record.exc_text
+        return orjson.dumps(entry, default=str).decode("utf-8")
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps a fraction of the records of each level
+
+    ``rates`` maps level names to the fraction kept, levels that are not
+    listed are kept in full. Every n-th record is kept rather than a
+    random one so that the output is steady.
+    """
+
+    def __init__(self, rates: dict):
+        super().__init__()
+        self.rates = {logging.getLevelName(level.upper()): float(rate) for level, rate in rates.items()}
+        self._seen = {}
+
+    def filter(self, record):
+        rate = self.rates.get(record.levelno)
+        if rate is None or rate >= 1:
+            return True
+        seen = self._seen.get(record.levelno, 0) + 1
+        self._seen[record.levelno] = seen
+        return int(seen * rate) > int((seen - 1) * rate)
+
+
+class RateLimitFilter(logging.Filter):
+    """Caps the records per second of each level with a token bucket
+
+    The next record let through after some were dropped carries their
+    number in a ``suppressed`` field.
+    """
+
+    def __init__(self, limits: dict):
+        super().__init__()
+        self.limits = {logging.getLevelName(level.upper()): float(limit) for level, limit in limits.items()}
+        self._buckets = {}
+
+    def filter(self, record):
+        limit = self.limits.get(record.levelno)
+        if limit is None:
+            return True
+        now = time.monotonic()
+        tokens, updated, suppressed = self._buckets.get(record.levelno, (limit, now, 0))
+        tokens = min(limit, tokens + (now - updated) * limit)
+        if tokens < 1:
+            self._buckets[record.levelno] = (tokens, now, suppressed + 1)
+            return False
+        self._buckets[record.levelno] = (tokens - 1, now, 0)
+        if suppressed:
+            record.suppressed = suppressed
+        return True
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """Puts records on a bounded queue and drops them when it is full"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+        self._exception_formatter = logging.Formatter()
+
+    def prepare(self, record):
+        """Resolves the message and the traceback so the record can be queued
+
+        Unlike QueueHandler.prepare the traceback stays out of the message
+        so that formatters can output it on its own.
+        """
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = self._exception_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class BatchingStreamHandler(logging.StreamHandler):
+    """Writes formatted records to a stream in batches
+
+    A batch is written when it holds ``capacity`` records, on an error,
+    or when flush() is called, which the listener does whenever the queue
+    runs empty.
+    """
+
+    def __init__(self, stream=None, capacity: int = 100):
+        super().__init__(stream)
+        self.capacity = capacity
+        self.buffer = []
+
+    def emit(self, record):
+        try:
+            self.buffer.append(self.format(record) + self.terminator)
+            if len(self.buffer) >= self.capacity or record.levelno >= logging.ERROR:
+                self.flush()
+        except Exception:  # pylint: disable=broad-except
+            self.handleError(record)
+
+    def flush(self):
+        self.acquire()
+        try:
+            if self.buffer:
+                self.stream.write("".join(self.buffer))
+                self.buffer.clear()
+            super().flush()
+        finally:
+            self.release()
+
+
+class BatchingQueueListener(QueueListener):
+    """Hands queued records to its handlers and flushes them when idle"""
+
+    def dequeue(self, block):
+        try:
+            return self.queue.get_nowait()
+        except queue.Empty:
+            if not block:
+                raise
+        for handler in self.handlers:
+            handler.flush()
+        return self.queue.get()
+
+    def stop(self):
+        super().stop()
+        for handler in self.handlers:
+            handler.flush()
+
+
+def start_pipeline(handler: logging.Handler, queue_size: int) -> NonBlockingQueueHandler:
+    """Starts a listener thread feeding ``handler`` and returns its queue handler
+
+    The pipeline of an earlier call is stopped first.
+    """
+    stop_pipeline()
+    log_queue = queue.Queue(queue_size)
+    listener = BatchingQueueListener(log_queue, handler, respect_handler_level=True)
+    listener.start()
+    _pipeline.update(handler=NonBlockingQueueHandler(log_queue), listener=listener)
+    return _pipeline["handler"]
+
+
+def stop_pipeline():
+    """Writes out the queued records and stops the listener thread"""
+    listener = _pipeline.pop("listener", None)
+    _pipeline.pop("handler", None)
+    if listener is not None:
+        try:
+            listener.stop()
+        except (OSError, ValueError):
+            # the stream was closed already, as logging.shutdown() allows
+            pass
+
+
+def _restart_after_fork():
+    """Gives a forked worker its own queue and listener thread
+
+    Threads do not survive fork(), so a worker of an app preloaded by the
+    gunicorn master would otherwise queue records nobody reads.
+    """
+    listener = _pipeline.get("listener")
+    if listener is None:
+        return
+    log_queue = queue.Queue(listener.queue.maxsize)
+    listener.queue = _pipeline["handler"].queue = log_queue
+    listener._thread = None  # pylint: disable=protected-access
+    listener.start()
+
+
+os.register_at_fork(after_in_child=_restart_after_fork)
+atexit.register(stop_pipeline)
+
+
+def _stream_of(handlers: list):
+    """Returns the stream of the first stream handler or stderr"""
+    for handler in handlers:
+        if isinstance(handler, logging.StreamHandler):
+            return handler.stream
+    return sys.stderr
 
 
 def init_logging(app, logger_name: str):
-    """Set up logging for production"""
-    app.logger.propagate = False
+    """Set up logging for production
+
+    The app logger and the "flask.app" logger of the models share the
+    handlers of the ``logger_name`` logger, or the asynchronous pipeline
+    writing to its stream when LOG_ASYNC is on.
+    """
+    config = app.config
     gunicorn_logger = logging.getLogger(logger_name)
-    app.logger.handlers = gunicorn_logger.handlers
-    app.logger.setLevel(gunicorn_logger.level)
-    # Make all log formats consistent
-    format_string = "[%(asctime)s] [%(levelname)s] [%(module)s] %(message)s"
-    formatter = logging.Formatter(format_string, "%Y-%m-%d %H:%M:%S %z")
-    for handler in app.logger.handlers:
-        handler.setFormatter(formatter)
+    if config["LOG_FORMAT"] == "json":
+        formatter = JsonFormatter()
+    else:
+        # Make all log formats consistent
+        formatter = logging.Formatter(TEXT_FORMAT, DATE_FORMAT)
+
+    if config["LOG_ASYNC"]:
+        target = BatchingStreamHandler(_stream_of(gunicorn_logger.handlers), config["LOG_BATCH_SIZE"])
+        target.setFormatter(formatter)
+        handler = start_pipeline(target, config["LOG_QUEUE_SIZE"])
+        if config["LOG_SAMPLE_RATES"]:
+            handler.addFilter(SamplingFilter(config["LOG_SAMPLE_RATES"]))
+        if config["LOG_RATE_LIMITS"]:
+            handler.addFilter(RateLimitFilter(config["LOG_RATE_LIMITS"]))
+        handlers = [handler]
+    else:
+        handlers = gunicorn_logger.handlers
+        for handler in handlers:
+            handler.setFormatter(formatter)
+
+    for logger in (app.logger, logging.getLogger("flask.app")):
+        logger.propagate = False
+        logger.handlers = handlers
+        logger.setLevel(gunicorn_logger.level)
     app.logger.info("Logging handler established")
@@ -0,0 +1,138 @@
+"""
+Metrics
+
+This module collects Prometheus metrics about requests, database queries
+and errors, and renders them for the /metrics endpoint.
+
+Under gunicorn set ``PROMETHEUS_MULTIPROC_DIR`` to a directory shared by
+all workers so that every worker writes its samples there and /metrics
+reports the aggregate of the whole server rather than a single worker.
+"""
+import functools
+import os
+import time
+from contextvars import ContextVar
+from flask import request
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+SIZE_BUCKETS = (100, 1_000, 10_000, 100_000, 1_000_000, 10_000_000, float("inf"))
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, float("inf"))
+BOOT_BUCKETS = (0.1, 0.25, 0.5, 1, 2, 5, 10, 30, float("inf"))
+
+REQUESTS = Counter(
+    "product_http_requests_total", "HTTP requests handled", ["endpoint", "method", "status"]
+)
+LATENCY = Histogram(
+    "product_http_request_duration_seconds", "Time spent handling a request", ["endpoint", "method"]
+)
+REQUEST_SIZE = Histogram(
+    "product_http_request_size_bytes", "Size of request bodies", ["endpoint"], buckets=SIZE_BUCKETS
+)
+RESPONSE_SIZE = Histogram(
+    "product_http_response_size_bytes", "Size of response bodies", ["endpoint"], buckets=SIZE_BUCKETS
+)
+DB_QUERIES = Histogram(
+    "product_db_queries_per_request", "SQL statements run per request", ["endpoint"], buckets=COUNT_BUCKETS
+)
+DB_DURATION = Histogram(
+    "product_db_duration_seconds_per_request", "Time spent in the database per request", ["endpoint"]
+)
+DB_QUERY_DURATION = Histogram("product_db_query_duration_seconds", "Time spent running each SQL statement")
+ERRORS = Counter("product_http_errors_total", "Error responses by error handler", ["handler"])
+STARTUP = Gauge(
+    "product_startup_seconds", "Time spent in each startup phase of this process", ["phase"], multiprocess_mode="max"
+)
+WORKER_BOOT = Histogram(
+    "product_worker_boot_seconds", "Time from forking a gunicorn worker until it accepts requests", buckets=BOOT_BUCKETS
+)
+
+# database activity of the request being handled in the current context
+_request_stats = ContextVar("request_stats", default=None)
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(_conn, _cursor, _statement, _parameters, context, _executemany):
+    # kept on the execution context, which is dropped with a failed statement
+    if context is not None:
+        context.query_start = time.perf_counter()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(_conn, _cursor, _statement, _parameters, context, _executemany):
+    start = getattr(context, "query_start", None)
+    if start is None:
+        return
+    elapsed = time.perf_counter() - start
+    DB_QUERY_DURATION.observe(elapsed)
+    stats = _request_stats.get()
+    if stats is not None:
+        stats["queries"] += 1
+        stats["db_time"] += elapsed
+
+
+def _endpoint() -> str:
+    """Returns the name of the view handling the request without its blueprint"""
+    return request.endpoint.rsplit(".", 1)[-1] if request.endpoint else "unmatched"
+
+
+def _start_request():
+    """Starts timing the current request"""
+    _request_stats.set({"start": time.perf_counter(), "queries": 0, "db_time": 0.0})
+
+
+def _finish_request(response):
+    """Records the metrics of the current request"""
+    stats = _request_stats.get()
+    if stats is None:
+        return response
+    _request_stats.set(None)
+    endpoint = _endpoint()
+    LATENCY.labels(endpoint, request.method).observe(time.perf_counter() - stats["start"])
+    REQUESTS.labels(endpoint, request.method, response.status_code).inc()
+    REQUEST_SIZE.labels(endpoint).observe(request.content_length or 0)
+    if response.content_length is not None:
+        RESPONSE_SIZE.labels(endpoint).observe(response.content_length)
+    DB_QUERIES.labels(endpoint).observe(stats["queries"])
+    DB_DURATION.labels(endpoint).observe(stats["db_time"])
+    return response
+
+
+def count_errors(handler):
+    """Decorates an error handler so that every call is counted"""
+    @functools.wraps(handler)
+    def wrapper(error):
+        ERRORS.labels(handler.__name__).inc()
+        return handler(error)
+    return wrapper
+
+
+def record_startup(phase: str, seconds: float):
+    """Records the duration of a startup phase such as import or schema_check"""
+    STARTUP.labels(phase).set(seconds)
+
+
+def render() -> tuple:
+    """Returns the metrics exposition and its content type"""
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def init_metrics(app):
+    """Set up request metrics for the Flask app"""
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
@@ -0,0 +1,131 @@
+"""
+Connection Pool
+
+This module builds the SQLAlchemy engine options from the DB_POOL_*
+settings and keeps telemetry about the connection pool of this worker
+"""
+import os
+import threading
+import time
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import NullPool, Pool, QueuePool
+
+
+class PoolStats:
+    """Thread-safe counters describing connection pool activity"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Sets every counter back to zero"""
+        with self._lock:
+            self.connects = 0
+            self.checkouts = 0
+            self.checkins = 0
+            self.invalidations = 0
+            self.waits = 0
+            self.wait_total = 0.0
+            self.wait_max = 0.0
+
+    def increment(self, counter: str):
+        """Adds one to the named counter"""
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def record_wait(self, seconds: float):
+        """Records how long a caller waited for a connection"""
+        with self._lock:
+            self.waits += 1
+            self.wait_total += seconds
+            self.wait_max = max(self.wait_max, seconds)
+
+    def as_dict(self) -> dict:
+        """Returns the counters with wait times in milliseconds"""
+        with self._lock:
+            return {
+                "connects": self.connects,
+                "checkouts": self.checkouts,
+                "checkins": self.checkins,
+                "invalidations": self.invalidations,
+                "wait_count": self.waits,
+                "wait_ms_total": round(self.wait_total * 1000, 3),
+                "wait_ms_avg": round(self.wait_total * 1000 / self.waits, 3) if self.waits else 0.0,
+                "wait_ms_max": round(self.wait_max * 1000, 3),
+            }
+
+
+pool_stats = PoolStats()
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that records how long each checkout waited for a connection"""
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            pool_stats.record_wait(time.perf_counter() - start)
+
+
+@event.listens_for(Pool, "connect")
+def _on_connect(dbapi_connection, connection_record):  # pylint: disable=unused-argument
+    pool_stats.increment("connects")
+
+
+@event.listens_for(Pool, "checkout")
+def _on_checkout(dbapi_connection, connection_record, connection_proxy):  # pylint: disable=unused-argument
+    pool_stats.increment("checkouts")
+
+
+@event.listens_for(Pool, "checkin")
+def _on_checkin(dbapi_connection, connection_record):  # pylint: disable=unused-argument
+    pool_stats.increment("checkins")
+
+
+@event.listens_for(Pool, "invalidate")
+def _on_invalidate(dbapi_connection, connection_record, exception):  # pylint: disable=unused-argument
+    pool_stats.increment("invalidations")
+
+
+def engine_options(config) -> dict:
+    """Builds the SQLAlchemy engine options from the DB_POOL_* settings
+
+    ``DB_POOL_MODE=null`` opens a connection per checkout, which suits
+    an external pooler such as PgBouncer. Options already present in
+    ``SQLALCHEMY_ENGINE_OPTIONS`` take precedence.
+    """
+    url = make_url(config["SQLALCHEMY_DATABASE_URI"])
+    options = {"pool_pre_ping": config["DB_POOL_PRE_PING"]}
+    if config["DB_POOL_MODE"] == "null":
+        options["poolclass"] = NullPool
+    elif not (url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:")):
+        # in-memory SQLite keeps the single static connection Flask-SQLAlchemy gives it
+        options.update(
+            poolclass=TimedQueuePool,
+            pool_size=config["DB_POOL_SIZE"],
+            max_overflow=config["DB_MAX_OVERFLOW"],
+            pool_recycle=config["DB_POOL_RECYCLE"],
+            pool_timeout=config["DB_POOL_TIMEOUT"],
+        )
+    options.update(config.get("SQLALCHEMY_ENGINE_OPTIONS") or {})
+    return options
+
+
+def pool_status(engine) -> dict:
+    """Returns the state of the engine's pool in this worker process"""
+    pool = engine.pool
+    status = {"pid": os.getpid(), "pool": type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        status.update(
+            size=pool.size(),
+            checked_out=pool.checkedout(),
+            idle=pool.checkedin(),
+            overflow=pool.overflow(),
+            timeout=pool.timeout(),
+        )
+    status.update(pool_stats.as_dict())
+    return status
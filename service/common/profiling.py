@@ -0,0 +1,162 @@
+"""
+SQL Profiling
+
+This module profiles the SQL statements of each request when
+``SQL_PROFILING`` is on. Every statement is recorded with its duration,
+row count and the line of the service that issued it. Statements slower
+than ``SQL_SLOW_QUERY_MS`` are logged with their query plan, and with
+``SERVER_TIMING`` the response gets a Server-Timing header such as:
+
+    Server-Timing: db;dur=4.210;desc="3 queries", serialize;dur=1.905, total;dur=7.630
+
+Routes mark the phases they want reported with ``timer("serialize")``.
+When profiling is off the engine hooks return at once and the timers do
+nothing.
+"""
+import contextlib
+import logging
+import os
+import sys
+import time
+from contextvars import ContextVar
+from flask import current_app
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger("flask.app")
+
+SERVICE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+COMMON_DIR = os.path.join(SERVICE_DIR, "common")
+EXPLAIN_PREFIXES = {"postgresql": "EXPLAIN ", "sqlite": "EXPLAIN QUERY PLAN "}
+
+# profile of the request being handled in the current context
+_profile = ContextVar("sql_profile", default=None)
+
+
+class RequestProfile:
+    """The SQL statements and timed phases of one request"""
+
+    def __init__(self, slow_query_ms: float, explain: bool):
+        self.slow_query_ms = slow_query_ms
+        self.explain = explain
+        self.start = time.perf_counter()
+        self.statements = []
+        self.db_time = 0.0
+        self.timings = {}
+
+    def add_statement(self, statement: str, seconds: float, rows: int, caller: str) -> dict:
+        """Records an executed statement and returns its entry"""
+        entry = {"statement": statement, "duration_ms": round(seconds * 1000, 3), "rows": rows, "caller": caller}
+        self.statements.append(entry)
+        self.db_time += seconds
+        return entry
+
+    def server_timing(self) -> str:
+        """Returns the Server-Timing header value of the profile so far"""
+        metrics = [f'db;dur={self.db_time * 1000:.3f};desc="{len(self.statements)} queries"']
+        metrics.extend(f"{name};dur={seconds * 1000:.3f}" for name, seconds in self.timings.items())
+        metrics.append(f"total;dur={(time.perf_counter() - self.start) * 1000:.3f}")
+        return ", ".join(metrics)
+
+
+def current_profile():
+    """Returns the profile of the current request, or None when not profiling"""
+    return _profile.get()
+
+
+@contextlib.contextmanager
+def timer(name: str):
+    """Adds the time spent in the block, less its SQL time, to a named phase"""
+    profile = _profile.get()
+    if profile is None:
+        yield
+        return
+    start, db_start = time.perf_counter(), profile.db_time
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start - (profile.db_time - db_start)
+        profile.timings[name] = profile.timings.get(name, 0.0) + elapsed
+
+
+def _call_site() -> str:
+    """Returns the innermost service line outside of service.common on the stack"""
+    frame = sys._getframe(2)  # pylint: disable=protected-access
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if filename.startswith(SERVICE_DIR) and not filename.startswith(COMMON_DIR):
+            return f"{os.path.relpath(filename, os.path.dirname(SERVICE_DIR))}:{frame.f_lineno} in {frame.f_code.co_name}"
+        frame = frame.f_back
+    return "unknown"
+
+
+def explain(engine, statement: str, parameters) -> str:
+    """Returns the query plan of a SELECT, or None for other statements
+
+    The plan is read on a separate connection so that a failing EXPLAIN
+    cannot abort the transaction of the request.
+    """
+    prefix = EXPLAIN_PREFIXES.get(engine.dialect.name)
+    if prefix is None or not statement.lstrip().upper().startswith("SELECT"):
+        return None
+    try:
+        with engine.connect() as connection:
+            rows = connection.exec_driver_sql(
+                prefix + statement, parameters, execution_options={"profiling_explain": True}
+            ).fetchall()
+    except Exception as error:  # pylint: disable=broad-except
+        return f"EXPLAIN failed: {error}"
+    return "\n".join(str(row[-1]) for row in rows)
+
+
+def _before_cursor_execute(conn, _cursor, _statement, _parameters, context, _executemany):
+    if _profile.get() is None or context is None or context.execution_options.get("profiling_explain"):
+        return
+    # kept on the execution context, which is dropped with a failed statement
+    context.profile_start = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    profile = _profile.get()
+    start = getattr(context, "profile_start", None)
+    if profile is None or start is None:
+        return
+    elapsed = time.perf_counter() - start
+    # drivers such as sqlite3 only count the rows of a SELECT once they are fetched
+    rows = cursor.rowcount if cursor.rowcount >= 0 else None
+    entry = profile.add_statement(statement, elapsed, rows, _call_site())
+    if entry["duration_ms"] >= profile.slow_query_ms:
+        plan = explain(conn.engine, statement, parameters) if profile.explain and not executemany else None
+        logger.warning(
+            "Slow query %.3f ms rows=%s at %s: %s%s",
+            entry["duration_ms"], entry["rows"], entry["caller"], statement, f"\n{plan}" if plan else "",
+        )
+
+
+def _start_request():
+    """Starts profiling the current request"""
+    config = current_app.config
+    _profile.set(RequestProfile(config["SQL_SLOW_QUERY_MS"], config["SQL_EXPLAIN_SLOW"]))
+
+
+def _finish_request(response):
+    """Stops profiling and reports the profile on the response"""
+    profile = _profile.get()
+    if profile is None:
+        return response
+    _profile.set(None)
+    if current_app.config["SERVER_TIMING"]:
+        response.headers["Server-Timing"] = profile.server_timing()
+    logger.debug("%s SQL statements in %.3f ms", len(profile.statements), profile.db_time * 1000)
+    return response
+
+
+def init_profiling(app):
+    """Set up SQL profiling for the Flask app when SQL_PROFILING is on"""
+    if not app.config["SQL_PROFILING"]:
+        return
+    if not event.contains(Engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
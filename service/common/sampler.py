@@ -0,0 +1,90 @@
+"""
+Sampling CPU Profiler
+
+This module samples the Python stacks of every thread of the serving
+process at a fixed interval and counts them as collapsed stacks, the
+input format of flamegraph.pl, speedscope and inferno:
+
+    MainThread;run (gunicorn/arbiter.py:196);sleep (gunicorn/arbiter.py:350) 42
+
+Nothing is installed in the interpreter: the profile is taken by the
+thread that asks for it, so there is no overhead when no profile is
+being captured. Only one profile runs at a time in a process.
+"""
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+
+class ProfilerBusyError(Exception):
+    """Raised when a profile is already being captured in this process"""
+
+
+_running = threading.Lock()
+
+
+def _path_prefixes() -> list:
+    """Returns the import roots stripped from file names, longest first"""
+    roots = {os.path.abspath(path) for path in sys.path if path}
+    return sorted((root.rstrip(os.sep) + os.sep for root in roots), key=len, reverse=True)
+
+
+class SamplingProfiler:
+    """Counts the stacks of the other threads of the process"""
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.samples = 0
+        self.stacks = Counter()
+        self._labels = {}
+        self._prefixes = _path_prefixes()
+
+    def _label(self, code) -> str:
+        """Returns the flamegraph label of a code object"""
+        label = self._labels.get(code)
+        if label is None:
+            filename = code.co_filename
+            for prefix in self._prefixes:
+                if filename.startswith(prefix):
+                    filename = filename[len(prefix):]
+                    break
+            label = f"{code.co_name} ({filename}:{code.co_firstlineno})"
+            self._labels[code] = label
+        return label
+
+    def sample(self, names: dict, exclude: int):
+        """Records the current stack of every thread but ``exclude``"""
+        for ident, frame in sys._current_frames().items():  # pylint: disable=protected-access
+            if ident == exclude:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(self._label(frame.f_code))
+                frame = frame.f_back
+            stack.append(names.get(ident, f"Thread-{ident}"))
+            self.stacks[";".join(reversed(stack))] += 1
+        self.samples += 1
+
+    def run(self, seconds: float) -> Counter:
+        """Samples the process for ``seconds`` and returns the stack counts
+
+        :raises ProfilerBusyError: if another profile is being captured
+        """
+        if not _running.acquire(blocking=False):  # pylint: disable=consider-using-with
+            raise ProfilerBusyError("A profile is already being captured")
+        try:
+            me = threading.get_ident()
+            deadline = time.monotonic() + seconds
+            while time.monotonic() < deadline:
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+                self.sample(names, me)
+                time.sleep(self.interval)
+        finally:
+            _running.release()
+        return self.stacks
+
+    def collapsed(self) -> str:
+        """Returns the profile as collapsed stacks, hottest first"""
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
@@ -13,7 +13,85 @@ DATABASE_URI = os.getenv(
 # Configure SQLAlchemy
 SQLALCHEMY_DATABASE_URI = DATABASE_URI
 SQLALCHEMY_TRACK_MODIFICATIONS = False
-# SQLALCHEMY_POOL_SIZE = 2
+
+# Create missing tables before the first request, false when a release step runs flask db-upgrade
+DB_SCHEMA_CHECK = os.getenv("DB_SCHEMA_CHECK", "true").lower() == "true"
+
+# Connection pool per worker, DB_POOL_MODE=null hands pooling to PgBouncer
+DB_POOL_MODE = os.getenv("DB_POOL_MODE", "queue")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"
+
+# Pagination limits for list endpoints
+PAGE_SIZE_MAX = int(os.getenv("PAGE_SIZE_MAX", "1000"))
+
+# Number of rows fetched per round-trip when streaming results
+STREAM_BATCH_SIZE = int(os.getenv("STREAM_BATCH_SIZE", "1000"))
+
+# Serializer used by list routes: "projection" reads the columns as tuples,
+# "orm" loads each Product and calls serialize()
+LIST_SERIALIZER = os.getenv("LIST_SERIALIZER", "projection")
+STREAM_SERIALIZER = os.getenv("STREAM_SERIALIZER", "projection")
+
+# Number of rows sent per INSERT by bulk operations
+BULK_CHUNK_SIZE = int(os.getenv("BULK_CHUNK_SIZE", "1000"))
+
+# In-process cache of serialized Products read by id (size 0 disables it)
+PRODUCT_CACHE_SIZE = int(os.getenv("PRODUCT_CACHE_SIZE", "1024"))
+PRODUCT_CACHE_TTL = float(os.getenv("PRODUCT_CACHE_TTL", "30"))
+
+# Seconds catalog statistics are cached for (0 disables the cache)
+STATS_CACHE_TTL = float(os.getenv("STATS_CACHE_TTL", "10"))
+
+# Seconds the response of a POST with an Idempotency-Key is kept for replays
+IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL", "86400"))
+
+# Response compression negotiated with Accept-Encoding, in server preference
+# order; br and zstd need the brotli and zstandard packages
+COMPRESS_ENABLED = os.getenv("COMPRESS_ENABLED", "true").lower() == "true"
+COMPRESS_ALGORITHMS = [coding.strip() for coding in os.getenv("COMPRESS_ALGORITHMS", "zstd,br,gzip").split(",")]
+COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", "1024"))
+COMPRESS_GZIP_LEVEL = int(os.getenv("COMPRESS_GZIP_LEVEL", "5"))
+COMPRESS_BROTLI_QUALITY = int(os.getenv("COMPRESS_BROTLI_QUALITY", "4"))
+COMPRESS_ZSTD_LEVEL = int(os.getenv("COMPRESS_ZSTD_LEVEL", "3"))
+
+# Longest a compressed stream holds data back before flushing it to the client
+COMPRESS_STREAM_FLUSH_MS = float(os.getenv("COMPRESS_STREAM_FLUSH_MS", "100"))
+
+# Per-request SQL profiling: statements slower than SQL_SLOW_QUERY_MS are
+# logged with their query plan, SERVER_TIMING reports db and serialize time
+SQL_PROFILING = os.getenv("SQL_PROFILING", "false").lower() == "true"
+SQL_SLOW_QUERY_MS = float(os.getenv("SQL_SLOW_QUERY_MS", "100"))
+SQL_EXPLAIN_SLOW = os.getenv("SQL_EXPLAIN_SLOW", "true").lower() == "true"
+SERVER_TIMING = os.getenv("SERVER_TIMING", "false").lower() == "true"
+
+# Bearer token of the /admin/profile sampling profiler, disabled when unset.
+# The profiler samples the other threads of a worker: sync workers refuse
+# it, and gevent greenlets share one thread, so profile gthread workers
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "60"))
+PROFILE_SAMPLE_RATE = int(os.getenv("PROFILE_SAMPLE_RATE", "200"))
+
+# Logging: "json" or "text" lines; LOG_ASYNC queues records for a listener
+# thread that writes them in batches of LOG_BATCH_SIZE and drops them when
+# LOG_QUEUE_SIZE records are waiting. LOG_SAMPLE_RATES ("DEBUG=0.1,INFO=0.5")
+# keeps a fraction of a level, LOG_RATE_LIMITS ("INFO=1000") caps its
+# records per second
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+LOG_ASYNC = os.getenv("LOG_ASYNC", "true").lower() == "true"
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_BATCH_SIZE = int(os.getenv("LOG_BATCH_SIZE", "100"))
+LOG_SAMPLE_RATES = {
+    level.strip(): float(rate)
+    for level, _, rate in (item.partition("=") for item in os.getenv("LOG_SAMPLE_RATES", "").split(",") if item.strip())
+}
+LOG_RATE_LIMITS = {
+    level.strip(): float(limit)
+    for level, _, limit in (item.partition("=") for item in os.getenv("LOG_RATE_LIMITS", "").split(",") if item.strip())
+}
 
 # Secret for session management
 SECRET_KEY = os.getenv("SECRET_KEY", "sup3r-s3cr3t")
@@ -28,23 +28,171 @@ description (string) - the description the product belongs to (i.e., dog, cat)
 available (boolean) - True for products that are available for adoption
 
 """
+import csv
+import io
+import itertools
 import logging
+import re
+import threading
+import time
+from datetime import datetime, timedelta
 from enum import Enum
-from decimal import Decimal
-from flask import Flask
+from decimal import Decimal, InvalidOperation
+from flask import Flask, current_app
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.orm.exc import StaleDataError
+from service.common.cache import LRUCache
+from service.common.pool import engine_options
+from service.common.metrics import record_startup
 
 logger = logging.getLogger("flask.app")
 
 # Create the SQLAlchemy object to be initialized later in init_db()
 db = SQLAlchemy()
 
+# Text search configuration for the PostgreSQL search index and queries
+SEARCH_CONFIG = "'english'::regconfig"
+
+# Serialized Products keyed by id, sized later in init_db()
+product_cache = LRUCache()
+
+# Catalog statistics, kept for a short TTL configured in init_db()
+stats_cache = LRUCache(maxsize=1)
+
+
+# Serializes the first schema check of threaded workers
+_schema_lock = threading.Lock()
+
+
+def init_app(app: Flask):
+    """Configures SQLAlchemy and the caches for the app without touching the database"""
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(app.config)
+    db.init_app(app)
+    product_cache.configure(app.config["PRODUCT_CACHE_SIZE"], app.config["PRODUCT_CACHE_TTL"])
+    stats_cache.configure(1 if app.config["STATS_CACHE_TTL"] > 0 else 0, app.config["STATS_CACHE_TTL"])
+    IdempotencyKey.ttl = app.config["IDEMPOTENCY_TTL"]
+
 
 def init_db(app):
     """Initialize the SQLAlchemy app"""
     Product.init_db(app)
 
 
+def ensure_schema():
+    """Creates missing tables the first time it runs for the current app
+
+    Called before the first request of each process, or once in the
+    gunicorn master when the app is preloaded so that forked workers
+    inherit the result. ``DB_SCHEMA_CHECK=false`` skips it entirely for
+    deployments that run ``flask db-upgrade`` as a release step.
+    """
+    app = current_app._get_current_object()  # pylint: disable=protected-access
+    if not app.config["DB_SCHEMA_CHECK"] or app.extensions.get("schema_checked"):
+        return
+    with _schema_lock:
+        if not app.extensions.get("schema_checked"):
+            _create_schema(app)
+
+
+def _create_schema(app: Flask):
+    """Creates the missing tables and records how long it took"""
+    started = time.perf_counter()
+    db.create_all()  # make our sqlalchemy tables
+    app.extensions["schema_checked"] = True
+    elapsed = time.perf_counter() - started
+    record_startup("schema_check", elapsed)
+    logger.info("Database schema checked in %.3fs", elapsed)
+
+
+def upgrade_db() -> list:
+    """Brings an existing database up to the current schema
+
+    ``db.create_all()`` only creates missing tables, so columns and indexes
+    added to a table that already exists are created here. New columns must
+    be nullable or carry a ``server_default`` to fill in existing rows.
+
+    :return: the names of the schema objects that were created
+    :rtype: list
+
+    """
+    logger.info("Upgrading database schema")
+    db.create_all()
+    created = []
+    for table in db.metadata.sorted_tables:
+        created.extend(_add_missing_columns(table))
+        created.extend(_add_missing_indexes(table))
+    return created
+
+
+def invalidate_caches(product_id: int = None):
+    """Drops cached data made stale by a write
+
+    :param product_id: the id of the Product written, or None when the
+        write may have touched any Product
+    :type product_id: int
+
+    """
+    if product_id is None:
+        product_cache.clear()
+    else:
+        product_cache.invalidate(product_id)
+    stats_cache.clear()
+
+
+def _add_missing_columns(table) -> list:
+    """Adds the columns of a table that the database does not have yet"""
+    created = []
+    existing = {column["name"] for column in db.inspect(db.engine).get_columns(table.name)}
+    compiler = db.engine.dialect.ddl_compiler(db.engine.dialect, None)
+    for column in table.columns:
+        if column.name not in existing:
+            logger.info("Adding column %s.%s", table.name, column.name)
+            spec = compiler.get_column_specification(column)
+            with db.engine.begin() as connection:
+                connection.execute(db.text(f"ALTER TABLE {table.name} ADD COLUMN {spec}"))
+            created.append(f"{table.name}.{column.name}")
+    return created
+
+
+def _add_missing_indexes(table) -> list:
+    """Creates the indexes of a table that the database does not have yet"""
+    created = []
+    existing = _index_names(table.name)
+    for index in sorted(table.indexes, key=lambda index: index.name):
+        if index.name not in existing and _creates_on(index, db.engine.dialect.name):
+            logger.info("Creating index %s", index.name)
+            index.create(db.engine)
+            created.append(index.name)
+    return created
+
+
+def _creates_on(index, dialect_name: str) -> bool:
+    """Returns False for indexes restricted to another dialect with ddl_if()"""
+    condition = index._ddl_if  # pylint: disable=protected-access
+    if condition is None or condition.dialect is None:
+        return True
+    dialects = [condition.dialect] if isinstance(condition.dialect, str) else condition.dialect
+    return dialect_name in dialects
+
+
+def _index_names(table_name: str) -> set:
+    """Returns the names of the indexes that exist on a table"""
+    if db.engine.dialect.name == "sqlite":
+        # SQLite reflection skips expression indexes so ask the catalog directly
+        statement = db.text("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = :table")
+        return set(db.session.scalars(statement, {"table": table_name}))
+    return {index["name"] for index in db.inspect(db.engine).get_indexes(table_name)}
+
+
+def _search_document(name, description):
+    """Returns the PostgreSQL text search document of a Product
+
+    The search index and the search queries must use this same expression
+    for PostgreSQL to match them up.
+    """
+    return db.func.to_tsvector(db.literal_column(SEARCH_CONFIG), name + " " + description)
+
+
 class DataValidationError(Exception):
     """Used for an data validation errors when deserializing"""
 
@@ -60,6 +208,78 @@ class Category(Enum):
     TOOLS = 5
 
 
+def _to_bool(value, field: str) -> bool:
+    """Validates a boolean value from a request"""
+    if not isinstance(value, bool):
+        raise DataValidationError(f"Invalid type for boolean [{field}]: " + str(type(value)))
+    return value
+
+
+def _to_decimal(value, field: str) -> Decimal:
+    """Validates a decimal value from a request"""
+    try:
+        number = Decimal(str(value).strip(' "'))
+    except ArithmeticError as error:
+        raise DataValidationError(f"Invalid decimal [{field}]: {value}") from error
+    if not number.is_finite():
+        raise DataValidationError(f"Invalid decimal [{field}]: {value}")
+    return number
+
+
+def _get_text(args, field: str) -> str:
+    """Returns a string filter from a request, or None when it is not given"""
+    value = args.get(field)
+    if value is None:
+        return None
+    if not isinstance(value, str):
+        raise DataValidationError(f"Invalid type for string [{field}]: {type(value)}")
+    return value
+
+
+def _summary(count: int, available: int, low, high, total) -> dict:
+    """Formats the aggregates of a group of Products"""
+    average = Decimal(total) / count if count else None
+    return {
+        "count": count,
+        "available": available,
+        "available_ratio": round(available / count, 4) if count else None,
+        "price_min": str(low) if low is not None else None,
+        "price_max": str(high) if high is not None else None,
+        "price_avg": str(average.quantize(Decimal("0.01"))) if average is not None else None,
+    }
+
+
+def _parse_bool(value, field: str) -> bool:
+    """Validates a boolean value that may come from a query string"""
+    if isinstance(value, str) and value.lower() in ("true", "false"):
+        return value.lower() == "true"
+    return _to_bool(value, field)
+
+
+def _get_list(args, key: str) -> list:
+    """Returns the comma separated and/or repeated values of an argument"""
+    if hasattr(args, "getlist"):
+        values = args.getlist(key)
+    else:
+        values = args.get(key)
+        values = values if isinstance(values, list) else [values]
+    result = []
+    for value in values:
+        if isinstance(value, str):
+            result.extend(item.strip() for item in value.split(",") if item.strip())
+        elif value is not None:
+            result.append(value)
+    return result
+
+
+def _to_category(value) -> Category:
+    """Validates a Category name from a request"""
+    try:
+        return Category[value]
+    except (KeyError, TypeError) as error:
+        raise DataValidationError(f"Invalid category: {value}") from error
+
+
 class Product(db.Model):
     """
     Class that represents a Product
@@ -79,6 +299,28 @@ class Product(db.Model):
     category = db.Column(
         db.Enum(Category), nullable=False, server_default=(Category.UNKNOWN.name)
     )
+    # row version, bumped on every update for ETags and optimistic locking
+    version = db.Column(db.Integer, nullable=False, server_default="1")
+    __mapper_args__ = {"version_id_col": version}
+
+    ##################################################
+    # Indexes for the filter columns
+    ##################################################
+    __table_args__ = (
+        db.Index("ix_product_name", name),
+        db.Index(
+            "ix_product_name_lower",
+            db.func.lower(name).label("name_lower"),
+            postgresql_ops={"name_lower": "text_pattern_ops"},
+        ),
+        db.Index("ix_product_category_available", category, available),
+        db.Index("ix_product_price", price),
+        db.Index(
+            "ix_product_search",
+            _search_document(name, description),
+            postgresql_using="gin",
+        ).ddl_if(dialect="postgresql"),
+    )
 
     ##################################################
     # INSTANCE METHODS
@@ -87,15 +329,32 @@ class Product(db.Model):
     def __repr__(self):
         return f"<Product {self.name} id=[{self.id}]>"
 
-    def create(self):
+    def create(self, idempotency_key: str = None, fingerprint: str = None):
         """
         Creates a Product to the database
+
+        With an ``idempotency_key`` the serialized Product is stored under
+        that key in the same transaction, so a retried request can replay
+        it. A concurrent request that stored the key first makes the
+        commit fail with an IntegrityError and nothing is inserted.
         """
         logger.info("Creating %s", self.name)
         # id must be none to generate next primary key
         self.id = None  # pylint: disable=invalid-name
         db.session.add(self)
-        db.session.commit()
+        if idempotency_key is not None:
+            # assign the id and read back the row so the stored response
+            # matches what the database returns from now on
+            db.session.flush()
+            db.session.refresh(self)
+            IdempotencyKey.expire(idempotency_key)
+            db.session.add(IdempotencyKey.store(idempotency_key, fingerprint, self.serialize()))
+        try:
+            db.session.commit()
+        except db.exc.IntegrityError:
+            db.session.rollback()
+            raise
+        invalidate_caches(self.id)
 
     def update(self):
         """
@@ -104,13 +363,24 @@ class Product(db.Model):
         logger.info("Saving %s", self.name)
         if not self.id:
             raise DataValidationError("Update called with empty ID field")
-        db.session.commit()
+        try:
+            db.session.commit()
+        except StaleDataError:
+            # another request changed the row since it was read
+            db.session.rollback()
+            raise
+        invalidate_caches(self.id)
 
     def delete(self):
         """Removes a Product from the data store"""
         logger.info("Deleting %s", self.name)
+        product_id = self.id
         db.session.delete(self)
         db.session.commit()
+        invalidate_caches(product_id)
+
+    # the keys of serialize(), in order
+    FIELDS = ("id", "name", "description", "price", "available", "category", "version")
 
     def serialize(self) -> dict:
         """Serializes a Product into a dictionary"""
@@ -120,7 +390,8 @@ class Product(db.Model):
             "description": self.description,
             "price": str(self.price),
             "available": self.available,
-            "category": self.category.name  # convert enum to string
+            "category": self.category.name,  # convert enum to string
+            "version": self.version,
         }
 
     def deserialize(self, data: dict):
@@ -129,27 +400,44 @@ class Product(db.Model):
         Args:
             data (dict): A dictionary containing the Product data
         """
+        for column, value in self.validate(data).items():
+            setattr(self, column, value)
+        return self
+
+    @staticmethod
+    def validate(data: dict) -> dict:
+        """
+        Validates a Product dictionary without building a Product
+        Args:
+            data (dict): A dictionary containing the Product data
+        Returns:
+            dict: the values of the columns set by deserialize
+        """
         try:
-            self.name = data["name"]
-            self.description = data["description"]
-            self.price = Decimal(data["price"])
+            values = {
+                "name": data["name"],
+                "description": data["description"],
+                "price": Decimal(data["price"]),
+            }
             if isinstance(data["available"], bool):
-                self.available = data["available"]
+                values["available"] = data["available"]
             else:
                 raise DataValidationError(
                     "Invalid type for boolean [available]: "
                     + str(type(data["available"]))
                 )
-            self.category = getattr(Category, data["category"])  # create enum from string
-        except AttributeError as error:
-            raise DataValidationError("Invalid attribute: " + error.args[0]) from error
+            values["category"] = _to_category(data["category"])  # create enum from string
         except KeyError as error:
             raise DataValidationError("Invalid product: missing " + error.args[0]) from error
         except TypeError as error:
             raise DataValidationError(
                 "Invalid product: body of request contained bad or no data " + str(error)
             ) from error
-        return self
+        except InvalidOperation as error:
+            raise DataValidationError(f"Invalid price: {data['price']}") from error
+        if not values["price"].is_finite():
+            raise DataValidationError(f"Invalid price: {data['price']}")
+        return values
 
     ##################################################
     # CLASS METHODS
@@ -159,15 +447,19 @@ class Product(db.Model):
     def init_db(cls, app: Flask):
         """Initializes the database session
 
+        Pushes an app context and creates the tables right away, for tests
+        and scripts that use the models outside of requests. The service
+        itself uses ``init_app()`` and ``ensure_schema()`` instead.
+
         :param app: the Flask app
         :type data: Flask
 
         """
         logger.info("Initializing database")
         # This is where we initialize SQLAlchemy from the Flask app
-        db.init_app(app)
+        init_app(app)
         app.app_context().push()
-        db.create_all()  # make our sqlalchemy tables
+        _create_schema(app)
 
     @classmethod
     def all(cls) -> list:
@@ -189,6 +481,29 @@ class Product(db.Model):
         logger.info("Processing lookup for id %s ...", product_id)
         return cls.query.get(product_id)
 
+    @classmethod
+    def find_serialized(cls, product_id: int):
+        """Finds a Product by it's ID and returns it serialized
+
+        Payloads are read through ``product_cache`` and written back on a
+        miss; every write to a Product invalidates its entry.
+
+        :param product_id: the id of the Product to find
+        :type product_id: int
+
+        :return: the serialized Product, or None if not found
+        :rtype: dict
+
+        """
+        payload = product_cache.get(product_id)
+        if payload is None:
+            product = cls.find(product_id)
+            if product is None:
+                return None
+            payload = product.serialize()
+            product_cache.set(product_id, payload)
+        return payload
+
     @classmethod
     def find_by_name(cls, name: str) -> list:
         """Returns all Products with the given name
@@ -247,3 +562,779 @@ class Product(db.Model):
         """
         logger.info("Processing category query for %s ...", category.name)
         return cls.query.filter(cls.category == category)
+
+    @classmethod
+    def create_many(cls, items: list, chunk_size: int = 1000) -> list:
+        """Creates many Products in a single transaction
+
+        Every item is validated with ``deserialize`` before anything is
+        written, then the rows are inserted ``chunk_size`` at a time with
+        one multi-row INSERT per chunk.
+
+        :param items: the dictionaries describing each Product
+        :type items: list
+        :param chunk_size: the number of rows sent per INSERT
+        :type chunk_size: int
+
+        :return: the ids of the new Products in the order given
+        :rtype: list
+
+        """
+        logger.info("Creating %s Products", len(items))
+        rows = []
+        for index, data in enumerate(items):
+            try:
+                rows.append(cls.row_from(data))
+            except DataValidationError as error:
+                raise DataValidationError(f"Item {index}: {error}") from error
+
+        ids = []
+        statement = db.insert(cls).returning(cls.id)
+        for start in range(0, len(rows), chunk_size):
+            chunk = rows[start:start + chunk_size]
+            ids.extend(db.session.scalars(statement, chunk).all())
+        db.session.commit()
+        invalidate_caches()
+        return ids
+
+    # columns written by bulk loads, the others have defaults
+    LOAD_COLUMNS = ("name", "description", "price", "available", "category")
+
+    @classmethod
+    def row_from(cls, data: dict) -> dict:
+        """Validates a Product dictionary and returns its column values
+
+        Applies the rules of ``validate`` and the column lengths, which
+        only PostgreSQL enforces, so that a bad row is rejected by itself
+        instead of failing a whole bulk load.
+
+        :param data: the dictionary describing a Product
+        :type data: dict
+
+        :return: the values of ``LOAD_COLUMNS``
+        :rtype: dict
+
+        """
+        row = cls.validate(data)
+        for column in ("name", "description"):
+            cls._check_text(column, row[column])
+        return row
+
+    @classmethod
+    def _check_text(cls, column: str, value):
+        """Validates a value for a string column and its length"""
+        if not isinstance(value, str):
+            raise DataValidationError(f"Invalid type for string [{column}]: {type(value)}")
+        length = cls.__table__.c[column].type.length
+        if len(value) > length:
+            raise DataValidationError(f"Invalid {column}: longer than {length} characters")
+
+    @classmethod
+    def load_rows(cls, rows: list) -> int:
+        """Inserts validated rows with COPY on PostgreSQL and commits them
+
+        Other databases get a single executemany INSERT. Unlike
+        ``create_many`` no ids are returned, which is what lets PostgreSQL
+        stream the rows with ``COPY FROM STDIN``.
+
+        :param rows: the dictionaries returned by ``row_from``
+        :type rows: list
+
+        :return: the number of rows inserted
+        :rtype: int
+
+        """
+        if not rows:
+            return 0
+        if db.engine.dialect.name == "postgresql":
+            buffer = io.StringIO()
+            writer = csv.writer(buffer, quoting=csv.QUOTE_ALL)
+            for row in rows:
+                writer.writerow(
+                    row["category"].name if column == "category" else row[column] for column in cls.LOAD_COLUMNS
+                )
+            buffer.seek(0)
+            cursor = db.session.connection().connection.cursor()
+            cursor.copy_expert(
+                f"COPY {cls.__tablename__} ({', '.join(cls.LOAD_COLUMNS)}) FROM STDIN WITH (FORMAT csv)", buffer
+            )
+        else:
+            db.session.execute(cls.__table__.insert(), rows)
+        db.session.commit()
+        invalidate_caches()
+        return len(rows)
+
+    ##################################################
+    # STATISTICS
+    ##################################################
+
+    @classmethod
+    def stats(cls) -> dict:
+        """Returns catalog statistics computed with one GROUP BY query
+
+        Results are kept in ``stats_cache`` for ``STATS_CACHE_TTL`` seconds
+        and dropped by every write.
+
+        :return: the product count, availability and price range overall
+            and per Category
+        :rtype: dict
+
+        """
+        cached = stats_cache.get("stats")
+        if cached is not None:
+            return cached
+        logger.info("Processing catalog statistics")
+        rows = db.session.query(
+            cls.category,
+            db.func.count(cls.id),
+            db.func.sum(db.case((cls.available.is_(True), 1), else_=0)),
+            db.func.min(cls.price),
+            db.func.max(cls.price),
+            db.func.sum(cls.price),
+        ).group_by(cls.category).all()
+
+        categories = {}
+        for category, count, available, low, high, total in rows:
+            categories[category.name] = _summary(count, available, low, high, total)
+        count = sum(row[1] for row in rows)
+        result = _summary(
+            count,
+            sum(row[2] for row in rows),
+            min((row[3] for row in rows), default=None),
+            max((row[4] for row in rows), default=None),
+            sum((Decimal(row[5]) for row in rows), Decimal(0)),
+        )
+        result["categories"] = categories
+        stats_cache.set("stats", result)
+        return result
+
+    ##################################################
+    # BULK OPERATIONS
+    ##################################################
+
+    @classmethod
+    def criteria(cls, ids: list = None, filters: dict = None) -> list:
+        """Builds the WHERE clauses selecting Products by id list or filter
+
+        :param ids: the ids of the Products to select
+        :type ids: list
+        :param filters: any of the ``ProductQuery.FILTERS`` to match,
+            an empty dictionary selects every Product
+        :type filters: dict
+
+        :return: a list of SQL expressions to pass to ``filter``
+        :rtype: list
+
+        """
+        if ids is None and filters is None:
+            raise DataValidationError("A list of ids or a filter is required")
+        builder = ProductQuery()
+        if ids is not None:
+            builder.ids(ids)
+        if filters is not None:
+            if not isinstance(filters, dict):
+                raise DataValidationError("Invalid filter: must be an object")
+            unknown = set(filters) - set(ProductQuery.FILTERS)
+            if unknown:
+                raise DataValidationError("Invalid filter field: " + ", ".join(sorted(unknown)))
+            builder.apply(filters)
+        return builder.clauses
+
+    @classmethod
+    def update_many(cls, changes: dict, ids: list = None, filters: dict = None) -> int:
+        """Applies a partial update to many Products with one UPDATE statement
+
+        :param changes: new values for ``name``, ``description``, ``price``,
+            ``available`` or ``category``, or a ``price_delta`` to add to
+            the current price
+        :type changes: dict
+        :param ids: the ids of the Products to update
+        :type ids: list
+        :param filters: the filter selecting the Products to update
+        :type filters: dict
+
+        :return: the number of Products updated
+        :rtype: int
+
+        """
+        logger.info("Bulk updating %s", changes)
+        clauses = cls.criteria(ids, filters)
+        if not isinstance(changes, dict) or not changes:
+            raise DataValidationError("Invalid update: no changes given")
+        unknown = set(changes) - {"name", "description", "price", "price_delta", "available", "category"}
+        if unknown:
+            raise DataValidationError("Invalid update field: " + ", ".join(sorted(unknown)))
+        if "price" in changes and "price_delta" in changes:
+            raise DataValidationError("Invalid update: price and price_delta are exclusive")
+
+        values = cls._update_values(changes)
+        values[cls.version] = cls.version + 1
+        count = cls.query.filter(*clauses).update(values, synchronize_session=False)
+        db.session.commit()
+        invalidate_caches()
+        return count
+
+    @classmethod
+    def _update_values(cls, changes: dict) -> dict:
+        """Converts a validated partial update into column values"""
+        values = {}
+        for field in ("name", "description"):
+            if field in changes:
+                cls._check_text(field, changes[field])
+                values[getattr(cls, field)] = changes[field]
+        if "price" in changes:
+            values[cls.price] = _to_decimal(changes["price"], "price")
+        if "price_delta" in changes:
+            values[cls.price] = cls.price + _to_decimal(changes["price_delta"], "price_delta")
+        if "available" in changes:
+            values[cls.available] = _to_bool(changes["available"], "available")
+        if "category" in changes:
+            values[cls.category] = _to_category(changes["category"])
+        return values
+
+    @classmethod
+    def delete_many(cls, ids: list = None, filters: dict = None) -> int:
+        """Removes many Products with one DELETE statement
+
+        :param ids: the ids of the Products to delete
+        :type ids: list
+        :param filters: the filter selecting the Products to delete
+        :type filters: dict
+
+        :return: the number of Products deleted
+        :rtype: int
+
+        """
+        logger.info("Bulk deleting ids=%s filter=%s", ids, filters)
+        clauses = cls.criteria(ids, filters)
+        count = cls.query.filter(*clauses).delete(synchronize_session=False)
+        db.session.commit()
+        invalidate_caches()
+        return count
+
+    ##################################################
+    # PAGINATION
+    ##################################################
+
+    @classmethod
+    def paginate(cls, query, limit: int, after: int = None) -> list:
+        """Returns a single page of a Product query using keyset pagination
+
+        Rows are ordered by id and the page starts right after the ``after``
+        id, so fetching a late page costs the same as fetching the first one.
+
+        :param query: the Product query to paginate
+        :type query: Query
+        :param limit: the maximum number of Products to return
+        :type limit: int
+        :param after: the id of the last Product of the previous page
+        :type after: int
+
+        :return: a page of Products
+        :rtype: list
+
+        """
+        logger.info("Processing page of %s after %s ...", limit, after)
+        return cls.seek(query, limit, after).all()
+
+    @classmethod
+    def seek(cls, query, limit: int = None, after: int = None):
+        """Orders a Product query by id starting right after the ``after`` id"""
+        if after is not None:
+            query = query.filter(cls.id > after)
+        query = query.order_by(cls.id)
+        if limit is not None:
+            query = query.limit(limit)
+        return query
+
+    @classmethod
+    def stream(cls, query, batch_size: int = 1000):
+        """Iterates over a Product query without loading it all into memory
+
+        Rows are fetched through a server-side cursor ``batch_size`` at a
+        time so memory stays flat regardless of how many rows match.
+
+        :param query: the Product query to iterate over
+        :type query: Query
+        :param batch_size: the number of rows to fetch per round-trip
+        :type batch_size: int
+
+        :return: a generator of Products
+        :rtype: generator
+
+        """
+        logger.info("Processing stream in batches of %s ...", batch_size)
+        query = query.execution_options(stream_results=True).yield_per(batch_size)
+        yield from query
+
+    @classmethod
+    def project(cls, query, batch_size: int = None, fields: tuple = None):
+        """Serializes the rows of a Product query straight from its columns
+
+        Only the serialized columns are selected and they come back as plain
+        tuples, which skips building ORM instances and the identity map. The
+        dictionaries are identical to the ones ``serialize`` returns, narrowed
+        to ``fields`` when given.
+
+        :param query: the Product query to serialize
+        :type query: Query
+        :param batch_size: stream the rows this many at a time if given
+        :type batch_size: int
+        :param fields: the names of the ``FIELDS`` to select, all if None
+        :type fields: tuple
+
+        :return: a generator of serialized Products
+        :rtype: generator
+
+        """
+        fields = tuple(fields or cls.FIELDS)
+        query = query.with_entities(*(getattr(cls, field) for field in fields))
+        if batch_size:
+            query = query.execution_options(stream_results=True).yield_per(batch_size)
+        if fields == cls.FIELDS:
+            # the full row is by far the most common so it skips the lookups below
+            for product_id, name, description, price, available, category, version in query:
+                yield {
+                    "id": product_id,
+                    "name": name,
+                    "description": description,
+                    "price": str(price),
+                    "available": available,
+                    "category": category.name,
+                    "version": version,
+                }
+            return
+        price = "price" in fields
+        category = "category" in fields
+        for row in query:
+            product = dict(zip(fields, row))
+            if price:
+                product["price"] = str(product["price"])
+            if category:
+                product["category"] = product["category"].name
+            yield product
+
+    @classmethod
+    def columns(cls, query, fields: tuple = None) -> dict:
+        """Reads a Product query into one list of values per field
+
+        Prices stay Decimals and categories stay Category members so that
+        columnar encoders can choose their own compact representation.
+
+        :param query: the Product query to read
+        :type query: Query
+        :param fields: the names of the ``FIELDS`` to select, all if None
+        :type fields: tuple
+
+        :return: lists of equal length keyed by field name
+        :rtype: dict
+
+        """
+        fields = tuple(fields or cls.FIELDS)
+        rows = query.with_entities(*(getattr(cls, field) for field in fields)).all()
+        if not rows:
+            return {field: [] for field in fields}
+        return {field: list(values) for field, values in zip(fields, zip(*rows))}
+
+    @classmethod
+    def column_batches(cls, query, batch_size: int, fields: tuple = None):
+        """Streams a Product query as ``columns`` dictionaries of batch_size rows
+
+        The rows are fetched through a server-side cursor so only one
+        batch is held in memory at a time.
+
+        :param query: the Product query to read
+        :type query: Query
+        :param batch_size: the number of rows per batch
+        :type batch_size: int
+        :param fields: the names of the ``FIELDS`` to select, all if None
+        :type fields: tuple
+
+        :return: a generator of lists of equal length keyed by field name
+        :rtype: generator
+
+        """
+        fields = tuple(fields or cls.FIELDS)
+        query = query.with_entities(*(getattr(cls, field) for field in fields))
+        rows = iter(query.execution_options(stream_results=True).yield_per(batch_size))
+        while True:
+            batch = list(itertools.islice(rows, batch_size))
+            if not batch:
+                return
+            yield {field: list(values) for field, values in zip(fields, zip(*batch))}
+
+    @classmethod
+    def all_paged(cls, limit: int, after: int = None) -> list:
+        """Returns a page of all of the Products in the database"""
+        return cls.paginate(cls.query, limit, after)
+
+    @classmethod
+    def find_by_name_paged(cls, name: str, limit: int, after: int = None) -> list:
+        """Returns a page of the Products with the given name"""
+        return cls.paginate(cls.find_by_name(name), limit, after)
+
+    @classmethod
+    def find_by_price_paged(cls, price: Decimal, limit: int, after: int = None) -> list:
+        """Returns a page of the Products with the given price"""
+        return cls.paginate(cls.find_by_price(price), limit, after)
+
+    @classmethod
+    def find_by_availability_paged(cls, available: bool, limit: int, after: int = None) -> list:
+        """Returns a page of the Products by their availability"""
+        return cls.paginate(cls.find_by_availability(available), limit, after)
+
+    @classmethod
+    def find_by_category_paged(cls, category: Category, limit: int, after: int = None) -> list:
+        """Returns a page of the Products by their Category"""
+        return cls.paginate(cls.find_by_category(category), limit, after)
+
+
+class ProductQuery:
+    """
+    Builds a single filtered and sorted SQL query over Products
+
+    Predicates are combined with AND so any number of filters run as one
+    statement, and pages are fetched with a seek predicate on the sort key
+    so that every page costs the same as the first one.
+    """
+
+    FILTERS = ("name", "name_prefix", "category", "available", "price", "price_min", "price_max")
+    SORT_FIELDS = ("id", "name", "price", "available", "category")
+
+    def __init__(self, dialect: str = None):
+        self.clauses = []
+        self.order = []
+        self.rank = None
+        self.dialect = dialect
+
+    def __repr__(self):
+        return f"<ProductQuery clauses={len(self.clauses)} order={self.order}>"
+
+    ##################################################
+    # PREDICATES
+    ##################################################
+
+    def ids(self, ids: list):
+        """Matches Products whose id is in the list"""
+        if not isinstance(ids, list) or not all(isinstance(i, int) and not isinstance(i, bool) for i in ids):
+            raise DataValidationError("Invalid ids: must be a list of integers")
+        self.clauses.append(Product.id.in_(ids))
+        return self
+
+    def name(self, name: str):
+        """Matches Products with exactly this name"""
+        self.clauses.append(Product.name == name)
+        return self
+
+    def name_prefix(self, prefix: str):
+        """Matches Products whose name starts with the prefix, ignoring case"""
+        self.clauses.append(db.func.lower(Product.name).startswith(prefix.lower(), autoescape=True))
+        return self
+
+    def categories(self, categories: list):
+        """Matches Products in any of the Categories"""
+        self.clauses.append(Product.category.in_(categories))
+        return self
+
+    def available(self, available: bool = True):
+        """Matches Products by their availability"""
+        self.clauses.append(Product.available == available)
+        return self
+
+    def price(self, price: Decimal):
+        """Matches Products with exactly this price"""
+        self.clauses.append(Product.price == price)
+        return self
+
+    def price_range(self, price_min: Decimal = None, price_max: Decimal = None):
+        """Matches Products priced between the inclusive bounds given"""
+        if price_min is not None:
+            self.clauses.append(Product.price >= price_min)
+        if price_max is not None:
+            self.clauses.append(Product.price <= price_max)
+        return self
+
+    def search(self, text: str):
+        """Matches Products whose name or description contain the words
+
+        The last word also matches as a prefix and results are ranked by
+        relevance unless another sort order is given. PostgreSQL uses the
+        GIN text search index, other databases fall back to substring
+        matching ranked by whether the name or the description matched.
+        """
+        terms = re.findall(r"\w+", text.lower())
+        if not terms:
+            return self
+        if (self.dialect or db.engine.dialect.name) == "postgresql":
+            tsquery = db.func.to_tsquery(
+                db.literal_column(SEARCH_CONFIG), " & ".join(terms[:-1] + [terms[-1] + ":*"])
+            )
+            document = _search_document(Product.name, Product.description)
+            self.clauses.append(document.op("@@")(tsquery))
+            # ts_rank returns a single precision real; as double precision
+            # it survives the round trip through a cursor exactly.
+            self.rank = db.cast(db.func.ts_rank(document, tsquery), db.Double)
+        else:
+            name, description = db.func.lower(Product.name), db.func.lower(Product.description)
+            weights = []
+            for term in terms:
+                self.clauses.append(db.or_(name.contains(term, autoescape=True), description.contains(term, autoescape=True)))
+                weights.append(db.case((name.contains(term, autoescape=True), 2), else_=0))
+                weights.append(db.case((description.contains(term, autoescape=True), 1), else_=0))
+            self.rank = sum(weights[1:], weights[0])
+        return self
+
+    def sort(self, spec: str):
+        """Orders by comma separated fields, prefix a field with '-' to descend
+
+        :param spec: the sort order, e.g. ``"category,-price"``
+        :type spec: str
+
+        """
+        for field in (item.strip() for item in spec.split(",")):
+            descending = field.startswith("-")
+            field = field.lstrip("-")
+            if field not in self.SORT_FIELDS:
+                raise DataValidationError(f"Invalid sort field: {field}")
+            self.order.append((field, descending))
+        return self
+
+    def apply(self, args):
+        """Applies filter and sort arguments given as strings or JSON values
+
+        :param args: a dictionary or MultiDict holding any of ``FILTERS``
+            and an optional ``sort``
+        :type args: dict
+
+        """
+        name, prefix, text = (_get_text(args, field) for field in ("name", "name_prefix", "q"))
+        if name:
+            self.name(name)
+        if prefix:
+            self.name_prefix(prefix)
+        categories = _get_list(args, "category")
+        if categories:
+            self.categories([_to_category(category) for category in categories])
+        if args.get("available") not in (None, ""):
+            self.available(_parse_bool(args.get("available"), "available"))
+        if args.get("price") not in (None, ""):
+            self.price(_to_decimal(args.get("price"), "price"))
+        self._apply_price_range(args)
+        if text:
+            self.search(text)
+        if args.get("sort"):
+            self.sort(args.get("sort"))
+        return self
+
+    def _apply_price_range(self, args):
+        """Applies the price_min and price_max arguments"""
+        bounds = {}
+        for field in ("price_min", "price_max"):
+            if args.get(field) not in (None, ""):
+                bounds[field] = _to_decimal(args.get(field), field)
+        if bounds:
+            self.price_range(**bounds)
+
+    @classmethod
+    def from_args(cls, args) -> "ProductQuery":
+        """Creates a ProductQuery from request arguments"""
+        return cls().apply(args)
+
+    ##################################################
+    # EXECUTION
+    ##################################################
+
+    def _sort_keys(self) -> list:
+        """Returns the sort keys with id appended as the unique tie breaker"""
+        keys = list(self.order)
+        if not keys and self.rank is not None:
+            keys.append(("rank", True))
+        if not any(field == "id" for field, _ in keys):
+            keys.append(("id", False))
+        return keys
+
+    def query(self):
+        """Returns the SQLAlchemy query with all predicates and ordering"""
+        query = Product.query.filter(*self.clauses)
+        if self.order or self.rank is not None:
+            query = query.order_by(*self._order_by())
+        return query
+
+    def _column(self, field: str):
+        """Returns the column or expression of a sort key"""
+        return self.rank if field == "rank" else getattr(Product, field)
+
+    def _order_by(self) -> list:
+        """Returns the ORDER BY expressions for the sort keys"""
+        columns = []
+        for field, descending in self._sort_keys():
+            column = self._column(field)
+            columns.append(column.desc() if descending else column.asc())
+        return columns
+
+    def seek(self, limit: int = None, after: list = None):
+        """Returns the query for the page following the ``after`` sort key
+
+        :param limit: the maximum number of Products in the page
+        :type limit: int
+        :param after: the cursor values of the last row of the previous page
+        :type after: list
+
+        """
+        query = Product.query.filter(*self.clauses)
+        if after is not None:
+            query = query.filter(self._seek_predicate(after))
+        query = query.order_by(*self._order_by())
+        if limit is not None:
+            query = query.limit(limit)
+        return query
+
+    def select(self, limit: int = None, after: list = None):
+        """Returns the same page as ``seek`` as a statement for any Session
+
+        The statement is not bound to the Flask-SQLAlchemy session, so it
+        can run on other sessions such as an ``AsyncSession``.
+        """
+        statement = db.select(Product).where(*self.clauses)
+        if after is not None:
+            statement = statement.where(self._seek_predicate(after))
+        if self.order or self.rank is not None or after is not None or limit is not None:
+            statement = statement.order_by(*self._order_by())
+        if limit is not None:
+            statement = statement.limit(limit)
+        return statement
+
+    def key_fields(self) -> tuple:
+        """Returns the Product fields that ``cursor`` reads from a page"""
+        return tuple(field for field, _ in self._sort_keys() if field != "rank")
+
+    def page(self, limit: int, after: list = None) -> list:
+        """Returns one page of Products"""
+        logger.info("Processing query page of %s after %s ...", limit, after)
+        return self.seek(limit, after).all()
+
+    def cursor(self, product, rank=None) -> list:
+        """Returns the JSON-friendly sort key values of a Product or its dictionary
+
+        :param product: the last Product of a page
+        :type product: Product or dict
+        :param rank: the search rank of the Product, looked up if not given
+        :type rank: float
+
+        """
+        values = []
+        for field, _ in self._sort_keys():
+            if field == "rank":
+                if rank is None:
+                    product_id = product["id"] if isinstance(product, dict) else product.id
+                    rank = db.session.query(self.rank).filter(Product.id == product_id).scalar()
+                values.append(rank)
+                continue
+            value = product[field] if isinstance(product, dict) else getattr(product, field)
+            if isinstance(value, Decimal):
+                value = str(value)
+            elif isinstance(value, Category):
+                value = value.name
+            values.append(value)
+        return values
+
+    def _seek_predicate(self, after: list):
+        """Builds (a > x) OR (a = x AND b > y) ... for the sort keys"""
+        keys = self._sort_keys()
+        if not isinstance(after, list) or len(after) != len(keys):
+            raise DataValidationError("Invalid cursor for this sort order")
+        values = [self._cursor_value(field, value) for (field, _), value in zip(keys, after)]
+        alternatives = []
+        for index, (field, descending) in enumerate(keys):
+            column = self._column(field)
+            terms = [self._column(f) == v for (f, _), v in zip(keys[:index], values[:index])]
+            terms.append(column < values[index] if descending else column > values[index])
+            alternatives.append(db.and_(*terms))
+        return db.or_(*alternatives)
+
+    @staticmethod
+    def _cursor_value(field: str, value):
+        """Converts a cursor value back into the type of its column"""
+        if field == "price":
+            return _to_decimal(value, "cursor")
+        if field == "category":
+            return _to_category(value)
+        if field == "available":
+            return _to_bool(value, "cursor")
+        if field == "id" and not (isinstance(value, int) and not isinstance(value, bool)):
+            raise DataValidationError("Invalid cursor")
+        if field == "name" and not isinstance(value, str):
+            raise DataValidationError("Invalid cursor")
+        if field == "rank" and (isinstance(value, bool) or not isinstance(value, (int, float))):
+            raise DataValidationError("Invalid cursor")
+        return value
+
+
+######################################################################
+#  I D E M P O T E N C Y   K E Y   M O D E L
+######################################################################
+class IdempotencyKey(db.Model):
+    """
+    The response of a create request stored under its Idempotency-Key
+
+    Keys live for ``IDEMPOTENCY_TTL`` seconds. Until then a retry with the
+    same key and body replays the stored response instead of creating
+    another Product.
+    """
+
+    key = db.Column(db.String(255), primary_key=True)
+    # SHA-256 of the request body, to reject a key reused for another request
+    fingerprint = db.Column(db.String(64), nullable=False)
+    response = db.Column(db.JSON, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (db.Index("ix_idempotency_key_created_at", created_at),)
+
+    # seconds a key is kept, set by init_app()
+    ttl = 86400
+
+    def __repr__(self):
+        return f"<IdempotencyKey {self.key} created_at=[{self.created_at}]>"
+
+    @classmethod
+    def store(cls, key: str, fingerprint: str, response: dict) -> "IdempotencyKey":
+        """Returns a new record of the response to a request with a key"""
+        return cls(key=key, fingerprint=fingerprint, response=response, created_at=datetime.utcnow())
+
+    @classmethod
+    def find(cls, key: str):
+        """Returns the live record stored under a key, or None"""
+        record = db.session.get(cls, key)
+        if record is None or record.expired():
+            return None
+        return record
+
+    def expired(self) -> bool:
+        """Returns True once the record has outlived the TTL"""
+        return self.created_at < self._cutoff()
+
+    @classmethod
+    def expire(cls, key: str):
+        """Deletes the record of a key if it outlived the TTL, so the key can be used again"""
+        db.session.execute(cls.expire_statement(key))
+
+    @classmethod
+    def expire_statement(cls, key: str):
+        """Returns the DELETE statement of ``expire``, for sessions other than db.session"""
+        return (
+            db.delete(cls)
+            .where(cls.key == key, cls.created_at < cls._cutoff())
+            .execution_options(synchronize_session=False)
+        )
+
+    @classmethod
+    def purge(cls) -> int:
+        """Deletes every record older than the TTL and returns how many there were"""
+        logger.info("Purging idempotency keys older than %s seconds", cls.ttl)
+        count = db.session.query(cls).filter(cls.created_at < cls._cutoff()).delete(synchronize_session=False)
+        db.session.commit()
+        return count
+
+    @classmethod
+    def _cutoff(cls) -> datetime:
+        return datetime.utcnow() - timedelta(seconds=cls.ttl)
@@ -4,28 +4,101 @@ Product Store Service Routes
 Implements REST API endpoints for Product resources.
 """
 
-from flask import jsonify, request, abort, url_for
-from service.models import Product, Category
-from service.common import status
-from . import app
+import base64
+import binascii
+import hashlib
+import hmac
+import json
+import os
+from flask import Blueprint, Response, current_app, jsonify, request, abort, url_for, stream_with_context
+from sqlalchemy.exc import IntegrityError
+from service.models import IdempotencyKey, Product, ProductQuery, db, product_cache
+from service.common import encoders, metrics, profiling, status
+from service.common.sampler import ProfilerBusyError, SamplingProfiler
+from service.common.pool import pool_status
+
+NDJSON_MIMETYPE = "application/x-ndjson"
+MSGPACK_MIMETYPE = "application/x-msgpack"
+
+# The routes are registered on the app by create_app()
+api = Blueprint("api", __name__)
 
 
 ######################################################################
 # HEALTH
 ######################################################################
-@app.route("/health")
+@api.route("/health")
 def healthcheck():
     """Health check endpoint"""
     return jsonify(status=200, message="OK"), status.HTTP_200_OK
 
 
+######################################################################
+# CACHE STATISTICS
+######################################################################
+@api.route("/admin/cache")
+def cache_stats():
+    """Report the hit/miss/eviction counters of the Product cache"""
+    return jsonify(product_cache.stats()), status.HTTP_200_OK
+
+
+######################################################################
+# CONNECTION POOL STATISTICS
+######################################################################
+@api.route("/admin/pool")
+def pool_stats():
+    """Report the connection pool state of this worker"""
+    return jsonify(pool_status(db.engine)), status.HTTP_200_OK
+
+
+######################################################################
+# CPU PROFILE
+######################################################################
+@api.route("/admin/profile")
+def cpu_profile():
+    """Sample the stacks of this worker for ?seconds=N as collapsed stacks"""
+    check_admin_token()
+    if not request.environ.get("wsgi.multithread"):
+        # a sync worker has no other thread to sample and is killed when a
+        # profile outlasts its timeout
+        abort(status.HTTP_409_CONFLICT, "Profiling needs a threaded worker, such as gunicorn gthread")
+    try:
+        seconds = float(request.args.get("seconds", "10"))
+    except ValueError:
+        seconds = 0
+    max_seconds = current_app.config["PROFILE_MAX_SECONDS"]
+    if not 0 < seconds <= max_seconds:
+        abort(status.HTTP_400_BAD_REQUEST, f"seconds must be between 0 and {max_seconds:g}")
+
+    profiler = SamplingProfiler(1 / current_app.config["PROFILE_SAMPLE_RATE"])
+    try:
+        profiler.run(seconds)
+    except ProfilerBusyError as error:
+        abort(status.HTTP_409_CONFLICT, str(error))
+    return profiler.collapsed(), status.HTTP_200_OK, {
+        "Content-Type": "text/plain; charset=utf-8",
+        "Content-Disposition": f"attachment; filename=profile-{os.getpid()}.folded",
+        "X-Profile-Samples": str(profiler.samples),
+    }
+
+
+######################################################################
+# METRICS
+######################################################################
+@api.route("/metrics")
+def prometheus_metrics():
+    """Prometheus metrics for every worker of this server"""
+    data, content_type = metrics.render()
+    return data, status.HTTP_200_OK, {"Content-Type": content_type}
+
+
 ######################################################################
 # HOME
 ######################################################################
-@app.route("/")
+@api.route("/")
 def index():
     """Root endpoint"""
-    return app.send_static_file("index.html")
+    return current_app.send_static_file("index.html")
 
 
 ######################################################################
@@ -39,42 +112,303 @@ def check_content_type(content_type):
         abort(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
 
 
+def check_admin_token():
+    """Verify the bearer token of an admin request
+
+    The admin endpoint does not exist at all until ADMIN_TOKEN is set.
+    """
+    token = current_app.config["ADMIN_TOKEN"]
+    if not token:
+        abort(status.HTTP_404_NOT_FOUND)
+    scheme, _, credentials = request.headers.get("Authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not hmac.compare_digest(credentials.encode(), token.encode()):
+        abort(status.HTTP_401_UNAUTHORIZED, "A valid admin bearer token is required")
+
+
+def product_etag(product_id: int, version: int) -> str:
+    """Returns the strong entity tag of a single Product"""
+    return f"{product_id}-{version}"
+
+
+def list_etag(rows, mimetype: str = "application/json") -> str:
+    """Returns the strong entity tag of a list from its (id, version) rows
+
+    Each media type of the same list is a different representation so it
+    gets its own entity tag.
+    """
+    digest = hashlib.sha1(mimetype.encode("ascii"))
+    for product_id, version in rows:
+        digest.update(f"{product_id}-{version};".encode("ascii"))
+    return digest.hexdigest()
+
+
+def not_modified(etag: str, mimetype: str = "application/json"):
+    """Returns an empty 304 Not Modified response for the entity tag of a representation"""
+    response = current_app.response_class(status=status.HTTP_304_NOT_MODIFIED, mimetype=mimetype)
+    response.set_etag(etag)
+    return response
+
+
+def check_if_match(product: Product):
+    """Verify the If-Match precondition against the current Product version"""
+    if "If-Match" not in request.headers:
+        return
+    if not request.if_match.contains(product_etag(product.id, product.version)):
+        abort(status.HTTP_412_PRECONDITION_FAILED, "Product was modified by another request")
+
+
+def encode_cursor(values: list) -> str:
+    """Encodes the sort key of the last row of a page as an opaque cursor"""
+    raw = json.dumps(values, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> list:
+    """Decodes an opaque cursor back into the sort key it was built from"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+    except (ValueError, binascii.Error):
+        values = None
+    if not isinstance(values, list) or not values:
+        abort(status.HTTP_400_BAD_REQUEST, f"Invalid cursor: {cursor}")
+    return values
+
+
+def get_page_args():
+    """Returns the (limit, after) pagination arguments or None if not paging"""
+    limit = request.args.get("limit")
+    after = request.args.get("after")
+    if limit is None and after is None:
+        return None
+    max_limit = current_app.config["PAGE_SIZE_MAX"]
+    try:
+        limit = int(limit) if limit is not None else max_limit
+    except ValueError:
+        abort(status.HTTP_400_BAD_REQUEST, f"Invalid limit: {limit}")
+    if not 0 < limit <= max_limit:
+        abort(status.HTTP_400_BAD_REQUEST, f"limit must be between 1 and {max_limit}")
+    return limit, decode_cursor(after) if after else None
+
+
+def get_batch_selector() -> dict:
+    """Returns the JSON object body of a bulk update or delete request"""
+    data = request.get_json()
+    if not isinstance(data, dict):
+        abort(status.HTTP_400_BAD_REQUEST, "Request body must be an object")
+    return data
+
+
+def parse_ndjson(text: str) -> list:
+    """Parses a newline delimited JSON body into a list of items"""
+    items = []
+    for number, line in enumerate(text.splitlines(), start=1):
+        if not line.strip():
+            continue
+        try:
+            items.append(json.loads(line))
+        except ValueError:
+            abort(status.HTTP_400_BAD_REQUEST, f"Invalid JSON on line {number}")
+    return items
+
+
+def wants_msgpack() -> bool:
+    """Returns True if the client prefers the columnar MessagePack format"""
+    if encoders.msgpack is None:
+        return False
+    best = request.accept_mimetypes.best_match(["application/json", MSGPACK_MIMETYPE])
+    return best == MSGPACK_MIMETYPE
+
+
+def wants_stream() -> bool:
+    """Returns True if the client asked for a streamed NDJSON response"""
+    if request.args.get("stream", "").lower() in ("1", "true"):
+        return True
+    best = request.accept_mimetypes.best_match(["application/json", NDJSON_MIMETYPE])
+    return best == NDJSON_MIMETYPE
+
+
+def get_fields() -> tuple:
+    """Returns the fields asked for with ?fields=id,name or None for all of them"""
+    spec = request.args.get("fields")
+    if not spec:
+        return None
+    fields = tuple(dict.fromkeys(field.strip() for field in spec.split(",") if field.strip()))
+    unknown = [field for field in fields if field not in Product.FIELDS]
+    if unknown or not fields:
+        abort(status.HTTP_400_BAD_REQUEST, f"Invalid fields: {spec}")
+    return fields
+
+
+def with_key_fields(fields: tuple, builder: ProductQuery) -> tuple:
+    """Adds the fields the cursor and the entity tag need to a sparse fieldset"""
+    if fields is None:
+        return None
+    needed = dict.fromkeys(("id", "version") + builder.key_fields())
+    return fields + tuple(field for field in needed if field not in fields)
+
+
+def serialize_products(query, batch_size: int = None, serializer: str = "projection", fields: tuple = None):
+    """Serializes a Product query with the chosen serializer
+
+    "projection" selects the serialized columns as tuples while "orm"
+    loads every Product and calls ``serialize`` on it. Either one keeps
+    only ``fields`` when given.
+    """
+    if serializer == "orm":
+        products = query if batch_size is None else Product.stream(query, batch_size)
+        if fields is None:
+            return (product.serialize() for product in products)
+        return ({field: data[field] for field in fields} for data in map(Product.serialize, products))
+    return Product.project(query, batch_size, fields)
+
+
+def json_response(data, status_code: int = status.HTTP_200_OK) -> Response:
+    """Returns a JSON response encoded with the fast encoder"""
+    return Response(encoders.dumps(data), status=status_code, mimetype="application/json")
+
+
+def stream_products(products, fields: tuple = None) -> Response:
+    """Streams Products to the client as newline delimited JSON"""
+    def generate():
+        rows = serialize_products(
+            products, current_app.config["STREAM_BATCH_SIZE"], current_app.config["STREAM_SERIALIZER"], fields
+        )
+        for row in rows:
+            yield encoders.dumps(row) + b"\n"
+
+    return Response(stream_with_context(generate()), mimetype=NDJSON_MIMETYPE)
+
+
+def next_page_link(cursor: str) -> str:
+    """Builds a Link header pointing at the page after the given cursor"""
+    args = request.args.to_dict(flat=False)
+    args["after"] = cursor
+    return f'<{url_for(".list_products", _external=True, **args)}>; rel="next"'
+
+
 ######################################################################
 # CREATE
 ######################################################################
-@app.route("/products", methods=["POST"])
+@api.route("/products", methods=["POST"])
 def create_products():
     """Create a Product"""
     check_content_type("application/json")
+    key = get_idempotency_key()
+    if key is not None:
+        fingerprint = hashlib.sha256(request.get_data()).hexdigest()
+        record = IdempotencyKey.find(key)
+        if record is not None:
+            return replay_created(record, fingerprint)
     data = request.get_json()
 
     product = Product()
     product.deserialize(data)
-    product.create()
+    if key is None:
+        product.create()
+    else:
+        try:
+            product.create(key, fingerprint)
+        except IntegrityError:
+            # a concurrent request with the same key got there first
+            return replay_created(IdempotencyKey.find(key), fingerprint)
 
-    location_url = url_for("get_product", product_id=product.id, _external=True)
+    location_url = url_for(".get_product", product_id=product.id, _external=True)
     return jsonify(product.serialize()), status.HTTP_201_CREATED, {
         "Location": location_url
     }
 
 
+def get_idempotency_key() -> str:
+    """Returns the Idempotency-Key header of the request, if any"""
+    key = request.headers.get("Idempotency-Key")
+    if key is None:
+        return None
+    if not 0 < len(key) <= 255:
+        abort(status.HTTP_400_BAD_REQUEST, "Idempotency-Key must be 1 to 255 characters")
+    return key
+
+
+def replay_created(record: IdempotencyKey, fingerprint: str):
+    """Returns the stored response of a create request again"""
+    if record is None:
+        abort(status.HTTP_409_CONFLICT, "Idempotency-Key is already in use")
+    if record.fingerprint != fingerprint:
+        abort(status.HTTP_422_UNPROCESSABLE_ENTITY, "Idempotency-Key was used with a different request body")
+    location_url = url_for(".get_product", product_id=record.response["id"], _external=True)
+    return jsonify(record.response), status.HTTP_201_CREATED, {
+        "Location": location_url,
+        "Idempotent-Replayed": "true",
+    }
+
+
+######################################################################
+# BULK CREATE
+######################################################################
+@api.route("/products:batch", methods=["POST"])
+def create_products_batch():
+    """Create many Products in a single transaction"""
+    content_type = request.headers.get("Content-Type", "").split(";")[0].strip()
+    if content_type == "application/json":
+        items = request.get_json()
+    elif content_type == NDJSON_MIMETYPE:
+        items = parse_ndjson(request.get_data(as_text=True))
+    else:
+        abort(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+    if not isinstance(items, list):
+        abort(status.HTTP_400_BAD_REQUEST, "Request body must be a list of products")
+
+    ids = Product.create_many(items, current_app.config["BULK_CHUNK_SIZE"])
+    return jsonify(count=len(ids), ids=ids), status.HTTP_201_CREATED
+
+
+######################################################################
+# BULK UPDATE + DELETE
+######################################################################
+@api.route("/products:batch", methods=["PATCH"])
+def update_products_batch():
+    """Apply a partial update to the Products selected by ids or filter"""
+    check_content_type("application/json")
+    data = get_batch_selector()
+
+    count = Product.update_many(data.get("set"), data.get("ids"), data.get("filter"))
+    return jsonify(updated=count), status.HTTP_200_OK
+
+
+@api.route("/products:batch", methods=["DELETE"])
+def delete_products_batch():
+    """Delete the Products selected by ids or filter"""
+    check_content_type("application/json")
+    data = get_batch_selector()
+
+    count = Product.delete_many(data.get("ids"), data.get("filter"))
+    return jsonify(deleted=count), status.HTTP_200_OK
+
+
 ######################################################################
 # READ
 ######################################################################
-@app.route("/products/<int:product_id>", methods=["GET"])
+@api.route("/products/<int:product_id>", methods=["GET"])
 def get_product(product_id):
     """Read a Product"""
-    product = Product.find(product_id)
-    if not product:
+    payload = Product.find_serialized(product_id)
+    if not payload:
         abort(status.HTTP_404_NOT_FOUND)
 
-    return jsonify(product.serialize()), status.HTTP_200_OK
+    etag = product_etag(payload["id"], payload["version"])
+    if request.if_none_match.contains_weak(etag):
+        return not_modified(etag)
+
+    with profiling.timer("serialize"):
+        response = jsonify(payload)
+    response.set_etag(etag)
+    return response, status.HTTP_200_OK
 
 
 ######################################################################
 # UPDATE
 ######################################################################
-@app.route("/products/<int:product_id>", methods=["PUT"])
+@api.route("/products/<int:product_id>", methods=["PUT"])
 def update_product(product_id):
     """Update a Product"""
     check_content_type("application/json")
@@ -82,46 +416,99 @@ def update_product(product_id):
     product = Product.find(product_id)
     if not product:
         abort(status.HTTP_404_NOT_FOUND)
+    check_if_match(product)
 
     product.deserialize(request.get_json())
     product.id = product_id
     product.update()
 
-    return jsonify(product.serialize()), status.HTTP_200_OK
+    response = jsonify(product.serialize())
+    response.set_etag(product_etag(product.id, product.version))
+    return response, status.HTTP_200_OK
 
 
 ######################################################################
 # DELETE
 ######################################################################
-@app.route("/products/<int:product_id>", methods=["DELETE"])
+@api.route("/products/<int:product_id>", methods=["DELETE"])
 def delete_product(product_id):
     """Delete a Product"""
     product = Product.find(product_id)
     if not product:
         abort(status.HTTP_404_NOT_FOUND)
+    check_if_match(product)
 
     product.delete()
     return "", status.HTTP_204_NO_CONTENT
 
 
+######################################################################
+# STATISTICS
+######################################################################
+@api.route("/products/stats", methods=["GET"])
+def product_stats():
+    """Report counts, availability and prices overall and per Category"""
+    return jsonify(Product.stats()), status.HTTP_200_OK
+
+
 ######################################################################
 # LIST + FILTERS
 ######################################################################
-@app.route("/products", methods=["GET"])
+@api.route("/products", methods=["GET"])
 def list_products():
-    """List Products with optional filters"""
-    name = request.args.get("name")
-    category = request.args.get("category")
-    available = request.args.get("available")
-
-    if name:
-        products = Product.find_by_name(name)
-    elif category:
-        products = Product.find_by_category(Category[category])
-    elif available:
-        products = Product.find_by_availability(available.lower() == "true")
-    else:
-        products = Product.all()
+    """List Products with optional filters and keyset pagination"""
+    builder = ProductQuery.from_args(request.args)
+    page = get_page_args()
+    fields = get_fields()
+    query = builder.query() if page is None else builder.seek(*page)
+
+    if wants_stream():
+        return stream_products(query, fields)
+
+    mimetype = MSGPACK_MIMETYPE if wants_msgpack() else "application/json"
+    if request.if_none_match:
+        # compare against the row versions alone before loading anything
+        etag = list_etag(query.with_entities(Product.id, Product.version), mimetype)
+        if request.if_none_match.contains_weak(etag):
+            response = not_modified(etag, mimetype)
+            response.vary.add("Accept")
+            return response
+
+    selected = with_key_fields(fields, builder)
+    if mimetype == MSGPACK_MIMETYPE:
+        return columnar_products(builder, page, query, fields, selected)
+
+    with profiling.timer("serialize"):
+        results = list(serialize_products(query, serializer=current_app.config["LIST_SERIALIZER"], fields=selected))
+    headers = {}
+    if page is not None and len(results) == page[0]:
+        headers["Link"] = next_page_link(encode_cursor(builder.cursor(results[-1])))
+    etag = list_etag((product["id"], product["version"]) for product in results)
+    if selected != fields:
+        results = [{field: product[field] for field in fields} for product in results]
+
+    with profiling.timer("serialize"):
+        response = json_response(results)
+    response.set_etag(etag)
+    response.vary.add("Accept")
+    return response, status.HTTP_200_OK, headers
+
+
+def columnar_products(builder: ProductQuery, page, query, fields: tuple, selected: tuple):
+    """Returns a list of Products as columnar MessagePack"""
+    with profiling.timer("serialize"):
+        columns = Product.columns(query, selected)
+    count = len(columns["id"])
+    headers = {}
+    if page is not None and count == page[0]:
+        last = {field: values[-1] for field, values in columns.items()}
+        headers["Link"] = next_page_link(encode_cursor(builder.cursor(last)))
+    etag = list_etag(zip(columns["id"], columns["version"]), MSGPACK_MIMETYPE)
+    if selected != fields:
+        columns = {field: columns[field] for field in fields}
 
-    results = [product.serialize() for product in products]
-    return jsonify(results), status.HTTP_200_OK
+    with profiling.timer("serialize"):
+        response = Response(encoders.pack_columns(columns, count), mimetype=MSGPACK_MIMETYPE)
+    response.set_etag(etag)
+    response.vary.add("Accept")
+    return response, status.HTTP_200_OK, headers
@@ -0,0 +1,65 @@
+"""
+Test cases for the LRU cache
+"""
+from unittest import TestCase
+from service.common.cache import LRUCache
+
+
+class FakeTimer:
+    """A clock that only moves when told to"""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestLRUCache(TestCase):
+    """LRU Cache tests"""
+
+    def setUp(self):
+        self.timer = FakeTimer()
+        self.cache = LRUCache(maxsize=2, ttl=10, timer=self.timer)
+
+    def test_hit_and_miss(self):
+        """It should count hits and misses"""
+        self.assertIsNone(self.cache.get(1))
+        self.cache.set(1, "one")
+        self.assertEqual(self.cache.get(1), "one")
+        stats = self.cache.stats()
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 1)
+
+    def test_evict_least_recently_used(self):
+        """It should evict the least recently used entry when full"""
+        self.cache.set(1, "one")
+        self.cache.set(2, "two")
+        self.cache.get(1)
+        self.cache.set(3, "three")
+        self.assertIsNone(self.cache.get(2))
+        self.assertEqual(self.cache.get(1), "one")
+        self.assertEqual(self.cache.stats()["evictions"], 1)
+        self.assertEqual(len(self.cache), 2)
+
+    def test_expire_after_ttl(self):
+        """It should not return entries older than the TTL"""
+        self.cache.set(1, "one")
+        self.timer.now = 10
+        self.assertIsNone(self.cache.get(1))
+        self.assertEqual(self.cache.stats()["expirations"], 1)
+
+    def test_invalidate_and_clear(self):
+        """It should drop invalidated and cleared entries"""
+        self.cache.set(1, "one")
+        self.cache.set(2, "two")
+        self.cache.invalidate(1)
+        self.assertIsNone(self.cache.get(1))
+        self.cache.clear()
+        self.assertIsNone(self.cache.get(2))
+
+    def test_disabled(self):
+        """It should store nothing when the size is 0"""
+        self.cache.configure(0, 10)
+        self.cache.set(1, "one")
+        self.assertIsNone(self.cache.get(1))
@@ -2,10 +2,13 @@
 CLI Command Extensions for Flask
 """
 import os
+import tempfile
 from unittest import TestCase
 from unittest.mock import patch, MagicMock
 from click.testing import CliRunner
-from service.common.cli_commands import db_create
+from service import app
+from service.common.cli_commands import cpu_profile, db_create, db_upgrade, idempotency_purge
+from service.common.cli_commands import products_export, products_import
 
 
 class TestFlaskCLI(TestCase):
@@ -21,3 +24,84 @@ class TestFlaskCLI(TestCase):
         with patch.dict(os.environ, {"FLASK_APP": "service:app"}, clear=True):
             result = self.runner.invoke(db_create)
             self.assertEqual(result.exit_code, 0)
+
+    @patch('service.common.cli_commands.upgrade_db')
+    def test_db_upgrade(self, upgrade_mock):
+        """It should call the db-upgrade command"""
+        upgrade_mock.return_value = ["ix_product_price"]
+        with patch.dict(os.environ, {"FLASK_APP": "service:app"}, clear=True):
+            result = self.runner.invoke(db_upgrade)
+            self.assertEqual(result.exit_code, 0)
+            self.assertIn("Created ix_product_price", result.output)
+
+    @patch('service.common.cli_commands.IdempotencyKey')
+    def test_idempotency_purge(self, key_mock):
+        """It should call the idempotency-purge command"""
+        key_mock.purge.return_value = 3
+        with patch.dict(os.environ, {"FLASK_APP": "service:app"}, clear=True):
+            result = self.runner.invoke(idempotency_purge)
+            self.assertEqual(result.exit_code, 0)
+            self.assertIn("Purged 3 idempotency keys", result.output)
+
+    @patch('service.common.cli_commands.urllib.request.urlopen')
+    def test_cpu_profile(self, urlopen_mock):
+        """It should fetch a profile from the running service"""
+        response = urlopen_mock.return_value.__enter__.return_value
+        response.read.return_value = b"MainThread;run (app.py:1) 5\n"
+        response.headers = {"X-Profile-Samples": "5"}
+        with app.app_context(), patch.dict(app.config, {"ADMIN_TOKEN": "s3cret"}):
+            result = self.runner.invoke(cpu_profile, ["--url", "http://worker:8080/", "--seconds", "2"])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("MainThread;run (app.py:1) 5", result.output)
+        request = urlopen_mock.call_args[0][0]
+        self.assertEqual(request.full_url, "http://worker:8080/admin/profile?seconds=2")
+        self.assertEqual(request.get_header("Authorization"), "Bearer s3cret")
+
+    def test_cpu_profile_needs_token(self):
+        """It should refuse to profile without an ADMIN_TOKEN"""
+        with app.app_context(), patch.dict(app.config, {"ADMIN_TOKEN": ""}):
+            result = self.runner.invoke(cpu_profile)
+        self.assertNotEqual(result.exit_code, 0)
+        self.assertIn("ADMIN_TOKEN", result.output)
+
+    @patch('service.common.cli_commands.ensure_schema')
+    @patch('service.common.cli_commands.importer.import_products')
+    def test_products_import(self, import_mock, schema_mock):
+        """It should import a catalog and report the rejected rows"""
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "catalog.csv")
+            with open(path, "w", encoding="utf-8") as catalog:
+                catalog.write("name,description,price,available,category\n")
+
+            import_mock.return_value = {"imported": 1000, "rejected": 2, "seconds": 0.5}
+            result = self.runner.invoke(products_import, [path, "--batch-size", "50"])
+            self.assertEqual(result.exit_code, 0, result.output)
+            self.assertIn("Imported 1000 products in 0.50s (2,000 rows/s)", result.output)
+            self.assertIn(f"Rejected 2 rows, see {path}.rejects.ndjson", result.output)
+            self.assertEqual(import_mock.call_args[0][1], "csv")
+            self.assertEqual(import_mock.call_args[0][3], 50)
+            self.assertTrue(os.path.exists(f"{path}.rejects.ndjson"))
+            schema_mock.assert_called_once()
+
+            import_mock.return_value = {"imported": 1000, "rejected": 0, "seconds": 0.5}
+            result = self.runner.invoke(products_import, [path])
+            self.assertEqual(result.exit_code, 0, result.output)
+            self.assertFalse(os.path.exists(f"{path}.rejects.ndjson"))
+
+    def test_products_import_unknown_format(self):
+        """It should ask for --format when the extension is unknown"""
+        with tempfile.NamedTemporaryFile(suffix=".xlsx") as catalog:
+            result = self.runner.invoke(products_import, [catalog.name])
+        self.assertNotEqual(result.exit_code, 0)
+        self.assertIn("--format", result.output)
+
+    @patch('service.common.cli_commands.ensure_schema')
+    @patch('service.common.cli_commands.exporter.export_products')
+    def test_products_export(self, export_mock, schema_mock):
+        """It should export the catalog and report the rate"""
+        export_mock.return_value = {"files": [{"path": "part-00000.csv", "rows": 500}] * 4, "rows": 2000, "seconds": 0.5}
+        result = self.runner.invoke(products_export, ["out", "--format", "msgpack", "--workers", "2", "--pool", "process"])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("Exported 2000 products to 4 files in out in 0.50s (4,000 rows/s)", result.output)
+        export_mock.assert_called_once_with("out", "msgpack", 2, None, 10000, "process")
+        schema_mock.assert_called_once()
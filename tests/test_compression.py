@@ -0,0 +1,57 @@
+"""
+Test cases for response compression
+"""
+import zlib
+from unittest import TestCase
+from werkzeug.datastructures import Accept
+from service.common import compression
+
+CONFIG = {
+    "COMPRESS_ALGORITHMS": ["zstd", "br", "gzip"],
+    "COMPRESS_GZIP_LEVEL": 5,
+    "COMPRESS_BROTLI_QUALITY": 4,
+    "COMPRESS_ZSTD_LEVEL": 3,
+}
+
+
+class TestCompression(TestCase):
+    """Compression Tests"""
+
+    def test_negotiate_by_quality_then_preference(self):
+        """It should pick the accepted coding with the best quality"""
+        codings = ["zstd", "br", "gzip"]
+        self.assertEqual(compression.negotiate(Accept([("gzip", 1), ("br", 1)]), codings), "br")
+        self.assertEqual(compression.negotiate(Accept([("gzip", 1), ("br", 0.5)]), codings), "gzip")
+        self.assertEqual(compression.negotiate(Accept([("*", 1)]), codings), "zstd")
+        self.assertIsNone(compression.negotiate(Accept([("deflate", 1)]), codings))
+        self.assertIsNone(compression.negotiate(Accept([]), codings))
+
+    def test_compressors_round_trip(self):
+        """It should compress with every installed coding in preference order"""
+        data = b'{"name": "hammer"}\n' * 1000
+        codings = compression.compressors(CONFIG)
+        self.assertEqual(list(codings)[-1], "gzip")
+        for coding, factory in codings.items():
+            compressor = factory()
+            body = compressor.compress(data) + compressor.flush()
+            self.assertLess(len(body), len(data), coding)
+        compressor = codings["gzip"]()
+        body = compressor.compress(data) + compressor.flush()
+        self.assertEqual(zlib.decompress(body, 31), data)
+
+    def test_compressors_honor_configuration(self):
+        """It should only offer the configured codings"""
+        self.assertEqual(list(compression.compressors(dict(CONFIG, COMPRESS_ALGORITHMS=["gzip"]))), ["gzip"])
+
+    def test_stream_flushes_as_it_goes(self):
+        """It should flush a compressed stream instead of holding it back to the end"""
+        rows = [b'{"name": "hammer"}\n'] * 5
+        compress_stream = compression._compress_stream  # pylint: disable=protected-access
+        for coding, factory in compression.compressors(CONFIG).items():
+            self.assertEqual(len(list(compress_stream(iter(rows), factory(), 0))), 6, coding)
+            self.assertEqual(len(list(compress_stream(iter(rows), factory(), 3600))), 2, coding)
+
+        decoder = zlib.decompressobj(31)
+        pieces = compress_stream(iter(rows), compression.compressors(CONFIG)["gzip"](), 3600)
+        self.assertEqual(decoder.decompress(next(pieces)), rows[0])
+        self.assertEqual(b"".join(map(decoder.decompress, pieces)), b"".join(rows[1:]))
@@ -0,0 +1,82 @@
+"""
+Test cases for the gunicorn configuration
+"""
+import os
+import runpy
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+from service import app
+from service.models import db
+from service.common.pool import pool_stats
+
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), "gunicorn.conf.py")
+
+
+def load_config(**env) -> dict:
+    """Evaluates gunicorn.conf.py under the given environment variables"""
+    with patch.dict(os.environ, env):
+        os.environ.pop("DB_POOL_SIZE", None)
+        config = runpy.run_path(CONFIG_PATH)
+        config["DB_POOL_SIZE"] = os.environ["DB_POOL_SIZE"]
+    return config
+
+
+class TestGunicornConfig(TestCase):
+    """Gunicorn Configuration Tests"""
+
+    def test_defaults_follow_cpu_count(self):
+        """It should size gthread workers from the CPU count"""
+        config = load_config()
+        self.assertEqual(config["worker_class"], "gthread")
+        self.assertEqual(config["workers"], config["CPUS"])
+        self.assertEqual(config["threads"], 4)
+        self.assertEqual(config["DB_POOL_SIZE"], "4")
+        self.assertTrue(config["preload_app"])
+        self.assertGreater(config["max_requests_jitter"], 0)
+
+    def test_environment_overrides(self):
+        """It should take workers, threads and the worker class from the environment"""
+        config = load_config(GUNICORN_WORKERS="3", GUNICORN_THREADS="8", GUNICORN_MAX_REQUESTS="0")
+        self.assertEqual((config["workers"], config["threads"]), (3, 8))
+        self.assertEqual(config["DB_POOL_SIZE"], "8")
+        self.assertEqual(config["max_requests_jitter"], 0)
+
+        config = load_config(GUNICORN_WORKER_CLASS="sync", WEB_CONCURRENCY="2")
+        self.assertEqual((config["workers"], config["threads"]), (2, 1))
+
+    def test_post_fork_disposes_engine(self):
+        """It should drop inherited pooled connections after a fork"""
+        config = load_config()
+        pool_stats.increment("connects")
+        with app.app_context():
+            engine = db.engine
+        with patch.object(engine, "dispose") as dispose:
+            config["post_fork"](MagicMock(), MagicMock())
+        dispose.assert_called_once_with(close=False)
+        self.assertEqual(pool_stats.as_dict()["connects"], 0)
+
+    def test_worker_boot_time_recorded(self):
+        """It should observe the time from spawning a worker until it is ready"""
+        config = load_config()
+        worker = MagicMock()
+        config["pre_fork"](MagicMock(), worker)
+        with patch("service.common.metrics.WORKER_BOOT") as boot:
+            config["post_worker_init"](worker)
+        boot.observe.assert_called_once()
+        self.assertGreaterEqual(boot.observe.call_args[0][0], 0)
+
+    def test_when_ready_checks_schema_once(self):
+        """It should check the schema in the master when the app is preloaded"""
+        config = load_config()
+        with patch("service.models.ensure_schema") as ensure_schema:
+            config["when_ready"](MagicMock())
+        ensure_schema.assert_called_once()
+
+    def test_child_exit_marks_process_dead(self):
+        """It should clean up a dead worker's metrics in multiprocess mode"""
+        config = load_config()
+        worker = MagicMock(pid=1234)
+        with patch("prometheus_client.multiprocess.mark_process_dead") as mark_dead:
+            with patch.dict(os.environ, {"PROMETHEUS_MULTIPROC_DIR": "/tmp"}):
+                config["child_exit"](MagicMock(), worker)
+        mark_dead.assert_called_once_with(1234)
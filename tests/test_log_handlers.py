@@ -0,0 +1,110 @@
+"""
+Test cases for the logging pipeline
+"""
+import io
+import json
+import logging
+import queue
+import sys
+from unittest import TestCase
+from unittest.mock import patch
+from service import create_app
+from service.common import log_handlers
+
+
+def make_record(level: int = logging.INFO, msg: str = "hello %s", args=("world",), **extra) -> logging.LogRecord:
+    """Returns a log record as a logger would create it"""
+    record = logging.LogRecord("flask.app", level, __file__, 1, msg, args, None)
+    record.__dict__.update(extra)
+    return record
+
+
+class TestLogHandlers(TestCase):
+    """Logging Pipeline Tests"""
+
+    def tearDown(self):
+        log_handlers.stop_pipeline()
+
+    def test_json_formatter(self):
+        """It should format a record as a JSON object with its extra fields"""
+        line = log_handlers.JsonFormatter().format(make_record(product_id=7))
+        entry = json.loads(line)
+        self.assertEqual(entry["level"], "INFO")
+        self.assertEqual(entry["logger"], "flask.app")
+        self.assertEqual(entry["message"], "hello world")
+        self.assertEqual(entry["product_id"], 7)
+        self.assertTrue(entry["ts"].endswith("+00:00"))
+
+    def test_json_formatter_exception(self):
+        """It should keep the traceback of a queued record out of the message"""
+        try:
+            raise ValueError("boom")
+        except ValueError:
+            record = logging.LogRecord("flask.app", logging.ERROR, __file__, 1, "failed", None, sys.exc_info())
+        handler = log_handlers.NonBlockingQueueHandler(queue.Queue())
+        prepared = handler.prepare(record)
+        self.assertIsNone(prepared.exc_info)
+        entry = json.loads(log_handlers.JsonFormatter().format(prepared))
+        self.assertEqual(entry["message"], "failed")
+        self.assertIn("ValueError: boom", entry["exc_info"])
+
+    def test_sampling_filter(self):
+        """It should keep the configured fraction of a level"""
+        sampler = log_handlers.SamplingFilter({"debug": 0.25, "INFO": 1})
+        kept = [sampler.filter(make_record(logging.DEBUG)) for _ in range(100)]
+        self.assertEqual(sum(kept), 25)
+        self.assertTrue(all(sampler.filter(make_record(logging.INFO)) for _ in range(10)))
+        self.assertTrue(sampler.filter(make_record(logging.WARNING)))
+
+    def test_rate_limit_filter(self):
+        """It should cap the records per second and report how many it dropped"""
+        limiter = log_handlers.RateLimitFilter({"INFO": 5})
+        with patch("service.common.log_handlers.time.monotonic", return_value=100.0):
+            kept = [limiter.filter(make_record()) for _ in range(8)]
+        self.assertEqual(sum(kept), 5)
+        record = make_record()
+        with patch("service.common.log_handlers.time.monotonic", return_value=101.0):
+            self.assertTrue(limiter.filter(record))
+        self.assertEqual(record.suppressed, 3)
+        self.assertTrue(limiter.filter(make_record(logging.ERROR)))
+
+    def test_queue_handler_drops_when_full(self):
+        """It should drop records instead of blocking when the queue is full"""
+        handler = log_handlers.NonBlockingQueueHandler(queue.Queue(2))
+        for _ in range(5):
+            handler.handle(make_record())
+        self.assertEqual(handler.queue.qsize(), 2)
+        self.assertEqual(handler.dropped, 3)
+
+    def test_pipeline_writes_batches(self):
+        """It should write queued records in batches from the listener thread"""
+        stream = io.StringIO()
+        target = log_handlers.BatchingStreamHandler(stream, capacity=3)
+        with patch.object(stream, "write", wraps=stream.write) as write:
+            handler = log_handlers.start_pipeline(target, 100)
+            for number in range(7):
+                handler.handle(make_record(args=(number,)))
+            log_handlers.stop_pipeline()
+        lines = stream.getvalue().splitlines()
+        self.assertEqual(lines, [f"hello {number}" for number in range(7)])
+        self.assertLess(write.call_count, 7)
+
+    def test_init_logging_async(self):
+        """It should route the app and model loggers through the queue"""
+        app = create_app({"LOG_ASYNC": True, "LOG_SAMPLE_RATES": {"DEBUG": 0.1}, "LOG_RATE_LIMITS": {"INFO": 100}})
+        handlers = logging.getLogger("flask.app").handlers
+        self.assertEqual(app.logger.handlers, handlers)
+        self.assertIsInstance(handlers[0], log_handlers.NonBlockingQueueHandler)
+        self.assertEqual(len(handlers[0].filters), 2)
+        self.assertIsInstance(log_handlers._pipeline["listener"].handlers[0].formatter,  # pylint: disable=protected-access
+                              log_handlers.JsonFormatter)
+
+    def test_init_logging_sync(self):
+        """It should use the server handlers directly when LOG_ASYNC is off"""
+        server_handler = logging.StreamHandler(io.StringIO())
+        gunicorn_logger = logging.getLogger("gunicorn.error")
+        with patch.object(gunicorn_logger, "handlers", [server_handler]):
+            app = create_app({"LOG_ASYNC": False, "LOG_FORMAT": "text"})
+        self.assertEqual(app.logger.handlers, [server_handler])
+        self.assertEqual(server_handler.formatter._fmt, log_handlers.TEXT_FORMAT)  # pylint: disable=protected-access
+        self.assertNotIn("listener", log_handlers._pipeline)  # pylint: disable=protected-access
@@ -8,9 +8,14 @@ Test cases for Product Model
 import os
 import logging
 import unittest
+from datetime import datetime, timedelta
 from decimal import Decimal
-from service.models import Product, Category, db
+import msgpack
+from sqlalchemy.orm.exc import StaleDataError
+from service.models import Product, ProductQuery, Category, DataValidationError, db, upgrade_db
+from service.models import invalidate_caches, product_cache, IdempotencyKey
 from service import app
+from service.common import encoders
 from tests.factories import ProductFactory
 
 DATABASE_URI = os.getenv(
@@ -41,7 +46,9 @@ class TestProductModel(unittest.TestCase):
     def setUp(self):
         """Run before each test"""
         db.session.query(Product).delete()
+        db.session.query(IdempotencyKey).delete()
         db.session.commit()
+        invalidate_caches()
 
     def tearDown(self):
         """Run after each test"""
@@ -167,3 +174,333 @@ class TestProductModel(unittest.TestCase):
 
         for product in found:
             self.assertEqual(product.category, category)
+
+    def test_paginate_all_products(self):
+        """It should page through all products by id"""
+        for product in ProductFactory.create_batch(5):
+            product.id = None
+            product.create()
+
+        first = Product.all_paged(2)
+        self.assertEqual(len(first), 2)
+        second = Product.all_paged(2, after=first[-1].id)
+        self.assertEqual(len(second), 2)
+        last = Product.all_paged(2, after=second[-1].id)
+        self.assertEqual(len(last), 1)
+
+        ids = [product.id for product in first + second + last]
+        self.assertEqual(ids, sorted(ids))
+        self.assertEqual(len(set(ids)), 5)
+
+    def test_paginate_find_by_category(self):
+        """It should page through products by category"""
+        products = ProductFactory.create_batch(10)
+        for product in products:
+            product.id = None
+            product.create()
+
+        category = products[0].category
+        expected = len([p for p in products if p.category == category])
+
+        found = Product.find_by_category_paged(category, 100)
+        self.assertEqual(len(found), expected)
+        for product in found:
+            self.assertEqual(product.category, category)
+
+    def test_stream_products(self):
+        """It should stream all products in batches"""
+        for product in ProductFactory.create_batch(5):
+            product.id = None
+            product.create()
+
+        streamed = list(Product.stream(Product.query, batch_size=2))
+        self.assertEqual(len(streamed), 5)
+
+    def test_create_many_products(self):
+        """It should create many products in one transaction"""
+        products = ProductFactory.create_batch(5)
+        ids = Product.create_many([product.serialize() for product in products], chunk_size=2)
+        self.assertEqual(len(ids), 5)
+        self.assertEqual(len(Product.all()), 5)
+        for product_id, product in zip(ids, products):
+            self.assertEqual(Product.find(product_id).name, product.name)
+
+    def test_create_many_products_invalid(self):
+        """It should not create any products when one is invalid"""
+        data = [product.serialize() for product in ProductFactory.create_batch(3)]
+        del data[1]["name"]
+        self.assertRaises(DataValidationError, Product.create_many, data)
+        self.assertEqual(len(Product.all()), 0)
+
+    def test_row_from_validates_lengths(self):
+        """It should validate a row with the deserialize rules and the column lengths"""
+        data = ProductFactory.build().serialize()
+        row = Product.row_from(data)
+        self.assertEqual(tuple(row), Product.LOAD_COLUMNS)
+        self.assertEqual(row["category"], Category[data["category"]])
+        self.assertRaises(DataValidationError, Product.row_from, dict(data, name="x" * 101))
+        self.assertRaises(DataValidationError, Product.row_from, dict(data, description=7))
+        self.assertRaises(DataValidationError, Product.row_from, dict(data, price="cheap"))
+
+    def test_load_rows(self):
+        """It should bulk load validated rows and commit them"""
+        rows = [Product.row_from(product.serialize()) for product in ProductFactory.build_batch(5)]
+        self.assertEqual(Product.load_rows(rows), 5)
+        self.assertEqual(Product.load_rows([]), 0)
+        db.session.remove()
+        products = Product.all()
+        self.assertEqual(sorted(p.name for p in products), sorted(row["name"] for row in rows))
+        self.assertTrue(all(p.version == 1 for p in products))
+
+    def test_update_many_by_ids(self):
+        """It should update many products selected by id"""
+        ids = Product.create_many([p.serialize() for p in ProductFactory.create_batch(4)])
+        count = Product.update_many({"available": False}, ids=ids[:3])
+        self.assertEqual(count, 3)
+        for product_id in ids[:3]:
+            self.assertFalse(Product.find(product_id).available)
+
+    def test_update_many_price_delta_by_filter(self):
+        """It should adjust the price of products selected by a filter"""
+        data = [p.serialize() for p in ProductFactory.create_batch(4, category=Category.FOOD, price=Decimal("10.00"))]
+        data[0]["category"] = "TOOLS"
+        ids = Product.create_many(data)
+        count = Product.update_many({"price_delta": "-2.50"}, filters={"category": "FOOD"})
+        self.assertEqual(count, 3)
+        self.assertEqual(Decimal(Product.find(ids[0]).price), Decimal("10.00"))
+        self.assertEqual(Decimal(Product.find(ids[1]).price), Decimal("7.50"))
+
+    def test_update_many_invalid(self):
+        """It should not update many products with bad input"""
+        self.assertRaises(DataValidationError, Product.update_many, {"available": False})
+        self.assertRaises(DataValidationError, Product.update_many, {"color": "red"}, filters={})
+        self.assertRaises(DataValidationError, Product.update_many, {"available": "no"}, filters={})
+        self.assertRaises(DataValidationError, Product.update_many, {"price": "abc"}, filters={})
+        self.assertRaises(DataValidationError, Product.update_many, {"price": 1}, filters={"color": 1})
+        self.assertRaises(DataValidationError, Product.update_many, {"price": 1}, ids="1")
+        self.assertRaises(DataValidationError, Product.update_many, {}, filters={})
+        self.assertRaises(DataValidationError, Product.update_many, {"price": "NaN"}, filters={})
+        self.assertRaises(DataValidationError, Product.update_many, {"price": 1}, filters={"name_prefix": 5})
+        self.assertRaises(DataValidationError, Product.update_many, {"price": 1}, filters={"name": 5})
+        self.assertRaises(DataValidationError, Product.delete_many, filters={"q": ["hat"]})
+        self.assertRaises(DataValidationError, Product.update_many, {"price_delta": "Infinity"}, filters={})
+        self.assertRaises(DataValidationError, Product.update_many, {"name": "x" * 101}, filters={})
+        self.assertRaises(DataValidationError, Product.update_many, {"description": "x" * 251}, filters={})
+
+    def test_delete_many(self):
+        """It should delete many products with one statement"""
+        ids = Product.create_many([p.serialize() for p in ProductFactory.create_batch(5)])
+        self.assertEqual(Product.delete_many(ids=ids[:2]), 2)
+        self.assertEqual(len(Product.all()), 3)
+        self.assertEqual(Product.delete_many(filters={}), 3)
+        self.assertEqual(len(Product.all()), 0)
+
+    def test_query_builder_combines_filters(self):
+        """It should combine many filters into a single query"""
+        data = [p.serialize() for p in ProductFactory.create_batch(6, available=True, price=Decimal("5.00"))]
+        data[0].update(name="Hammer", category="TOOLS")
+        data[1].update(name="hammock", category="HOUSEWARES", price="25.00")
+        data[2].update(name="Hamster food", category="FOOD", available=False)
+        Product.create_many(data)
+
+        found = ProductQuery().name_prefix("HAM").categories([Category.TOOLS, Category.HOUSEWARES]).query().all()
+        self.assertEqual(sorted(p.name for p in found), ["Hammer", "hammock"])
+
+        found = ProductQuery.from_args({"name_prefix": "ham", "price_min": "10", "available": True}).query().all()
+        self.assertEqual([p.name for p in found], ["hammock"])
+
+        found = ProductQuery.from_args({"name_prefix": "ham", "category": "FOOD,TOOLS", "sort": "-name"}).query().all()
+        self.assertEqual([p.name for p in found], ["Hamster food", "Hammer"])
+
+    def test_query_builder_invalid_args(self):
+        """It should not build a query from invalid arguments"""
+        for args in (
+            {"category": "TOYS"},
+            {"available": "maybe"},
+            {"price_max": "cheap"},
+            {"sort": "color"},
+        ):
+            self.assertRaises(DataValidationError, ProductQuery.from_args, args)
+
+    def test_query_builder_keyset_pages(self):
+        """It should page through a sorted query with a cursor"""
+        Product.create_many([p.serialize() for p in ProductFactory.create_batch(7)])
+        builder = ProductQuery().sort("-price,name")
+        expected = [p.id for p in builder.query().all()]
+
+        seen, after = [], None
+        while True:
+            page = builder.page(3, after)
+            seen.extend(p.id for p in page)
+            if len(page) < 3:
+                break
+            after = builder.cursor(page[-1])
+        self.assertEqual(seen, expected)
+        self.assertRaises(DataValidationError, builder.page, 3, [1])
+
+    def test_upgrade_db_creates_missing_indexes(self):
+        """It should create indexes missing from an existing table"""
+        index = next(i for i in Product.__table__.indexes if i.name == "ix_product_price")
+        index.drop(db.engine)
+        self.assertEqual(upgrade_db(), ["ix_product_price"])
+        self.assertEqual(upgrade_db(), [])
+
+    def test_find_serialized_uses_cache(self):
+        """It should serve repeated reads from the cache until a write"""
+        product = ProductFactory()
+        product.create()
+
+        self.assertEqual(Product.find_serialized(product.id)["name"], product.name)
+        hits = product_cache.stats()["hits"]
+        Product.find_serialized(product.id)
+        self.assertEqual(product_cache.stats()["hits"], hits + 1)
+
+        product.name = "Renamed"
+        product.update()
+        self.assertEqual(Product.find_serialized(product.id)["name"], "Renamed")
+
+        Product.update_many({"name": "Bulk"}, ids=[product.id])
+        self.assertEqual(Product.find_serialized(product.id)["name"], "Bulk")
+
+        product = Product.find(product.id)
+        product.delete()
+        self.assertIsNone(Product.find_serialized(product.id))
+
+    def test_update_bumps_version(self):
+        """It should increment the version on every update"""
+        product = ProductFactory()
+        product.create()
+        self.assertEqual(product.version, 1)
+        product.description = "Updated description"
+        product.update()
+        self.assertEqual(product.version, 2)
+        Product.update_many({"available": True}, ids=[product.id])
+        db.session.expire_all()
+        self.assertEqual(Product.find(product.id).version, 3)
+
+    def test_update_stale_product(self):
+        """It should not update a product changed since it was read"""
+        if not db.engine.dialect.supports_sane_rowcount_returning:
+            self.skipTest("database cannot verify row versions")
+        product = ProductFactory()
+        product.create()
+        self.assertEqual(product.version, 1)
+        with db.engine.begin() as connection:
+            connection.execute(
+                db.update(Product).where(Product.id == product.id).values(description="Changed elsewhere", version=2)
+            )
+        product.description = "Lost update"
+        self.assertRaises(StaleDataError, product.update)
+        db.session.expire_all()
+        self.assertEqual(Product.find(product.id).description, "Changed elsewhere")
+
+    def test_upgrade_db_adds_missing_columns(self):
+        """It should add columns missing from an existing table"""
+        db.session.close()
+        with db.engine.begin() as connection:
+            connection.execute(db.text("ALTER TABLE product DROP COLUMN version"))
+        self.assertEqual(upgrade_db(), ["product.version"])
+        product = ProductFactory()
+        product.create()
+        self.assertEqual(Product.find(product.id).version, 1)
+
+    def test_project_matches_serialize(self):
+        """It should serialize projected rows exactly like serialize()"""
+        Product.create_many([p.serialize() for p in ProductFactory.create_batch(5)])
+        query = Product.query.order_by(Product.id)
+        expected = [product.serialize() for product in query]
+        self.assertEqual(list(Product.project(query)), expected)
+        self.assertEqual(list(Product.project(query, batch_size=2)), expected)
+        narrowed = [{"price": p["price"], "id": p["id"], "category": p["category"]} for p in expected]
+        self.assertEqual(list(Product.project(query, fields=("price", "id", "category"))), narrowed)
+
+    def test_purge_idempotency_keys(self):
+        """It should purge only the idempotency keys older than the TTL"""
+        now = datetime.utcnow()
+        for key, age in (("fresh", 0), ("stale", IdempotencyKey.ttl + 60)):
+            db.session.add(
+                IdempotencyKey(key=key, fingerprint="0" * 64, response={}, created_at=now - timedelta(seconds=age))
+            )
+        db.session.commit()
+        self.assertIsNone(IdempotencyKey.find("stale"))
+        self.assertEqual(IdempotencyKey.purge(), 1)
+        self.assertEqual([record.key for record in IdempotencyKey.query.all()], ["fresh"])
+
+    def test_columns(self):
+        """It should read a query into columns of raw values"""
+        Product.create_many([p.serialize() for p in ProductFactory.create_batch(3)])
+        query = Product.query.order_by(Product.id)
+        products = query.all()
+        columns = Product.columns(query, ("id", "price", "category"))
+        self.assertEqual(columns["id"], [p.id for p in products])
+        self.assertEqual(columns["price"], [p.price for p in products])
+        self.assertEqual(columns["category"], [p.category for p in products])
+        self.assertEqual(Product.columns(query.filter(Product.id < 0)), {field: [] for field in Product.FIELDS})
+
+    def test_column_batches(self):
+        """It should stream a query as batches of columns"""
+        Product.create_many([p.serialize() for p in ProductFactory.create_batch(5)])
+        query = Product.query.order_by(Product.id)
+        batches = list(Product.column_batches(query, 2, ("id", "category")))
+        self.assertEqual([len(batch["id"]) for batch in batches], [2, 2, 1])
+        self.assertEqual(sum((batch["id"] for batch in batches), []), [p.id for p in query])
+        self.assertEqual(list(Product.column_batches(query.filter(Product.id < 0), 2)), [])
+
+    def test_pack_columns(self):
+        """It should scale prices and dictionary encode categories"""
+        columns = {"price": [Decimal("1.5"), Decimal("20"), Decimal("0.125")], "category": [Category.FOOD] * 3}
+        document = msgpack.unpackb(encoders.pack_columns(columns, 3))
+        self.assertEqual(document["scales"], {"price": 3})
+        self.assertEqual(document["columns"]["price"], [1500, 20000, 125])
+        self.assertEqual(document["columns"]["category"], [Category.FOOD.value] * 3)
+        self.assertEqual(document["dictionaries"]["category"][Category.FOOD.value], "FOOD")
+        decoded = encoders.unpack_columns(encoders.pack_columns(columns, 3))
+        self.assertEqual(decoded["price"], columns["price"])
+        self.assertEqual(decoded["category"], ["FOOD"] * 3)
+
+    def test_search_ranks_name_matches_first(self):
+        """It should search name and description and rank name matches first"""
+        data = [p.serialize() for p in ProductFactory.create_batch(4)]
+        data[0].update(name="Plain", description="Goes well with a red hat")
+        data[1].update(name="Red Hat", description="A fedora")
+        data[2].update(name="Hatchet", description="Splits wood")
+        data[3].update(name="Shoe", description="Leather")
+        Product.create_many(data)
+
+        found = ProductQuery().search("red hat").query().all()
+        self.assertEqual([p.name for p in found], ["Red Hat", "Plain"])
+
+        found = ProductQuery().search("HAT").query().all()
+        self.assertEqual(found[0].name, "Red Hat")
+        self.assertEqual(len(found), 3)
+        self.assertEqual(len(ProductQuery().search("!!").query().all()), 4)
+
+    def test_stats(self):
+        """It should compute catalog statistics per category"""
+        data = [p.serialize() for p in ProductFactory.create_batch(4)]
+        data[0].update(category="FOOD", price="2.00", available=True)
+        data[1].update(category="FOOD", price="4.00", available=False)
+        data[2].update(category="TOOLS", price="10.00", available=True)
+        data[3].update(category="TOOLS", price="20.00", available=True)
+        Product.create_many(data)
+
+        stats = Product.stats()
+        self.assertEqual(stats["count"], 4)
+        self.assertEqual(stats["available"], 3)
+        self.assertEqual(stats["available_ratio"], 0.75)
+        self.assertEqual(Decimal(stats["price_min"]), Decimal("2"))
+        self.assertEqual(Decimal(stats["price_max"]), Decimal("20"))
+        self.assertEqual(stats["price_avg"], "9.00")
+        self.assertEqual(stats["categories"]["FOOD"]["count"], 2)
+        self.assertEqual(stats["categories"]["FOOD"]["price_avg"], "3.00")
+        self.assertEqual(stats["categories"]["TOOLS"]["available_ratio"], 1.0)
+
+    def test_stats_cached_until_write(self):
+        """It should cache statistics until a Product is written"""
+        self.assertEqual(Product.stats()["count"], 0)
+        self.assertIsNone(Product.stats()["price_avg"])
+        product = ProductFactory()
+        product.create()
+        self.assertEqual(Product.stats()["count"], 1)
+        Product.delete_many(filters={})
+        self.assertEqual(Product.stats()["count"], 0)
@@ -5,13 +5,18 @@
 Product API Service Test Suite
 """
 from urllib.parse import quote_plus
+import copy
+import gzip
+import json
 import os
 import logging
 from decimal import Decimal
 from unittest import TestCase
+from unittest.mock import patch
+from sqlalchemy.exc import DBAPIError
 from service import app
-from service.common import status
-from service.models import db, init_db, Product
+from service.common import encoders, status
+from service.models import db, init_db, invalidate_caches, IdempotencyKey, Product
 from tests.factories import ProductFactory
 
 DATABASE_URI = os.getenv(
@@ -42,7 +47,9 @@ class TestProductRoutes(TestCase):
     def setUp(self):
         self.client = app.test_client()
         db.session.query(Product).delete()
+        db.session.query(IdempotencyKey).delete()
         db.session.commit()
+        invalidate_caches()
 
     def tearDown(self):
         db.session.remove()
@@ -164,3 +171,558 @@ class TestProductRoutes(TestCase):
         data = response.get_json()
         for product in data:
             self.assertEqual(product["available"], available)
+
+    def test_list_products_paginated(self):
+        """It should List Products one page at a time"""
+        self._create_products(5)
+
+        response = self.client.get(f"{BASE_URL}?limit=2")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.get_json()), 2)
+
+        seen = [product["id"] for product in response.get_json()]
+        while "Link" in response.headers:
+            next_url = response.headers["Link"].split(";")[0].strip("<>")
+            response = self.client.get(next_url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            seen.extend(product["id"] for product in response.get_json())
+
+        self.assertEqual(len(seen), 5)
+        self.assertEqual(seen, sorted(seen))
+
+    def test_list_products_paginated_by_categories(self):
+        """It should keep repeated filters on every page"""
+        data = [p.serialize() for p in ProductFactory.build_batch(9)]
+        for i, product in enumerate(data):
+            product["category"] = ["FOOD", "TOOLS", "CLOTHS"][i % 3]
+        self.client.post(f"{BASE_URL}:batch", json=data)
+
+        response = self.client.get(f"{BASE_URL}?category=FOOD&category=TOOLS&limit=2")
+        seen = response.get_json()
+        while "Link" in response.headers:
+            response = self.client.get(response.headers["Link"].split(";")[0].strip("<>"))
+            seen.extend(response.get_json())
+        self.assertEqual(len(seen), 6)
+        self.assertEqual(sorted(product["category"] for product in seen), ["FOOD"] * 3 + ["TOOLS"] * 3)
+
+    def test_list_products_bad_page_args(self):
+        """It should not List Products with a bad limit or cursor"""
+        response = self.client.get(f"{BASE_URL}?limit=0")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(f"{BASE_URL}?limit=abc")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(f"{BASE_URL}?after=not-a-cursor")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_stream_products_ndjson(self):
+        """It should stream Products as NDJSON"""
+        self._create_products(3)
+
+        response = self.client.get(BASE_URL, headers={"Accept": "application/x-ndjson"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.mimetype, "application/x-ndjson")
+        lines = response.get_data(as_text=True).splitlines()
+        self.assertEqual(len(lines), 3)
+        for line in lines:
+            self.assertIn("name", json.loads(line))
+
+        response = self.client.get(f"{BASE_URL}?stream=1&limit=2")
+        self.assertEqual(response.mimetype, "application/x-ndjson")
+        self.assertEqual(len(response.get_data(as_text=True).splitlines()), 2)
+
+    ############################################################
+    # BULK CREATE
+    ############################################################
+    def test_create_products_batch(self):
+        """It should Create many Products from a JSON array"""
+        data = [product.serialize() for product in ProductFactory.create_batch(4)]
+        response = self.client.post(f"{BASE_URL}:batch", json=data)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        body = response.get_json()
+        self.assertEqual(body["count"], 4)
+        self.assertEqual(len(body["ids"]), 4)
+
+        response = self.client.get(BASE_URL)
+        self.assertEqual(len(response.get_json()), 4)
+
+    def test_create_products_batch_ndjson(self):
+        """It should Create many Products from an NDJSON body"""
+        lines = [json.dumps(product.serialize()) for product in ProductFactory.create_batch(3)]
+        response = self.client.post(
+            f"{BASE_URL}:batch",
+            data="\n".join(lines) + "\n",
+            content_type="application/x-ndjson",
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.get_json()["count"], 3)
+
+    def test_create_products_batch_bad_data(self):
+        """It should not Create a batch with bad data or media type"""
+        data = [product.serialize() for product in ProductFactory.create_batch(2)]
+        data[0]["available"] = "yes"
+        response = self.client.post(f"{BASE_URL}:batch", json=data)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post(f"{BASE_URL}:batch", json={"name": "x"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        data[0]["available"] = True
+        data[1]["category"] = "mro"
+        response = self.client.post(f"{BASE_URL}:batch", json=data)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post(f"{BASE_URL}:batch", data="[]", content_type="text/plain")
+        self.assertEqual(response.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+        response = self.client.get(BASE_URL)
+        self.assertEqual(len(response.get_json()), 0)
+
+    ############################################################
+    # BULK UPDATE + DELETE
+    ############################################################
+    def test_update_products_batch(self):
+        """It should Update many Products in one request"""
+        products = self._create_products(4)
+        ids = [product.id for product in products]
+
+        response = self.client.patch(
+            f"{BASE_URL}:batch", json={"ids": ids[:2], "set": {"available": False}}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.get_json()["updated"], 2)
+        for product_id in ids[:2]:
+            response = self.client.get(f"{BASE_URL}/{product_id}")
+            self.assertFalse(response.get_json()["available"])
+
+        response = self.client.patch(f"{BASE_URL}:batch", json={"set": {"available": False}})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.patch(f"{BASE_URL}:batch", json=[1, 2])
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_update_products_batch_invalid_values(self):
+        """It should reject non-finite prices and overlong names in a bulk update"""
+        product = self._create_products(1)[0]
+        for changes in ({"price_delta": "Infinity"}, {"price": "NaN"}, {"price": "-inf"}, {"name": "x" * 500}):
+            response = self.client.patch(
+                f"{BASE_URL}:batch", json={"filter": {"price_min": "0"}, "set": changes}
+            )
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, changes)
+        for selector in ({"name_prefix": 5}, {"name": 5}):
+            response = self.client.patch(f"{BASE_URL}:batch", json={"filter": selector, "set": {"available": True}})
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, selector)
+        response = self.client.get(f"{BASE_URL}/{product.id}")
+        self.assertEqual(Decimal(response.get_json()["price"]), Decimal(product.price))
+        self.assertEqual(response.get_json()["name"], product.name)
+
+    def test_delete_products_batch(self):
+        """It should Delete many Products in one request"""
+        self._create_products(5)
+
+        response = self.client.delete(f"{BASE_URL}:batch", json={"filter": {}})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.get_json()["deleted"], 5)
+        response = self.client.get(BASE_URL)
+        self.assertEqual(len(response.get_json()), 0)
+
+    def test_list_products_combined_filters(self):
+        """It should List Products matching several filters at once"""
+        products = self._create_products(10)
+        category = products[0].category.name
+        price_min = min(p.price for p in products)
+
+        response = self.client.get(
+            f"{BASE_URL}?category={category}&available=true&price_min={price_min}&sort=-price"
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()
+        expected = [p for p in products if p.category.name == category and p.available]
+        self.assertEqual(len(data), len(expected))
+        prices = [Decimal(product["price"]) for product in data]
+        self.assertEqual(prices, sorted(prices, reverse=True))
+        for product in data:
+            self.assertEqual(product["category"], category)
+            self.assertTrue(product["available"])
+
+    def test_list_products_by_price(self):
+        """It should List Products by price"""
+        products = self._create_products(5)
+        price = products[0].price
+
+        response = self.client.get(f"{BASE_URL}?price={price}")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()
+        self.assertEqual(len(data), len([p for p in products if p.price == price]))
+
+    def test_list_products_sorted_pages(self):
+        """It should page through sorted Products"""
+        self._create_products(5)
+        response = self.client.get(f"{BASE_URL}?sort=name,-id")
+        expected = [product["id"] for product in response.get_json()]
+
+        response = self.client.get(f"{BASE_URL}?sort=name,-id&limit=2")
+        seen = [product["id"] for product in response.get_json()]
+        while "Link" in response.headers:
+            response = self.client.get(response.headers["Link"].split(";")[0].strip("<>"))
+            seen.extend(product["id"] for product in response.get_json())
+        self.assertEqual(seen, expected)
+
+    def test_list_products_bad_filter(self):
+        """It should not List Products with a bad filter"""
+        response = self.client.get(f"{BASE_URL}?category=TOYS")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(f"{BASE_URL}?sort=color")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_get_product_cached_until_update(self):
+        """It should serve a cached Product until it is updated"""
+        test_product = self._create_products()[0]
+        self.client.get(f"{BASE_URL}/{test_product.id}")
+        self.client.get(f"{BASE_URL}/{test_product.id}")
+
+        response = self.client.get("/admin/cache")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertGreaterEqual(response.get_json()["hits"], 1)
+
+        updated_data = test_product.serialize()
+        updated_data["description"] = "Fresh description"
+        self.client.put(f"{BASE_URL}/{test_product.id}", json=updated_data)
+        response = self.client.get(f"{BASE_URL}/{test_product.id}")
+        self.assertEqual(response.get_json()["description"], "Fresh description")
+
+    ############################################################
+    # CONDITIONAL REQUESTS
+    ############################################################
+    def test_get_product_not_modified(self):
+        """It should return 304 when the Product ETag still matches"""
+        test_product = self._create_products()[0]
+        response = self.client.get(f"{BASE_URL}/{test_product.id}")
+        etag = response.headers["ETag"]
+
+        response = self.client.get(f"{BASE_URL}/{test_product.id}", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response.get_data(), b"")
+
+        self.client.patch(f"{BASE_URL}:batch", json={"ids": [test_product.id], "set": {"name": "New"}})
+        response = self.client.get(f"{BASE_URL}/{test_product.id}", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response.headers["ETag"], etag)
+
+    def test_list_products_not_modified(self):
+        """It should return 304 when the list ETag still matches"""
+        products = self._create_products(3)
+        response = self.client.get(BASE_URL)
+        etag = response.headers["ETag"]
+
+        response = self.client.get(BASE_URL, headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        self.client.delete(f"{BASE_URL}/{products[0].id}")
+        response = self.client.get(BASE_URL, headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.get_json()), 2)
+
+    def test_update_product_if_match(self):
+        """It should only Update a Product when If-Match is current"""
+        test_product = self._create_products()[0]
+        etag = self.client.get(f"{BASE_URL}/{test_product.id}").headers["ETag"]
+        updated_data = test_product.serialize()
+        updated_data["description"] = "Updated description"
+
+        response = self.client.put(f"{BASE_URL}/{test_product.id}", json=updated_data, headers={"If-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response.headers["ETag"], etag)
+
+        response = self.client.put(f"{BASE_URL}/{test_product.id}", json=updated_data, headers={"If-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        response = self.client.delete(f"{BASE_URL}/{test_product.id}", headers={"If-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        response = self.client.delete(f"{BASE_URL}/{test_product.id}", headers={"If-Match": "*"})
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+
+    ############################################################
+    # ADMIN
+    ############################################################
+    def test_pool_stats(self):
+        """It should report the connection pool of this worker"""
+        self._create_products()
+        response = self.client.get("/admin/pool")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()
+        self.assertEqual(data["pid"], os.getpid())
+        self.assertGreater(data["checkouts"], 0)
+
+    def test_cpu_profile(self):
+        """It should sample this worker as collapsed stacks for a valid admin token"""
+        with patch.dict(app.config, {"ADMIN_TOKEN": "s3cret"}):
+            response = self.client.get(
+                "/admin/profile?seconds=0.05",
+                headers={"Authorization": "Bearer s3cret"},
+                environ_overrides={"wsgi.multithread": True},
+            )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.mimetype, "text/plain")
+        self.assertGreater(int(response.headers["X-Profile-Samples"]), 0)
+        for line in response.get_data(as_text=True).splitlines():
+            self.assertRegex(line, r"^\S.*;.* \d+$")
+
+    def test_cpu_profile_protected(self):
+        """It should hide the profiler without ADMIN_TOKEN and require the token otherwise"""
+        with patch.dict(app.config, {"ADMIN_TOKEN": ""}):
+            response = self.client.get("/admin/profile", headers={"Authorization": "Bearer "})
+            self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        with patch.dict(app.config, {"ADMIN_TOKEN": "s3cret"}):
+            response = self.client.get("/admin/profile", headers={"Authorization": "Bearer wrong"})
+            self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+            self.assertEqual(response.headers["WWW-Authenticate"], "Bearer")
+            response = self.client.get(
+                "/admin/profile?seconds=3600",
+                headers={"Authorization": "Bearer s3cret"},
+                environ_overrides={"wsgi.multithread": True},
+            )
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_cpu_profile_single_threaded_worker(self):
+        """It should refuse to profile a worker that serves one request at a time"""
+        with patch.dict(app.config, {"ADMIN_TOKEN": "s3cret"}):
+            response = self.client.get(
+                "/admin/profile?seconds=0.05",
+                headers={"Authorization": "Bearer s3cret"},
+                environ_overrides={"wsgi.multithread": False},
+            )
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertIn("threaded worker", response.get_json()["message"])
+
+    def test_cpu_profile_one_at_a_time(self):
+        """It should not capture two profiles at once"""
+        with patch.dict(app.config, {"ADMIN_TOKEN": "s3cret"}), patch("service.common.sampler._running") as running:
+            running.acquire.return_value = False
+            response = self.client.get(
+                "/admin/profile?seconds=1",
+                headers={"Authorization": "Bearer s3cret"},
+                environ_overrides={"wsgi.multithread": True},
+            )
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertIn("already", response.get_json()["message"])
+
+    def test_query_timing_survives_failed_statements(self):
+        """It should not leave timing state on a connection when a statement fails"""
+        with db.engine.connect() as connection:
+            info = copy.deepcopy(connection.info)
+            for _ in range(3):
+                self.assertRaises(DBAPIError, connection.exec_driver_sql, "SELECT * FROM no_such_table")
+                connection.rollback()
+            self.assertEqual(dict(connection.info), info)
+            self.assertEqual(connection.exec_driver_sql("SELECT 1").scalar(), 1)
+
+    def test_metrics(self):
+        """It should expose request, database and error metrics"""
+        test_product = self._create_products()[0]
+        self.client.get(f"{BASE_URL}/{test_product.id}")
+        self.client.get(f"{BASE_URL}/0")
+
+        response = self.client.get("/metrics")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        body = response.get_data(as_text=True)
+        self.assertIn('product_http_requests_total{endpoint="get_product",method="GET",status="200"}', body)
+        self.assertIn('product_http_request_duration_seconds_bucket{endpoint="create_products"', body)
+        self.assertIn('product_db_queries_per_request_count{endpoint="get_product"}', body)
+        self.assertIn('product_http_errors_total{handler="not_found"}', body)
+
+    def test_list_products_serializers_match(self):
+        """It should List the same Products with either serializer"""
+        self._create_products(3)
+        projected = self.client.get(f"{BASE_URL}?sort=id").get_json()
+        app.config["LIST_SERIALIZER"] = "orm"
+        try:
+            loaded = self.client.get(f"{BASE_URL}?sort=id").get_json()
+        finally:
+            app.config["LIST_SERIALIZER"] = "projection"
+        self.assertEqual(projected, loaded)
+
+    def test_search_products(self):
+        """It should search Products by name and description a page at a time"""
+        data = [p.serialize() for p in ProductFactory.build_batch(6)]
+        for i, product in enumerate(data):
+            product["name"] = f"Toolbox {i}" if i % 2 else f"Crate {i}"
+            product["description"] = "Sturdy toolbox lid" if i == 0 else "Plain"
+        self.client.post(f"{BASE_URL}:batch", json=data)
+
+        response = self.client.get(f"{BASE_URL}?q=toolbox")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        names = [product["name"] for product in response.get_json()]
+        self.assertEqual(len(names), 4)
+        self.assertEqual(names[-1], "Crate 0")
+
+        response = self.client.get(f"{BASE_URL}?q=toolbox&limit=3")
+        seen = [product["name"] for product in response.get_json()]
+        while "Link" in response.headers:
+            response = self.client.get(response.headers["Link"].split(";")[0].strip("<>"))
+            seen.extend(product["name"] for product in response.get_json())
+        self.assertEqual(seen, names)
+
+    def test_search_products_pages_by_rank(self):
+        """It should page through full text search results without repeats or gaps"""
+        if db.engine.dialect.name != "postgresql":
+            self.skipTest("database has no full text search ranks")
+        data = [p.serialize() for p in ProductFactory.build_batch(9)]
+        for i, product in enumerate(data):
+            product["name"] = "Red hat" if i % 3 else f"Hat {i}"
+            product["description"] = " ".join(["hat"] * (i % 4 + 1))
+        self.client.post(f"{BASE_URL}:batch", json=data)
+
+        response = self.client.get(f"{BASE_URL}?q=hat")
+        ids = [product["id"] for product in response.get_json()]
+        self.assertEqual(len(ids), 9)
+
+        response = self.client.get(f"{BASE_URL}?q=hat&limit=2")
+        seen = [product["id"] for product in response.get_json()]
+        while "Link" in response.headers:
+            response = self.client.get(response.headers["Link"].split(";")[0].strip("<>"))
+            seen.extend(product["id"] for product in response.get_json())
+        self.assertEqual(seen, ids)
+
+    def test_list_products_sparse_fields(self):
+        """It should List only the requested fields, on every page"""
+        self._create_products(5)
+        response = self.client.get(f"{BASE_URL}?fields=name,price&sort=-price&limit=2")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        pages = [response.get_json()]
+        while "Link" in response.headers:
+            response = self.client.get(response.headers["Link"].split(";")[0].strip("<>"))
+            pages.append(response.get_json())
+        rows = [product for page in pages for product in page]
+        self.assertEqual(len(rows), 5)
+        self.assertTrue(all(list(product) == ["name", "price"] for product in rows))
+        self.assertEqual(rows, sorted(rows, key=lambda product: Decimal(product["price"]), reverse=True))
+
+        response = self.client.get(f"{BASE_URL}?fields=id,bogus")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_list_products_compressed(self):
+        """It should compress large lists with the negotiated encoding"""
+        self._create_products(20)
+        plain = self.client.get(BASE_URL)
+        self.assertNotIn("Content-Encoding", plain.headers)
+        self.assertIn("Accept-Encoding", plain.headers["Vary"])
+
+        response = self.client.get(BASE_URL, headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(response.headers["Content-Encoding"], "gzip")
+        self.assertEqual(gzip.decompress(response.data), plain.data)
+        self.assertTrue(response.headers["ETag"].startswith("W/"))
+        self.assertLess(len(response.data), len(plain.data))
+
+        # a 304 carries the validator and Vary of the response it replaces
+        headers = {"Accept-Encoding": "gzip", "If-None-Match": response.headers["ETag"]}
+        not_modified = self.client.get(BASE_URL, headers=headers)
+        self.assertEqual(not_modified.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(not_modified.headers["ETag"], response.headers["ETag"])
+        self.assertEqual(not_modified.vary, response.vary)
+        headers["If-None-Match"] = plain.headers["ETag"]
+        self.assertEqual(self.client.get(BASE_URL, headers=headers).headers["ETag"], plain.headers["ETag"])
+
+        # small bodies are not worth compressing
+        response = self.client.get("/health", headers={"Accept-Encoding": "gzip"})
+        self.assertNotIn("Content-Encoding", response.headers)
+
+    def test_list_products_msgpack(self):
+        """It should List Products as columnar MessagePack when asked to"""
+        self._create_products(5)
+        expected = self.client.get(f"{BASE_URL}?sort=id").get_json()
+        headers = {"Accept": "application/x-msgpack"}
+
+        response = self.client.get(f"{BASE_URL}?sort=id&limit=3", headers=headers)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.mimetype, "application/x-msgpack")
+        columns = encoders.unpack_columns(response.data)
+        response = self.client.get(response.headers["Link"].split(";")[0].strip("<>"), headers=headers)
+        for field, values in encoders.unpack_columns(response.data).items():
+            columns[field].extend(values)
+
+        self.assertEqual(columns["id"], [product["id"] for product in expected])
+        self.assertEqual(columns["category"], [product["category"] for product in expected])
+        self.assertEqual(columns["price"], [Decimal(product["price"]) for product in expected])
+
+        response = self.client.get(f"{BASE_URL}?fields=name", headers=headers)
+        self.assertEqual(list(encoders.unpack_columns(response.data)), ["name"])
+
+        etag = response.headers["ETag"]
+        self.assertNotEqual(etag, self.client.get(f"{BASE_URL}?fields=name").headers["ETag"])
+        response = self.client.get(f"{BASE_URL}?fields=name", headers=dict(headers, **{"If-None-Match": etag}))
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_stream_products_compressed(self):
+        """It should compress streamed lists as they are written"""
+        self._create_products(3)
+        response = self.client.get(f"{BASE_URL}?stream=true&fields=id", headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(response.headers["Content-Encoding"], "gzip")
+        lines = gzip.decompress(response.data).splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(list(json.loads(lines[0])), ["id"])
+
+    def test_static_file_compressed(self):
+        """It should not send the uncompressed length with a compressed file"""
+        plain = self.client.get("/")
+        response = self.client.get("/", headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.headers["Content-Encoding"], "gzip")
+        if "Content-Length" in response.headers:
+            self.assertEqual(int(response.headers["Content-Length"]), len(response.data))
+        self.assertEqual(gzip.decompress(response.data), plain.data)
+
+        # byte ranges are of the uncompressed file
+        response = self.client.get("/", headers={"Accept-Encoding": "gzip", "Range": "bytes=0-9"})
+        self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        self.assertNotIn("Content-Encoding", response.headers)
+        self.assertEqual(response.data, plain.data[:10])
+
+    ############################################################
+    # IDEMPOTENCY
+    ############################################################
+    def test_create_product_idempotent(self):
+        """It should replay the first response when a create is retried with its key"""
+        data = ProductFactory().serialize()
+        headers = {"Idempotency-Key": "retry-1"}
+        first = self.client.post(BASE_URL, json=data, headers=headers)
+        self.assertEqual(first.status_code, status.HTTP_201_CREATED)
+        second = self.client.post(BASE_URL, json=data, headers=headers)
+        self.assertEqual(second.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(second.get_json(), first.get_json())
+        self.assertEqual(second.headers["Location"], first.headers["Location"])
+        self.assertEqual(second.headers["Idempotent-Replayed"], "true")
+        self.assertEqual(Product.query.count(), 1)
+
+        data["name"] = "Something else"
+        response = self.client.post(BASE_URL, json=data, headers=headers)
+        self.assertEqual(response.status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+
+        response = self.client.post(BASE_URL, json=data, headers={"Idempotency-Key": "x" * 256})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(Product.query.count(), 1)
+
+    def test_create_product_idempotent_race(self):
+        """It should replay the response of a concurrent request that stored the key first"""
+        data = ProductFactory().serialize()
+        first = self.client.post(BASE_URL, json=data, headers={"Idempotency-Key": "race"})
+        with patch.object(IdempotencyKey, "find", side_effect=[None, IdempotencyKey.find("race")]):
+            second = self.client.post(BASE_URL, json=data, headers={"Idempotency-Key": "race"})
+        self.assertEqual(second.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(second.get_json()["id"], first.get_json()["id"])
+        self.assertEqual(Product.query.count(), 1)
+
+    def test_create_product_idempotency_key_expires(self):
+        """It should create again once the key has expired"""
+        data = ProductFactory().serialize()
+        first = self.client.post(BASE_URL, json=data, headers={"Idempotency-Key": "old"})
+        with patch.object(IdempotencyKey, "ttl", -1):
+            second = self.client.post(BASE_URL, json=data, headers={"Idempotency-Key": "old"})
+        self.assertNotEqual(second.get_json()["id"], first.get_json()["id"])
+        self.assertEqual(Product.query.count(), 2)
+
+    ############################################################
+    # STATISTICS
+    ############################################################
+    def test_product_stats(self):
+        """It should report catalog statistics"""
+        products = self._create_products(5)
+        response = self.client.get(f"{BASE_URL}/stats")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()
+        self.assertEqual(data["count"], 5)
+        self.assertEqual(data["available"], len([p for p in products if p.available]))
+        self.assertEqual(sum(c["count"] for c in data["categories"].values()), 5)
@@ -0,0 +1,45 @@
+"""
+Test cases for the sampling CPU profiler
+"""
+import threading
+from unittest import TestCase
+from service.common.sampler import ProfilerBusyError, SamplingProfiler, _running
+
+
+def spin(stop: threading.Event):
+    """Keeps a thread busy until it is stopped"""
+    while not stop.is_set():
+        sum(range(1000))
+
+
+class TestSamplingProfiler(TestCase):
+    """Sampling Profiler Tests"""
+
+    def test_samples_other_threads(self):
+        """It should count the stacks of the other threads by thread name"""
+        stop = threading.Event()
+        worker = threading.Thread(target=spin, args=(stop,), name="busy-worker")
+        worker.start()
+        try:
+            profiler = SamplingProfiler(0.001)
+            stacks = profiler.run(0.1)
+        finally:
+            stop.set()
+            worker.join()
+        self.assertGreater(profiler.samples, 0)
+        busy = [stack for stack in stacks if stack.startswith("busy-worker;")]
+        self.assertTrue(busy)
+        self.assertTrue(any("spin (tests/test_sampler.py:" in stack for stack in busy))
+        self.assertFalse(any("run (service/common/sampler.py:" in stack for stack in stacks))
+
+    def test_collapsed_format(self):
+        """It should write one stack and its count per line, hottest first"""
+        profiler = SamplingProfiler()
+        profiler.stacks.update({"MainThread;a (x.py:1)": 1, "MainThread;a (x.py:1);b (x.py:5)": 3})
+        self.assertEqual(profiler.collapsed(), "MainThread;a (x.py:1);b (x.py:5) 3\nMainThread;a (x.py:1) 1\n")
+
+    def test_one_profile_at_a_time(self):
+        """It should refuse to start while another profile is running"""
+        with _running:
+            self.assertRaises(ProfilerBusyError, SamplingProfiler().run, 0.01)
+        self.assertFalse(_running.locked())